@@ -5,9 +5,23 @@ import time
 import re
 import html
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+import threading
+import queue
+import uuid
+import hashlib
+import hmac
+import secrets
+import atexit
+import ast
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
 from telebot import types
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ChatMember
+from template_renderer import ConfigError, TemplateError, load_templates, parse_config, render_template
+from supervisor import Supervisor, CHILD_LOG_FILE
 
 # Configure logging
 logging.basicConfig(level=logging.INFO,
@@ -21,6 +35,143 @@ ADMIN_ID = 6341715879
 CHANNEL_USERNAME = "tenocobotmaker"
 CHANNEL_LINK = "https://t.me/tenocobotmaker"
 DATABASE_FILE = "database.json"
+BOT_INDEX_FILE = "bot_index.json"  # Bot username / token fingerprint -> owner, rebuilt on every database save
+
+BROADCAST_WORKERS = 8
+BROADCAST_RATE_LIMIT = 25  # Messages per second across all workers (Telegram allows ~30/s for bulk sends)
+BROADCAST_MAX_RETRIES = 3  # Retries per recipient after a 429 Too Many Requests
+BROADCAST_STATUS_INTERVAL = 3  # Seconds between progress edits of the admin's status message
+BROADCAST_DIR = "broadcasts"  # Job state (<id>.json) and per-recipient result logs (<id>.log)
+
+MEMBERSHIP_CACHE_SIZE = 10000  # Most (chat, user) membership results kept in memory
+MEMBERSHIP_TTL = 300  # Seconds a "member" result is trusted
+MEMBERSHIP_NEGATIVE_TTL = 15  # Seconds a "not a member" result is trusted
+
+TOKEN_CACHE_SIZE = 1000
+TOKEN_VALID_TTL = 600  # Seconds a successful getMe result is reused for the same token
+TOKEN_INVALID_TTL = 60  # Seconds a token rejected by Telegram stays rejected without asking again
+
+CHAT_INFO_CACHE_SIZE = 5000
+CHAT_INFO_TTL = 3600  # Seconds a resolved must-join chat (type, id, title) is reused
+CHAT_INFO_NEGATIVE_TTL = 300  # Seconds a "chat not found" (or bot) username stays unresolved
+
+CONVERSATION_TTL = 3600  # Seconds an idle creation wizard is kept before its state is dropped
+CONVERSATION_MAX_USERS = 10000  # Wizards kept at once; the least recently used is dropped beyond this
+CONVERSATION_FILE = "conversations.json"  # Snapshot of in-flight wizards restored on restart ("" keeps them in memory only)
+CONVERSATION_SNAPSHOT_INTERVAL = 15  # Seconds between snapshots (only written when something changed)
+
+# Approving a bot renders its template, starts it and marks it Active once it answers getMe.
+# With DEPLOY_ENABLED off the admin deploys by hand and presses "Mark as Active" as before.
+DEPLOY_ENABLED = True
+DEPLOY_MODE = "process"  # "process": one supervised child process per bot; "tenant": hand the bot to tenant_runtime.py
+DEPLOY_DIR = "deployments"  # Process mode: <bot username>/bot.py (rendered template) and the bot's data files
+TENANTS_DIR = "tenants"  # Tenant mode: tenant_runtime.py's TENANTS_DIR
+DEPLOY_TEMPLATE = "naira"  # template_renderer key of the template this maker deploys; must be one of DEPLOYABLE_TEMPLATES
+# The *_async editions have no heartbeat, no webhook mode and are not loadable by tenant_runtime.py,
+# so the supervisor and tenant mode cannot run them; host those by hand.
+DEPLOYABLE_TEMPLATES = ("naira", "ton", "star")
+DEPLOY_WORKERS = 2  # Deploy jobs run in parallel
+DEPLOY_STARTUP_GRACE = 5  # Seconds a new child process must stay up before it counts as started
+DEPLOY_TENANT_TIMEOUT = 90  # Seconds to wait for tenant_runtime.py (which scans every 30s) to report a new tenant running
+TENANT_STATUS_FILE = "runtime.json"  # Written by tenant_runtime.py into the tenant's directory once it started (or failed)
+
+# Webhook mode: set WEBHOOK_URL to the public https base URL (e.g. behind a TLS-terminating reverse
+# proxy forwarding to WEBHOOK_HOST:WEBHOOK_PORT). Leave it empty to use long polling.
+WEBHOOK_URL = ""
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""  # X-Telegram-Bot-Api-Secret-Token value; a random one is generated per run if empty
+WEBHOOK_QUEUE_SIZE = 1000  # Updates waiting for a worker; when full Telegram gets a 503 and redelivers later
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+HANDLER_WORKERS = 4  # Threads running update handlers; updates from one chat always go to the same thread
+HANDLER_QUEUE_SIZE = 1000  # Updates waiting per handler thread before dispatch blocks (backpressure on polling/webhook)
+CALLBACK_STATS_ROUTES = 5  # Slowest callback routes listed in /stats
+HTTP_POOL_SIZE = BROADCAST_WORKERS + HANDLER_WORKERS + 2  # Keep-alive connections to the Bot API: broadcast workers, handlers, polling
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 30  # Long polling adds its own timeout on top of this
+
+# One keep-alive connection pool for both telebot and validate_bot_token. Only connection failures and
+# 502/503/504 on GET requests are retried, so a send is never repeated after Telegram got it.
+def create_http_session():
+    session = requests.Session()
+    retries = Retry(total=3, connect=3, read=0, status=2, backoff_factor=0.5,
+                    status_forcelist=(502, 503, 504), allowed_methods=frozenset(["GET"]))
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE, max_retries=retries, pool_block=True)
+    session.mount("https://", adapter)
+    return session
+
+http_session = create_http_session()
+telebot.apihelper.session = http_session
+telebot.apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+telebot.apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+
+class ChatWorkerPool:
+    # Drop-in replacement for telebot's worker pool: every update is hashed by chat id onto one
+    # worker queue, so one user's updates run in order while different users run in parallel.
+    def __init__(self, telebot_instance, num_workers, queue_size=0):
+        self.telebot = telebot_instance
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(num_workers)]
+        self.max_depths = [0] * num_workers
+        self.processed = [0] * num_workers
+        self.exception_event = threading.Event()
+        self.exception_info = None
+        self.running = True
+        self.workers = [threading.Thread(target=self._work, args=(i,), name=f"chat-worker-{i}", daemon=True) for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    @staticmethod
+    def chat_key(update):
+        chat = getattr(update, "chat", None) or getattr(getattr(update, "message", None), "chat", None)
+        if chat is not None:
+            return chat.id
+        user = getattr(update, "from_user", None)
+        return user.id if user is not None else 0
+
+    def put(self, func, *args, **kwargs):
+        index = self.chat_key(args[0]) % len(self.queues) if args else 0
+        self.queues[index].put((func, args, kwargs))
+        self.max_depths[index] = max(self.max_depths[index], self.queues[index].qsize())
+
+    def _work(self, index):
+        tasks = self.queues[index]
+        while self.running:
+            try:
+                func, args, kwargs = tasks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                handled = self.telebot.exception_handler.handle(e) if self.telebot.exception_handler else False
+                if not handled:
+                    # Surfaced by the polling loop like telebot's own pool does
+                    self.exception_info = e
+                    self.exception_event.set()
+            finally:
+                self.processed[index] += 1
+
+    def queue_depths(self):
+        return [{"depth": tasks.qsize(), "max_depth": self.max_depths[i], "processed": self.processed[i]}
+                for i, tasks in enumerate(self.queues)]
+
+    def raise_exceptions(self):
+        if self.exception_event.is_set():
+            raise self.exception_info
+
+    def clear_exceptions(self):
+        self.exception_event.clear()
+
+    def close(self):
+        self.running = False
+        for worker in self.workers:
+            if worker is not threading.current_thread():
+                worker.join()
+
+bot.worker_pool.close()
+bot.worker_pool = ChatWorkerPool(bot, HANDLER_WORKERS, HANDLER_QUEUE_SIZE)
 
 if not os.path.exists(DATABASE_FILE):
     logger.info(f"Database file '{DATABASE_FILE}' not found. Creating...")
@@ -31,6 +182,11 @@ if not os.path.exists(DATABASE_FILE):
     except Exception as e:
         logger.error(f"Failed to create database file '{DATABASE_FILE}': {e}", exc_info=True)
 
+# Held around every load_database() ... save_database() that changes the database, together with the
+# bot index and /stats counter updates that go with it, so concurrent handlers and deploy threads
+# neither lose each other's writes nor leave the index out of step with the file
+database_lock = threading.RLock()
+
 def load_database():
     try:
         with open(DATABASE_FILE, "r") as f:
@@ -49,44 +205,468 @@ def load_database():
         logger.error(f"An unexpected error occurred while loading the database '{DATABASE_FILE}': {e}", exc_info=True)
         return {"users": {}}
 
+# Written to a temp file and atomically replaced, so a concurrent load never reads a half-written file
 def save_database(data):
     try:
-        with open(DATABASE_FILE, "w") as f:
+        tmp_path = DATABASE_FILE + ".tmp"
+        with open(tmp_path, "w") as f:
             json.dump(data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, DATABASE_FILE)
         logger.debug(f"Database saved successfully to {DATABASE_FILE}")
     except Exception as e:
         logger.error(f"An error occurred while saving the database '{DATABASE_FILE}': {e}", exc_info=True)
 
-user_states = {}
-user_data = {}
+# Running totals for /stats, computed once at startup and then adjusted where users register and
+# bots are created, removed or change status, so neither /stats nor a save walks the database.
+registry_stats = {"total_users": 0, "total_bots": 0, "bots_by_status": {}}
+registry_stats_lock = threading.Lock()
+
+def refresh_registry_stats(data):
+    all_users = data.get("users", {})
+    bots_by_status = {}
+    for user_entry in all_users.values():
+        for bot_entry in user_entry.get("bots", []):
+            status = bot_entry.get("status", "Unknown")
+            bots_by_status[status] = bots_by_status.get(status, 0) + 1
+    with registry_stats_lock:
+        registry_stats["total_users"] = len(all_users)
+        registry_stats["total_bots"] = sum(bots_by_status.values())
+        registry_stats["bots_by_status"] = bots_by_status
+
+def count_new_user():
+    with registry_stats_lock:
+        registry_stats["total_users"] += 1
+
+# Moves one bot between status counters; None as old_status for a new bot, as new_status for a removed one
+def count_bot_status(old_status, new_status):
+    with registry_stats_lock:
+        by_status = registry_stats["bots_by_status"]
+        if old_status is not None:
+            by_status[old_status] = by_status.get(old_status, 0) - 1
+            if by_status[old_status] <= 0:
+                del by_status[old_status]
+        if new_status is not None:
+            by_status[new_status] = by_status.get(new_status, 0) + 1
+        registry_stats["total_bots"] = sum(by_status.values())
+
+def get_registry_stats():
+    with registry_stats_lock:
+        return dict(registry_stats, bots_by_status=dict(registry_stats["bots_by_status"]))
+
+# Index from bot username and token fingerprint to the owning user and the bot's slot in their
+# "bots" list, so callbacks can find a bot without scanning and a bot can only be registered once.
+bot_index = {"bots": {}, "tokens": {}}
+bot_index_lock = threading.Lock()
+
+def bot_index_key(bot_username):
+    return "@" + bot_username.strip().lstrip("@").lower()
+
+def token_fingerprint(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+# Bots registered before fingerprints were stored only have the token inside their config text
+def bot_entry_fingerprint(bot_entry):
+    if bot_entry.get("token_fingerprint"):
+        return bot_entry["token_fingerprint"]
+    match = re.search(r'"BOT_TOKEN":\s*"([^"]+)"', bot_entry.get("config_details", ""))
+    return token_fingerprint(match.group(1)) if match else None
+
+def build_bot_index(data):
+    index = {"bots": {}, "tokens": {}}
+    for owner_id, user_entry in data.get("users", {}).items():
+        for slot, bot_entry in enumerate(user_entry.get("bots", [])):
+            bot_username = bot_entry.get("bot_username")
+            if not bot_username:
+                continue
+            key = bot_index_key(bot_username)
+            if key in index["bots"]:
+                logger.warning(f"Bot {bot_username} is registered more than once (users {index['bots'][key]['owner']} and {owner_id}). Indexing the first.")
+                continue
+            fingerprint = bot_entry_fingerprint(bot_entry)
+            index["bots"][key] = {"owner": owner_id, "slot": slot, "bot_username": bot_username,
+                                  "status": bot_entry.get("status", "Unknown"), "token_fingerprint": fingerprint}
+            if fingerprint:
+                index["tokens"].setdefault(fingerprint, key)
+    return index
+
+# Written at exit; the next start reuses it if no database save happened after it
+def save_bot_index():
+    with bot_index_lock:
+        snapshot = json.dumps(bot_index, indent=4)
+    try:
+        tmp_path = BOT_INDEX_FILE + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(snapshot)
+        os.replace(tmp_path, BOT_INDEX_FILE)
+    except Exception as e:
+        logger.error(f"Failed to save bot index '{BOT_INDEX_FILE}': {e}", exc_info=True)
+
+# Whether a saved index still describes the database: the same bots, each at its recorded slot with its recorded status
+def bot_index_matches(index, data):
+    users = data.get("users", {})
+    stored = {bot_index_key(b["bot_username"]) for u in users.values() for b in u.get("bots", []) if b.get("bot_username")}
+    if set(index["bots"]) != stored:
+        return False
+    for key, indexed in index["bots"].items():
+        bots = users.get(indexed.get("owner"), {}).get("bots", [])
+        slot = indexed.get("slot")
+        if not isinstance(slot, int) or not 0 <= slot < len(bots):
+            return False
+        if bot_index_key(bots[slot].get("bot_username", "")) != key or bots[slot].get("status", "Unknown") != indexed.get("status"):
+            return False
+    return True
+
+# Uses the saved index unless the database was written after it (e.g. edited by hand, or the maker crashed)
+# or it no longer matches the database (e.g. a write that never reached it)
+def load_bot_index():
+    global bot_index
+    data = load_database()
+    try:
+        if os.path.getmtime(BOT_INDEX_FILE) >= os.path.getmtime(DATABASE_FILE):
+            with open(BOT_INDEX_FILE, "r") as f:
+                index = json.load(f)
+            if "bots" in index and "tokens" in index and bot_index_matches(index, data):
+                with bot_index_lock:
+                    bot_index = index
+                logger.info(f"Loaded bot index with {len(index['bots'])} bots from {BOT_INDEX_FILE}.")
+                return
+            logger.warning(f"Bot index in {BOT_INDEX_FILE} does not match the database. Rebuilding.")
+    except (OSError, json.JSONDecodeError) as e:
+        logger.info(f"Bot index not usable ({e}). Rebuilding from database.")
+    index = build_bot_index(data)
+    with bot_index_lock:
+        bot_index = index
+    save_bot_index()
+
+# Index a newly registered bot stored at bots[slot] of its owner
+def index_bot(owner_id, slot, bot_entry):
+    key = bot_index_key(bot_entry["bot_username"])
+    fingerprint = bot_entry_fingerprint(bot_entry)
+    with bot_index_lock:
+        bot_index["bots"][key] = {"owner": str(owner_id), "slot": slot, "bot_username": bot_entry["bot_username"],
+                                  "status": bot_entry.get("status", "Unknown"), "token_fingerprint": fingerprint}
+        if fingerprint:
+            bot_index["tokens"].setdefault(fingerprint, key)
+
+def set_indexed_status(bot_username, status):
+    with bot_index_lock:
+        indexed = bot_index["bots"].get(bot_index_key(bot_username))
+        if not indexed:
+            return
+        old_status, indexed["status"] = indexed["status"], status
+    count_bot_status(old_status, status)
+
+def lookup_bot(bot_username):
+    with bot_index_lock:
+        indexed = bot_index["bots"].get(bot_index_key(bot_username))
+    return dict(indexed) if indexed else None
+
+# Returns the index entry of a bot already registered with this token or username, or None
+def find_registered_bot(token, bot_username):
+    with bot_index_lock:
+        key = bot_index["tokens"].get(token_fingerprint(token)) or bot_index_key(bot_username)
+        indexed = bot_index["bots"].get(key)
+    return dict(indexed) if indexed else None
+
+# Returns the bot's record inside `database`, or None if it isn't registered (to owner_id, when given)
+def get_indexed_bot(database, bot_username, owner_id=None):
+    indexed = lookup_bot(bot_username)
+    if not indexed or (owner_id is not None and indexed["owner"] != str(owner_id)):
+        return None
+    user_bots = database.get("users", {}).get(indexed["owner"], {}).get("bots", [])
+    slot = indexed["slot"]
+    if slot < len(user_bots) and user_bots[slot].get("bot_username") == indexed["bot_username"]:
+        return user_bots[slot]
+    # Database changed behind the index's back; fall back to a scan of the owner's bots
+    return next((b for b in user_bots if b.get("bot_username") == indexed["bot_username"]), None)
+
+# Removes the bot from `database` (the caller saves it) and from the index; returns True if it was there
+def remove_indexed_bot(database, bot_username, owner_id=None):
+    bot_entry = get_indexed_bot(database, bot_username, owner_id)
+    if bot_entry is None:
+        return False
+    owner = lookup_bot(bot_username)["owner"]
+    user_bots = database["users"][owner]["bots"]
+    slot = next(i for i, b in enumerate(user_bots) if b is bot_entry)
+    del user_bots[slot]
+    count_bot_status(bot_entry.get("status", "Unknown"), None)
+    with bot_index_lock:
+        indexed = bot_index["bots"].pop(bot_index_key(bot_username), None)
+        if indexed and bot_index["tokens"].get(indexed.get("token_fingerprint")) == bot_index_key(bot_username):
+            del bot_index["tokens"][indexed["token_fingerprint"]]
+        # The owner's later bots moved up one slot
+        for later_slot in range(slot, len(user_bots)):
+            later = bot_index["bots"].get(bot_index_key(user_bots[later_slot].get("bot_username", "")))
+            if later and later["owner"] == owner:
+                later["slot"] = later_slot
+    return True
+
+refresh_registry_stats(load_database())
+load_bot_index()
+atexit.register(save_bot_index)
+
+# Per-user wizard state with idle expiry and a size cap. It behaves like the plain dicts it replaced,
+# and every access counts as activity (values are mutated in place after a get()), so it also marks
+# the store dirty for the next snapshot.
+class ConversationStore:
+    def __init__(self, ttl, maxsize, on_evict=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.entries = OrderedDict()  # key -> [value, last_used (wall clock, so it survives restarts)]
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def _touch(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            now = time.time()
+            self.dirty = True
+            if now - entry[1] <= self.ttl:
+                entry[1] = now
+                self.entries.move_to_end(key)
+                return entry
+            del self.entries[key]
+        if self.on_evict:
+            self.on_evict(key)
+        return None
+
+    def __contains__(self, key):
+        return self._touch(key) is not None
+
+    def __getitem__(self, key):
+        entry = self._touch(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[0]
+
+    def get(self, key, default=None):
+        entry = self._touch(key)
+        return default if entry is None else entry[0]
+
+    def __setitem__(self, key, value):
+        evicted = []
+        with self.lock:
+            self.entries[key] = [value, time.time()]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                evicted.append(self.entries.popitem(last=False)[0])
+            self.dirty = True
+        for evicted_key in evicted:
+            logger.info(f"Conversation store full; dropped wizard state of user {evicted_key}.")
+            if self.on_evict:
+                self.on_evict(evicted_key)
+
+    # Values are replaced, never mutated in place: this stores a copy of the value with `changes`
+    # applied and the keys in `remove` dropped, so snapshot() never sees a half-made change
+    def update(self, key, changes, remove=()):
+        entry = self._touch(key)
+        if entry is None:
+            raise KeyError(key)
+        value = {k: v for k, v in entry[0].items() if k not in remove}
+        value.update(changes)
+        with self.lock:
+            entry[0] = value
+            self.dirty = True
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.dirty = True
+        return default if entry is None else entry[0]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    # Drops every entry idle for longer than the TTL; returns how many were dropped
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            expired = [key for key, entry in self.entries.items() if entry[1] < cutoff]
+            for key in expired:
+                del self.entries[key]
+            if expired:
+                self.dirty = True
+        if self.on_evict:
+            for key in expired:
+                self.on_evict(key)
+        return len(expired)
+
+    # Values are never mutated once stored (see update()), so a shallow copy taken under the lock
+    # can be serialized while handlers keep going
+    def snapshot(self):
+        with self.lock:
+            entries = {key: [value, last_used] for key, (value, last_used) in self.entries.items()}
+            self.dirty = False
+        return entries
+
+    def restore(self, entries):
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            for key, (value, last_used) in sorted(entries.items(), key=lambda item: item[1][1]):
+                if last_used >= cutoff:
+                    self.entries[key] = [value, last_used]
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+# A wizard's state and its collected answers expire and are evicted together, whichever goes first,
+# so a live state never outlives its data
+user_data = ConversationStore(CONVERSATION_TTL, CONVERSATION_MAX_USERS, on_evict=lambda key: user_states.pop(key, None))
+user_states = ConversationStore(CONVERSATION_TTL, CONVERSATION_MAX_USERS, on_evict=lambda key: user_data.pop(key, None))
+conversations_save_lock = threading.Lock()
+
+def save_conversations(force=False):
+    if not CONVERSATION_FILE or not (force or user_states.dirty or user_data.dirty):
+        return
+    with conversations_save_lock:
+        snapshot = {"user_states": user_states.snapshot(), "user_data": user_data.snapshot()}
+        try:
+            tmp_path = CONVERSATION_FILE + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, CONVERSATION_FILE)
+        except Exception as e:
+            user_states.dirty = user_data.dirty = True
+            logger.error(f"Failed to save conversation snapshot '{CONVERSATION_FILE}': {e}", exc_info=True)
+
+def load_conversations():
+    if not CONVERSATION_FILE or not os.path.exists(CONVERSATION_FILE):
+        return
+    try:
+        with open(CONVERSATION_FILE, "r") as f:
+            snapshot = json.load(f)
+        user_states.restore(snapshot.get("user_states", {}))
+        user_data.restore(snapshot.get("user_data", {}))
+        logger.info(f"Restored {len(user_states)} in-progress bot creation wizard(s) from {CONVERSATION_FILE}.")
+    except Exception as e:
+        logger.error(f"Failed to restore conversations from '{CONVERSATION_FILE}': {e}", exc_info=True)
+
+def conversation_maintenance_loop():
+    while True:
+        time.sleep(CONVERSATION_SNAPSHOT_INTERVAL)
+        try:
+            expired = user_states.sweep() + user_data.sweep()
+            if expired:
+                logger.info(f"Dropped {expired} idle conversation entr{'y' if expired == 1 else 'ies'}.")
+            save_conversations()
+        except Exception as e:
+            logger.error(f"Conversation maintenance failed: {e}", exc_info=True)
+
+load_conversations()
+threading.Thread(target=conversation_maintenance_loop, name="conversation-maintenance", daemon=True).start()
+atexit.register(save_conversations)
+
 BOT_TEMPLATES = ["💵 NAIRA BOT"]
 broadcast_temp_data = {}
 
-def validate_bot_token(token):
+class TTLCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if entry[1] <= time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+def fetch_bot_info(token):
     api_url = f"https://api.telegram.org/bot{token}/getMe"
     try:
-        response = requests.get(api_url, timeout=10)
+        response = http_session.get(api_url, timeout=(HTTP_CONNECT_TIMEOUT, 10))
         response.raise_for_status()
         if response.status_code == 200:
             bot_info = response.json()
             if bot_info.get("ok"):
                 logger.info(f"Token validation successful for bot: {bot_info['result']['username']}")
-                return True, bot_info["result"]
+                return True, bot_info["result"], True
             else:
                 logger.warning(f"Token validation failed. API response not OK: {response.text}")
-                return False, None
+                return False, None, True
     except requests.exceptions.Timeout:
-        logger.error(f"Request timeout during token validation ({api_url}).")
-        return False, None
-    except requests.exceptions.HTTPError as http_err:
-        logger.error(f"HTTP error occurred during token validation: {http_err} - Response: {response.text}")
-        return False, None
+        logger.error("Request timeout during token validation.")
+        return False, None, False
+    except requests.exceptions.HTTPError:
+        # The HTTPError message carries the request URL, and with it the raw token, so it is never logged
+        try:
+            description = response.json().get("description")
+        except ValueError:
+            description = None
+        logger.error(f"HTTP error occurred during token validation: status {response.status_code} - {description}")
+        # 401/404 mean Telegram rejected the token itself; anything else may succeed on the next try
+        return False, None, response.status_code in (401, 404)
     except requests.exceptions.RequestException as req_err:
-        logger.error(f"Request error during token validation: {req_err}")
-        return False, None
+        logger.error(f"Request error during token validation: {type(req_err).__name__}")
+        return False, None, False
     except Exception as e:
         logger.error(f"An unexpected error occurred during token validation: {e}", exc_info=True)
-        return False, None
+        return False, None, False
+    return False, None, False
+
+# getMe results keyed by a SHA-256 of the token, so raw tokens are never kept as cache keys.
+# Concurrent validations of the same token wait for the one request already in flight.
+token_validation_cache = TTLCache(TOKEN_CACHE_SIZE)
+token_validations_in_flight = {}
+token_validations_lock = threading.Lock()
+
+def validate_bot_token(token):
+    token_key = token_fingerprint(token)
+    cached = token_validation_cache.get(token_key)
+    if cached is not None:
+        logger.debug(f"Token validation served from cache (valid={cached[0]}).")
+        return cached
+
+    with token_validations_lock:
+        in_flight = token_validations_in_flight.get(token_key)
+        if in_flight is None:
+            in_flight = {"done": threading.Event(), "result": (False, None)}
+            token_validations_in_flight[token_key] = in_flight
+            is_leader = True
+        else:
+            is_leader = False
+
+    if not is_leader:
+        in_flight["done"].wait(timeout=HTTP_CONNECT_TIMEOUT + 15)
+        return in_flight["result"]
+
+    try:
+        is_valid, bot_info, cacheable = fetch_bot_info(token)
+        result = (is_valid, bot_info)
+        if cacheable:
+            token_validation_cache.set(token_key, result, TOKEN_VALID_TTL if is_valid else TOKEN_INVALID_TTL)
+        in_flight["result"] = result
+        return result
+    finally:
+        with token_validations_lock:
+            token_validations_in_flight.pop(token_key, None)
+        in_flight["done"].set()
 
 def join_channel_keyboard():
     markup = InlineKeyboardMarkup()
@@ -101,11 +681,21 @@ def main_menu_keyboard():
     markup.row(InlineKeyboardButton("👤 My account", callback_data="my_account"))
     return markup
 
-def check_membership(user_id):
+membership_cache = TTLCache(MEMBERSHIP_CACHE_SIZE)
+
+def check_membership(user_id, recheck_negative=False):
+    cache_key = (CHANNEL_USERNAME, str(user_id))
+    cached = membership_cache.get(cache_key)
+    if cached is not None:
+        if cached or not recheck_negative:
+            return cached
+        membership_cache.invalidate(cache_key)
     try:
         member = bot.get_chat_member(chat_id=f"@{CHANNEL_USERNAME}", user_id=user_id)
         logger.debug(f"Membership check for user {user_id} in @{CHANNEL_USERNAME}: Status={member.status}")
-        return member.status in ['member', 'administrator', 'creator']
+        is_member = member.status in ['member', 'administrator', 'creator']
+        membership_cache.set(cache_key, is_member, MEMBERSHIP_TTL if is_member else MEMBERSHIP_NEGATIVE_TTL)
+        return is_member
     except Exception as e:
         logger.error(f"Could not check membership for user {user_id} in @{CHANNEL_USERNAME}: {e}", exc_info=False)
         if "user not found" in str(e).lower():
@@ -117,24 +707,26 @@ def check_membership(user_id):
 def send_welcome_message(chat_id, user_id, username, first_name):
     user_id_str = str(user_id)
     try:
-        database = load_database()
-        if user_id_str not in database["users"]:
-            logger.info(f"New user detected: {first_name} (@{username}, ID: {user_id_str}). Registering.")
-            database["users"][user_id_str] = {
-                "username": username if username else "Unknown",
-                "first_name": first_name if first_name else "Unknown",
-                "registration_date": time.strftime("%Y-%m-%d %H:%M:%S"),
-                "bots": []
-            }
-            save_database(database)
-        else:
-            # Update username/first_name if changed
-            if database["users"][user_id_str].get("username") != (username if username else "Unknown") or \
-               database["users"][user_id_str].get("first_name") != (first_name if first_name else "Unknown"):
-                 logger.info(f"Updating user info for {user_id_str}.")
-                 database["users"][user_id_str]["username"] = username if username else "Unknown"
-                 database["users"][user_id_str]["first_name"] = first_name if first_name else "Unknown"
-                 save_database(database)
+        with database_lock:
+            database = load_database()
+            if user_id_str not in database["users"]:
+                logger.info(f"New user detected: {first_name} (@{username}, ID: {user_id_str}). Registering.")
+                database["users"][user_id_str] = {
+                    "username": username if username else "Unknown",
+                    "first_name": first_name if first_name else "Unknown",
+                    "registration_date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "bots": []
+                }
+                save_database(database)
+                count_new_user()
+            else:
+                # Update username/first_name if changed
+                if database["users"][user_id_str].get("username") != (username if username else "Unknown") or \
+                   database["users"][user_id_str].get("first_name") != (first_name if first_name else "Unknown"):
+                     logger.info(f"Updating user info for {user_id_str}.")
+                     database["users"][user_id_str]["username"] = username if username else "Unknown"
+                     database["users"][user_id_str]["first_name"] = first_name if first_name else "Unknown"
+                     save_database(database)
 
         welcome_msg = f"✅ Welcome back to BotMaker, @{username if username else first_name}!\n\n"
         welcome_msg += "I can help you create and manage your Telegram bots without coding.\n\n"
@@ -148,15 +740,24 @@ def send_welcome_message(chat_id, user_id, username, first_name):
         except Exception as send_error:
              logger.error(f"Failed even to send error message to chat {chat_id}: {send_error}", exc_info=True)
 
+# username (lowercase) -> {"type", "id", "title"} of the resolved chat, or False if it can't be used
+chat_info_cache = TTLCache(CHAT_INFO_CACHE_SIZE)
+
 def get_chat_info_from_link(link):
     match_username = re.match(r"^https?://t\.me/([a-zA-Z0-9_]{5,32})$", link)
     if match_username:
         identifier = f"@{match_username.group(1)}"
+        cache_key = match_username.group(1).lower()
+        cached = chat_info_cache.get(cache_key)
+        if cached is not None:
+            return (cached["type"], identifier) if cached else (None, None)
         try:
             chat = bot.get_chat(identifier)
             if chat.type == 'private' and hasattr(chat, 'username') and chat.username and chat.username.lower().endswith('bot'):
                  logger.warning(f"Link {link} points to a bot ({identifier}), not suitable as a channel/group for must_join.")
+                 chat_info_cache.set(cache_key, False, CHAT_INFO_NEGATIVE_TTL)
                  return None, None
+            chat_info_cache.set(cache_key, {"type": chat.type, "id": chat.id, "title": chat.title}, CHAT_INFO_TTL)
             return chat.type, identifier
         except Exception as e:
             # Log less verbosely if it's a common "chat not found" for non-existent usernames
@@ -164,6 +765,7 @@ def get_chat_info_from_link(link):
                 logger.warning(f"Could not get chat info for {identifier} from link {link}: {e}")
             else:
                 logger.debug(f"Chat info not found for {identifier} (likely not a public channel/group with this username): {e}")
+                chat_info_cache.set(cache_key, False, CHAT_INFO_NEGATIVE_TTL)
             return None, None
     return None, None
 
@@ -188,25 +790,70 @@ def start(message):
             logger.error(f"Failed to send join request message to user {user_id}: {e}", exc_info=True)
 
 
-@bot.callback_query_handler(func=lambda call: True)
-def callback_handler(call):
+# Table-driven dispatch for inline button callbacks: exact keys and "prefix:" keys are looked
+# up in dicts so routing is O(1), and the time spent in each route is recorded for /stats
+class CallbackRouter:
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    # Decorator registering a handler; a key ending in ':' matches every callback with that prefix
+    def route(self, key):
+        def decorator(func):
+            if key.endswith(":"):
+                self.prefixes[key[:-1]] = func
+            else:
+                self.exact[key] = func
+            return func
+        return decorator
+
+    # Returns (route_name, handler) for callback data, or (None, None) if nothing is registered
+    def resolve(self, data):
+        handler = self.exact.get(data)
+        if handler:
+            return data, handler
+        prefix, sep, _ = data.partition(":")
+        if sep and prefix in self.prefixes:
+            return prefix + ":", self.prefixes[prefix]
+        return None, None
+
+    def record(self, route, elapsed):
+        with self.lock:
+            entry = self.timings.setdefault(route, {"count": 0, "total": 0.0, "max": 0.0})
+            entry["count"] += 1
+            entry["total"] += elapsed
+            entry["max"] = max(entry["max"], elapsed)
+
+    # Per-route timings, slowest total first
+    def timing_stats(self):
+        with self.lock:
+            stats = [dict(route=route, **entry) for route, entry in self.timings.items()]
+        return sorted(stats, key=lambda entry: entry["total"], reverse=True)
+
+
+callback_router = CallbackRouter()
+
+
+@callback_router.route("check_subscription")
+def callback_check_subscription(call):
     user_id = call.from_user.id
     user_id_str = str(user_id)
     username = call.from_user.username
     first_name = call.from_user.first_name
-    logger.info(f"Received callback '{call.data}' from user {first_name or 'N/A'} (@{username or 'N/A'}, ID: {user_id})")
-
-    if call.data == "check_subscription":
-        try:
-            bot.answer_callback_query(call.id)
-            if check_membership(user_id):
-                logger.info(f"User {user_id} passed subscription check via callback. Sending welcome.")
-                try:
-                    welcome_msg = f"✅ Welcome to BotMaker, @{username if username else first_name}!\n\n"
-                    welcome_msg += "Thank you for joining the channel.\n\n"
-                    welcome_msg += "I can help you create and manage your Telegram bots without coding.\n\n"
-                    welcome_msg += "Please select an option from the menu below:"
-                    bot.edit_message_text(welcome_msg, call.message.chat.id, call.message.message_id, reply_markup=main_menu_keyboard(), parse_mode="HTML")
+    try:
+        bot.answer_callback_query(call.id)
+        # The user says they have just joined, so don't trust a cached "not a member"
+        if check_membership(user_id, recheck_negative=True):
+            logger.info(f"User {user_id} passed subscription check via callback. Sending welcome.")
+            try:
+                welcome_msg = f"✅ Welcome to BotMaker, @{username if username else first_name}!\n\n"
+                welcome_msg += "Thank you for joining the channel.\n\n"
+                welcome_msg += "I can help you create and manage your Telegram bots without coding.\n\n"
+                welcome_msg += "Please select an option from the menu below:"
+                bot.edit_message_text(welcome_msg, call.message.chat.id, call.message.message_id, reply_markup=main_menu_keyboard(), parse_mode="HTML")
+                with database_lock:
                     database = load_database()
                     if user_id_str not in database["users"]:
                          logger.info(f"New user detected post-subscription: {first_name or 'N/A'} (@{username or 'N/A'}, ID: {user_id_str}). Registering.")
@@ -217,534 +864,570 @@ def callback_handler(call):
                              "bots": []
                          }
                          save_database(database)
-                except Exception as edit_err:
-                    logger.warning(f"Failed to edit message for user {user_id} after subscription check: {edit_err}. Sending new welcome message.", exc_info=False)
-                    send_welcome_message(call.message.chat.id, user_id, username, first_name)
-            else:
-                logger.info(f"User {user_id} clicked continue but is still not subscribed to @{CHANNEL_USERNAME}.")
-                bot.answer_callback_query(call.id, f"⚠️ Please join the channel @{CHANNEL_USERNAME} first!", show_alert=True)
-        except Exception as e:
-            logger.error(f"Error handling 'check_subscription' callback for user {user_id}: {e}", exc_info=True)
-            try:
-                bot.answer_callback_query(call.id, "An error occurred. Please try again.", show_alert=True)
-            except Exception: pass
-        return
+                         count_new_user()
+            except Exception as edit_err:
+                logger.warning(f"Failed to edit message for user {user_id} after subscription check: {edit_err}. Sending new welcome message.", exc_info=False)
+                send_welcome_message(call.message.chat.id, user_id, username, first_name)
+        else:
+            logger.info(f"User {user_id} clicked continue but is still not subscribed to @{CHANNEL_USERNAME}.")
+            bot.answer_callback_query(call.id, f"⚠️ Please join the channel @{CHANNEL_USERNAME} first!", show_alert=True)
+    except Exception as e:
+        logger.error(f"Error handling 'check_subscription' callback for user {user_id}: {e}", exc_info=True)
+        try:
+            bot.answer_callback_query(call.id, "An error occurred. Please try again.", show_alert=True)
+        except Exception: pass
 
-    elif call.data == "show_admin_instructions":
-        bot.answer_callback_query(call.id)
-        instructions = (
-            "<b>How to make your new bot an Administrator:</b>\n\n"
-            "1. Open the Telegram Channel/Group where the bot needs admin rights.\n"
-            "2. Go to Channel/Group Info.\n"
-            "3. Tap on 'Administrators' (or 'Edit' then 'Administrators').\n"
-            "4. Tap 'Add Admin'.\n"
-            "5. Search for your new bot's username (e.g., <code>@YourNewBot_bot</code> that you are creating).\n"
-            "6. Select your bot.\n"
-            "7. Grant necessary permissions (e.g., 'Post messages' for payment channels; for mandatory join checks, the bot needs to be able to see members, which is usually default for admins).\n"
-            "8. Save the changes.\n\n"
-            "Once done, you can proceed with the setup here."
-        )
-        original_markup = call.message.reply_markup
-        preserved_markup = None
-        if original_markup:
-            for row in original_markup.keyboard:
-                for button in row:
-                    if button.callback_data in ["payment_channel_admin_done", "must_join_admin_done"]:
-                        preserved_markup = original_markup
-                        break
-                if preserved_markup:
+
+@callback_router.route("show_admin_instructions")
+def callback_show_admin_instructions(call):
+    bot.answer_callback_query(call.id)
+    instructions = (
+        "<b>How to make your new bot an Administrator:</b>\n\n"
+        "1. Open the Telegram Channel/Group where the bot needs admin rights.\n"
+        "2. Go to Channel/Group Info.\n"
+        "3. Tap on 'Administrators' (or 'Edit' then 'Administrators').\n"
+        "4. Tap 'Add Admin'.\n"
+        "5. Search for your new bot's username (e.g., <code>@YourNewBot_bot</code> that you are creating).\n"
+        "6. Select your bot.\n"
+        "7. Grant necessary permissions (e.g., 'Post messages' for payment channels; for mandatory join checks, the bot needs to be able to see members, which is usually default for admins).\n"
+        "8. Save the changes.\n\n"
+        "Once done, you can proceed with the setup here."
+    )
+    original_markup = call.message.reply_markup
+    preserved_markup = None
+    if original_markup:
+        for row in original_markup.keyboard:
+            for button in row:
+                if button.callback_data in ["payment_channel_admin_done", "must_join_admin_done"]:
+                    preserved_markup = original_markup
                     break
-        bot.send_message(call.message.chat.id, instructions, parse_mode="HTML", reply_markup=preserved_markup)
-        return
+            if preserved_markup:
+                break
+    bot.send_message(call.message.chat.id, instructions, parse_mode="HTML", reply_markup=preserved_markup)
 
-    elif call.data == "confirm_broadcast":
-        if str(call.from_user.id) != str(ADMIN_ID):
-            bot.answer_callback_query(call.id, "⛔ Unauthorized!", show_alert=True)
-            logger.warning(f"Unauthorized broadcast confirmation by {user_id_str}")
-            return
-        data = broadcast_temp_data.get(str(ADMIN_ID))
-        if not data:
-            bot.answer_callback_query(call.id, "Error: No broadcast data found. Please start over with /broadcast.", show_alert=True)
-            try:
-                bot.edit_message_text("Broadcast data lost or expired. Please use /broadcast again.", call.message.chat.id, call.message.message_id)
-            except Exception: pass
-            return
-        bot.answer_callback_query(call.id, "Commencing broadcast...")
-        try:
-            bot.edit_message_text("🚀 Initiating broadcast to all users. This may take some time...", call.message.chat.id, call.message.message_id, parse_mode="HTML")
-        except Exception: pass
-        send_broadcast_messages(ADMIN_ID, data["text"], data["photo_id"], data["video_id"], data["parse_mode"])
-        broadcast_temp_data.pop(str(ADMIN_ID), None)
-        return
 
-    elif call.data == "cancel_broadcast":
-        if str(call.from_user.id) != str(ADMIN_ID):
-            bot.answer_callback_query(call.id, "⛔ Unauthorized!", show_alert=True)
-            logger.warning(f"Unauthorized broadcast cancellation by {user_id_str}")
-            return
-        bot.answer_callback_query(call.id, "Broadcast cancelled.")
+@callback_router.route("confirm_broadcast")
+def callback_confirm_broadcast(call):
+    user_id_str = str(call.from_user.id)
+    if str(call.from_user.id) != str(ADMIN_ID):
+        bot.answer_callback_query(call.id, "⛔ Unauthorized!", show_alert=True)
+        logger.warning(f"Unauthorized broadcast confirmation by {user_id_str}")
+        return
+    data = broadcast_temp_data.get(str(ADMIN_ID))
+    if not data:
+        bot.answer_callback_query(call.id, "Error: No broadcast data found. Please start over with /broadcast.", show_alert=True)
         try:
-            bot.edit_message_text("✅ Broadcast has been cancelled by Admin.", call.message.chat.id, call.message.message_id, parse_mode="HTML")
+            bot.edit_message_text("Broadcast data lost or expired. Please use /broadcast again.", call.message.chat.id, call.message.message_id)
         except Exception: pass
-        broadcast_temp_data.pop(str(ADMIN_ID), None)
-        logger.info(f"Admin {ADMIN_ID} cancelled broadcast.")
         return
-
-    if call.data == "payment_channel_admin_done":
-        bot.answer_callback_query(call.id)
-        if user_states.get(user_id_str) == "awaiting_payment_channel_admin_confirm":
-            logger.info(f"User {user_id_str} confirmed adminship for payment channel. Proceeding.")
-            user_states[user_id_str] = "awaiting_must_join_channels"
-            msg = "🔗 Payment channel noted.\n\n"
-            msg += "Now, let's add <b>Must Join Channels/Links</b>.\n\n"
-            msg += "Send me the link (e.g., <code>https://t.me/MyUpdateChannel</code> or <code>https://example.com</code>) for each you want users to join.\n\n"
-            msg += "If it's a public Telegram Channel, I'll ask if it's mandatory. For mandatory checks to work, your new bot must be an <b>admin</b> there.\n"
-            msg += "For Telegram Groups or any non-Telegram web links, they'll be added directly without a mandatory check or admin prompt.\n\n"
-            msg += "When you have added all, type <code>/done</code>."
-            bot.edit_message_text(msg, call.message.chat.id, call.message.message_id, parse_mode="HTML")
-        else:
-            bot.send_message(call.message.chat.id, "Please follow the current step in the bot creation process.", reply_markup=main_menu_keyboard())
+    bot.answer_callback_query(call.id, "Commencing broadcast...")
+    try:
+        bot.edit_message_text("🚀 Broadcast to all users is running in the background. Progress updates will follow.", call.message.chat.id, call.message.message_id, parse_mode="HTML")
+    except Exception: pass
+    send_broadcast_messages(ADMIN_ID, data["text"], data["photo_id"], data["video_id"], data["parse_mode"])
+    broadcast_temp_data.pop(str(ADMIN_ID), None)
+
+
+@callback_router.route("cancel_broadcast")
+def callback_cancel_broadcast(call):
+    user_id_str = str(call.from_user.id)
+    if str(call.from_user.id) != str(ADMIN_ID):
+        bot.answer_callback_query(call.id, "⛔ Unauthorized!", show_alert=True)
+        logger.warning(f"Unauthorized broadcast cancellation by {user_id_str}")
         return
+    bot.answer_callback_query(call.id, "Broadcast cancelled.")
+    try:
+        bot.edit_message_text("✅ Broadcast has been cancelled by Admin.", call.message.chat.id, call.message.message_id, parse_mode="HTML")
+    except Exception: pass
+    broadcast_temp_data.pop(str(ADMIN_ID), None)
+    logger.info(f"Admin {ADMIN_ID} cancelled broadcast.")
+
+
+@callback_router.route("payment_channel_admin_done")
+def callback_payment_channel_admin_done(call):
+    user_id_str = str(call.from_user.id)
+    bot.answer_callback_query(call.id)
+    if user_states.get(user_id_str) == "awaiting_payment_channel_admin_confirm":
+        logger.info(f"User {user_id_str} confirmed adminship for payment channel. Proceeding.")
+        user_states[user_id_str] = "awaiting_must_join_channels"
+        msg = "🔗 Payment channel noted.\n\n"
+        msg += "Now, let's add <b>Must Join Channels/Links</b>.\n\n"
+        msg += "Send me the link (e.g., <code>https://t.me/MyUpdateChannel</code> or <code>https://example.com</code>) for each you want users to join.\n\n"
+        msg += "If it's a public Telegram Channel, I'll ask if it's mandatory. For mandatory checks to work, your new bot must be an <b>admin</b> there.\n"
+        msg += "For Telegram Groups or any non-Telegram web links, they'll be added directly without a mandatory check or admin prompt.\n\n"
+        msg += "When you have added all, type <code>/done</code>."
+        bot.edit_message_text(msg, call.message.chat.id, call.message.message_id, parse_mode="HTML")
+    else:
+        bot.send_message(call.message.chat.id, "Please follow the current step in the bot creation process.", reply_markup=main_menu_keyboard())
+
+
+@callback_router.route("must_join_admin_done")
+def callback_must_join_admin_done(call):
+    user_id_str = str(call.from_user.id)
+    bot.answer_callback_query(call.id)
+    current_user_state = user_states.get(user_id_str)
+    if current_user_state == "awaiting_must_join_public_channel_admin_confirm" and \
+       "pending_channel_for_admin_check" in user_data.get(user_id_str, {}):
+        logger.info(f"User {user_id_str} confirmed adminship for a public must-join channel. Proceeding to ask mandatory.")
+        channel_data = user_data[user_id_str]["pending_channel_for_admin_check"]
+        user_data.update(user_id_str, {"current_channel": channel_data}, remove=("pending_channel_for_admin_check",))
+        user_states[user_id_str] = "awaiting_must_join_mandatory_choice"
+        logger.info(f"User {user_id_str} state changed to 'awaiting_must_join_mandatory_choice' for channel {channel_data['url']}")
+        markup = InlineKeyboardMarkup()
+        markup.row(
+             InlineKeyboardButton("✅ Yes (Mandatory)", callback_data="must_join_yes"),
+             InlineKeyboardButton("❌ No (Optional)", callback_data="must_join_no")
+        )
+        bot.edit_message_text(f"Okay, for Public Channel: {html.escape(channel_data['url'])}\n\n"
+                              f"❓ <b>Should joining this be MANDATORY for users?</b>\n"
+                              f"<i>(Remember: This only works effectively if your new bot is an admin there!)</i>",
+                              call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
+    else:
+        logger.warning(f"User {user_id_str} clicked 'must_join_admin_done' in unexpected state: {current_user_state} or missing data.")
+        bot.send_message(call.message.chat.id, "There was an issue. Please send the channel link again or type /done.", parse_mode="HTML")
+
+
+@callback_router.route("must_join_yes")
+@callback_router.route("must_join_no")
+def callback_must_join_choice(call):
+    user_id_str = str(call.from_user.id)
+    bot.answer_callback_query(call.id)
+    current_user_state = user_states.get(user_id_str)
+    if current_user_state == "awaiting_must_join_mandatory_choice" and \
+       user_id_str in user_data and "current_channel" in user_data[user_id_str]:
+        wizard_data = user_data[user_id_str]
+        channel_data = dict(wizard_data["current_channel"])
+        is_mandatory_option_relevant = channel_data.get("is_public_channel", False) # Should be True here
+        channel_data["check"] = (call.data == "must_join_yes") if is_mandatory_option_relevant else False
+        channel_data["name"] = f"Channel {len(wizard_data.get('must_join_channels', [])) + 1}"
+        user_data.update(user_id_str, {"must_join_channels": wizard_data.get("must_join_channels", []) + [channel_data]},
+                         remove=("current_channel",))
+        user_states[user_id_str] = "awaiting_must_join_channels" # CRITICAL FIX
+        logger.info(f"User {user_id_str} state set to 'awaiting_must_join_channels' after mandatory choice for {channel_data['url']}.")
+        mandatory_text = f"\nIt will{' ' if channel_data['check'] else ' <b>NOT</b> '}be a MANDATORY join." if is_mandatory_option_relevant else ""
+        bot.edit_message_text(
+            f"Link added: {html.escape(channel_data['url'])}{mandatory_text}\n\nPlease send another channel/group/web link, or type <code>/done</code> to continue.",
+            call.message.chat.id, call.message.message_id, parse_mode="HTML"
+        )
+        logger.info(f"User {user_id_str} processed must-join: {channel_data['url']} (Mandatory: {channel_data['check'] if is_mandatory_option_relevant else 'N/A'})")
+    else:
+        logger.warning(f"Received '{call.data}' callback from user {user_id_str} in unexpected state: {current_user_state} or 'current_channel' data missing.")
+        bot.answer_callback_query(call.id, "Session expired or invalid action. Please send the link again.", show_alert=True)
 
-    if call.data == "must_join_admin_done":
-        bot.answer_callback_query(call.id)
-        current_user_state = user_states.get(user_id_str)
-        if current_user_state == "awaiting_must_join_public_channel_admin_confirm" and \
-           "pending_channel_for_admin_check" in user_data.get(user_id_str, {}):
-            logger.info(f"User {user_id_str} confirmed adminship for a public must-join channel. Proceeding to ask mandatory.")
-            user_data[user_id_str]["current_channel"] = user_data[user_id_str].pop("pending_channel_for_admin_check")
-            channel_data = user_data[user_id_str]["current_channel"]
-            user_states[user_id_str] = "awaiting_must_join_mandatory_choice"
-            logger.info(f"User {user_id_str} state changed to 'awaiting_must_join_mandatory_choice' for channel {channel_data['url']}")
-            markup = InlineKeyboardMarkup()
-            markup.row(
-                 InlineKeyboardButton("✅ Yes (Mandatory)", callback_data="must_join_yes"),
-                 InlineKeyboardButton("❌ No (Optional)", callback_data="must_join_no")
-            )
-            bot.edit_message_text(f"Okay, for Public Channel: {html.escape(channel_data['url'])}\n\n"
-                                  f"❓ <b>Should joining this be MANDATORY for users?</b>\n"
-                                  f"<i>(Remember: This only works effectively if your new bot is an admin there!)</i>",
-                                  call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
-        else:
-            logger.warning(f"User {user_id_str} clicked 'must_join_admin_done' in unexpected state: {current_user_state} or missing data.")
-            bot.send_message(call.message.chat.id, "There was an issue. Please send the channel link again or type /done.", parse_mode="HTML")
-        return
 
-    if call.data in ["must_join_yes", "must_join_no"]:
-        bot.answer_callback_query(call.id)
-        current_user_state = user_states.get(user_id_str)
-        if current_user_state == "awaiting_must_join_mandatory_choice" and \
-           user_id_str in user_data and "current_channel" in user_data[user_id_str]:
-            channel_data = user_data[user_id_str]["current_channel"]
-            is_mandatory_option_relevant = channel_data.get("is_public_channel", False) # Should be True here
-            channel_data["check"] = (call.data == "must_join_yes") if is_mandatory_option_relevant else False
-            channel_data["name"] = f"Channel {len(user_data[user_id_str].get('must_join_channels', [])) + 1}"
-            if "must_join_channels" not in user_data[user_id_str]:
-                user_data[user_id_str]["must_join_channels"] = []
-            user_data[user_id_str]["must_join_channels"].append(channel_data)
-            user_data[user_id_str].pop("current_channel", None)
-            user_states[user_id_str] = "awaiting_must_join_channels" # CRITICAL FIX
-            logger.info(f"User {user_id_str} state set to 'awaiting_must_join_channels' after mandatory choice for {channel_data['url']}.")
-            mandatory_text = f"\nIt will{' ' if channel_data['check'] else ' <b>NOT</b> '}be a MANDATORY join." if is_mandatory_option_relevant else ""
-            bot.edit_message_text(
-                f"Link added: {html.escape(channel_data['url'])}{mandatory_text}\n\nPlease send another channel/group/web link, or type <code>/done</code> to continue.",
-                call.message.chat.id, call.message.message_id, parse_mode="HTML"
-            )
-            logger.info(f"User {user_id_str} processed must-join: {channel_data['url']} (Mandatory: {channel_data['check'] if is_mandatory_option_relevant else 'N/A'})")
-        else:
-            logger.warning(f"Received '{call.data}' callback from user {user_id_str} in unexpected state: {current_user_state} or 'current_channel' data missing.")
-            bot.answer_callback_query(call.id, "Session expired or invalid action. Please send the link again.", show_alert=True)
+@callback_router.route("create_bot")
+def callback_create_bot(call):
+    user_id_str = str(call.from_user.id)
+    bot.answer_callback_query(call.id)
+    database = load_database()
+    if user_id_str in database["users"] and len(database["users"][user_id_str].get("bots", [])) >= 10:
+        bot.send_message(call.message.chat.id, "⚠️ You have reached the maximum limit of <b>10 bots!</b>", parse_mode="HTML")
+        logger.info(f"User {user_id_str} tried to create bot but reached limit.")
         return
+    markup = InlineKeyboardMarkup()
+    for template in BOT_TEMPLATES:
+         safe_template_name = template.replace(":", "_")
+         markup.row(InlineKeyboardButton(template, callback_data=f"template:{safe_template_name}"))
+    markup.row(InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_main"))
+    bot.edit_message_text("Please select a bot template to start:", call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
+    logger.info(f"User {user_id_str} initiated bot creation. Showing templates.")
+
+
+@callback_router.route("template:")
+def callback_template(call):
+    user_id_str = str(call.from_user.id)
+    bot.answer_callback_query(call.id)
+    template_name = call.data.split(":", 1)[1]
+    original_template_name = template_name.replace("_", ":")
+    if original_template_name in BOT_TEMPLATES:
+         logger.info(f"User {user_id_str} selected template: {original_template_name}")
+         user_data[user_id_str] = {
+             "template": original_template_name,
+             "must_join_channels": []
+         }
+         user_states[user_id_str] = "awaiting_bot_token"
+         msg = "Great! Let's start configuring your bot.\n\n"
+         msg += "Please send me the <b>API token</b> for the bot you want to create.\n\n"
+         msg += "To get a token:\n"
+         msg += "1. Open a chat with @BotFather on Telegram.\n"
+         msg += "2. Send the <code>/newbot</code> command.\n"
+         msg += "3. Follow the instructions to choose a name and username.\n"
+         msg += "4. @BotFather will provide the API token. <b>Copy the token and paste it here.</b>"
+         markup = InlineKeyboardMarkup()
+         markup.row(InlineKeyboardButton("🔙 Cancel Creation", callback_data="back_to_main"))
+         bot.edit_message_text(msg, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
+    else:
+         logger.warning(f"User {user_id_str} selected an unknown template: {template_name}")
+         bot.edit_message_text("Invalid template selected. Please try again.", call.message.chat.id, call.message.message_id, reply_markup=main_menu_keyboard())
+
+
+@callback_router.route("my_bots")
+def callback_my_bots(call):
+    user_id_str = str(call.from_user.id)
+    bot.answer_callback_query(call.id)
+    database = load_database()
+    user_bots_list = database.get("users", {}).get(user_id_str, {}).get("bots", [])
+    logger.debug(f"My Bots for {user_id_str}: {user_bots_list}") # Log the raw list
+    if not user_bots_list:
+        markup = InlineKeyboardMarkup()
+        markup.row(InlineKeyboardButton("🤖 Create a bot", callback_data="create_bot"))
+        markup.row(InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_main"))
+        bot.edit_message_text("You haven't created any bots with me yet.\n\nWould you like to create one now?", call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
+        logger.info(f"User {user_id_str} viewed 'My Bots' but has none.")
+    else:
+         markup = InlineKeyboardMarkup(row_width=1)
+         for bot_entry in user_bots_list:
+             bot_name = bot_entry.get('bot_name', 'Unnamed Bot')
+             bot_username_cb = bot_entry.get('bot_username', 'Unknown Username') # Should be like @username_bot
+             bot_status = bot_entry.get('status', 'Unknown')
+             # Pass bot_username_cb directly as it includes '@' which is consistent with storage
+             markup.add(InlineKeyboardButton(f"{bot_name} (@{bot_username_cb.lstrip('@')}) - {bot_status}", callback_data=f"bot_info:{bot_username_cb}"))
+         markup.add(InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_main"))
+         bot.edit_message_text(f"Here are the bots you've created (Total: {len(user_bots_list)}):", call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
+         logger.info(f"User {user_id_str} viewed 'My Bots'. Displayed {len(user_bots_list)} bots.")
+
+
+@callback_router.route("bot_info:")
+def callback_bot_info(call):
+    user_id_str = str(call.from_user.id)
+    bot.answer_callback_query(call.id)
+    bot_username_to_find = call.data.split(":", 1)[1] # This will be like "@username_bot"
+    logger.info(f"User {user_id_str} trying to view bot info for: '{bot_username_to_find}'")
+    database = load_database()
+    bot_data_entry = get_indexed_bot(database, bot_username_to_find, user_id_str)
+
+    if bot_data_entry:
+        msg = f"🤖 <b>Bot Details</b>\n\n"
+        msg += f"<b>Name:</b> {html.escape(bot_data_entry.get('bot_name', 'N/A'))}\n"
+        msg += f"<b>Username:</b> {html.escape(bot_data_entry.get('bot_username', 'N/A'))}\n" # Show with @
+        msg += f"<b>Status:</b> {html.escape(bot_data_entry.get('status', 'Unknown'))}\n"
+        msg += f"<b>Requested:</b> {html.escape(bot_data_entry.get('creation_request_date', 'N/A'))}\n"
+        config_details_str = bot_data_entry.get('config_details', 'Configuration not available.')
+        max_config_len = 3000
+        truncated_config = config_details_str[:max_config_len] + ("..." if len(config_details_str) > max_config_len else "")
+        msg += f"\n<b>Configuration:</b>\n<pre><code class=\"language-python\">{html.escape(truncated_config)}</code></pre>\n"
+        markup = InlineKeyboardMarkup()
+        markup.row(InlineKeyboardButton("🛠️ Edit Bot (Recreates)", callback_data=f"edit_bot_warn:{bot_username_to_find}"))
+        markup.row(InlineKeyboardButton("🗑️ Delete Bot", callback_data=f"delete_bot:{bot_username_to_find}"))
+        markup.row(InlineKeyboardButton("🔙 Back to My Bots", callback_data="my_bots"))
+        bot.edit_message_text(msg, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
+        logger.info(f"User {user_id_str} viewed info for bot {bot_username_to_find}.")
+    else:
+         db_bot_usernames = [b.get('bot_username') for b in database.get("users", {}).get(user_id_str, {}).get("bots", [])]
+         logger.warning(f"User {user_id_str} tried to view info for bot {bot_username_to_find}, but it was NOT found in their list: {db_bot_usernames}")
+         bot.edit_message_text("Error: Could not find details for this bot.\n\nIt might have been deleted or there was an issue retrieving its data.", call.message.chat.id, call.message.message_id, reply_markup=main_menu_keyboard(), parse_mode="HTML")
+
+
+@callback_router.route("edit_bot_warn:")
+def callback_edit_bot_warn(call):
+    bot.answer_callback_query(call.id)
+    bot_username_to_edit = call.data.split(":", 1)[1] # Includes @
+    markup = InlineKeyboardMarkup()
+    markup.row(
+        InlineKeyboardButton("⚠️ Yes, Delete & Recreate", callback_data=f"confirm_edit_recreate:{bot_username_to_edit}"),
+        InlineKeyboardButton("❌ Cancel", callback_data=f"bot_info:{bot_username_to_edit}")
+    )
+    warn_msg = (f"<b>WARNING!</b> Editing bot <b>{html.escape(bot_username_to_edit)}</b> means its current settings and record will be <b>deleted</b> from My Bots.\n\n"
+                f"You will then be guided to create it again from scratch (you'll need its API token, etc.). This action cannot be undone.\n\n"
+                f"Are you sure you want to proceed?")
+    bot.edit_message_text(warn_msg, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
+
+
+@callback_router.route("confirm_edit_recreate:")
+def callback_confirm_edit_recreate(call):
+    user_id_str = str(call.from_user.id)
+    bot_username_to_delete_and_edit = call.data.split(":", 1)[1] # Includes @
+    logger.info(f"User {user_id_str} confirmed edit (delete & recreate) for bot {bot_username_to_delete_and_edit}.")
+    with database_lock:
+        database = load_database()
+        deleted_for_edit = remove_indexed_bot(database, bot_username_to_delete_and_edit, user_id_str)
+        if deleted_for_edit:
+            save_database(database)
+    if deleted_for_edit:
+        undeploy_bot(bot_username_to_delete_and_edit)
+        logger.info(f"Bot {bot_username_to_delete_and_edit} deleted for edit by user {user_id_str}.")
+    if deleted_for_edit:
+        bot.answer_callback_query(call.id, "Bot deleted. Starting recreation...")
+        create_markup = InlineKeyboardMarkup()
+        for template in BOT_TEMPLATES:
+            safe_template_name = template.replace(":", "_")
+            create_markup.row(InlineKeyboardButton(template, callback_data=f"template:{safe_template_name}"))
+        create_markup.row(InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_main"))
+        edit_msg = (f"Bot {html.escape(bot_username_to_delete_and_edit)} has been removed.\n\n"
+                    "Let's set up the new configuration. Please select a bot template to start:")
+        bot.edit_message_text(edit_msg, call.message.chat.id, call.message.message_id, reply_markup=create_markup, parse_mode="HTML")
+    else:
+        bot.answer_callback_query(call.id, "Error: Could not remove the bot for editing. It might have already been deleted.", show_alert=True)
+        logger.warning(f"Failed to find bot {bot_username_to_delete_and_edit} for deletion during edit process by user {user_id_str}.")
+        bot.edit_message_text("Could not find the bot to edit. Please check 'My Bots' again.", call.message.chat.id, call.message.message_id, reply_markup=main_menu_keyboard(), parse_mode="HTML")
 
-    # General callback processing starts after specific handlers
+
+@callback_router.route("delete_bot:")
+def callback_delete_bot(call):
+    user_id_str = str(call.from_user.id)
+    bot.answer_callback_query(call.id)
+    bot_username_to_delete = call.data.split(":", 1)[1] # Includes @
+    logger.warning(f"User {user_id_str} initiated deletion for bot {bot_username_to_delete}.")
+    markup = InlineKeyboardMarkup()
+    markup.row(
+        InlineKeyboardButton("✅ Yes, Delete", callback_data=f"confirm_delete:{bot_username_to_delete}"),
+        InlineKeyboardButton("❌ No, Cancel", callback_data=f"bot_info:{bot_username_to_delete}")
+     )
+    bot.edit_message_text(f"⚠️ <b>Are you sure you want to delete the bot {html.escape(bot_username_to_delete)}?</b>\n\nThis action cannot be undone and will remove its record from 'My Bots'.",
+                          call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
+
+
+@callback_router.route("confirm_delete:")
+def callback_confirm_delete(call):
+    user_id_str = str(call.from_user.id)
+    bot_username_to_delete = call.data.split(":", 1)[1] # Includes @
+    logger.info(f"User {user_id_str} confirmed deletion for bot {bot_username_to_delete}.")
+    with database_lock:
+        database = load_database()
+        deleted = remove_indexed_bot(database, bot_username_to_delete, user_id_str)
+        if deleted:
+            save_database(database)
+    if deleted:
+         undeploy_bot(bot_username_to_delete)
+         logger.info(f"Successfully deleted bot {bot_username_to_delete} for user {user_id_str}.")
+    markup = InlineKeyboardMarkup()
+    markup.row(InlineKeyboardButton("🔙 Back to My Bots", callback_data="my_bots"))
+    if deleted:
+        bot.edit_message_text(f"🗑️ Bot {html.escape(bot_username_to_delete)} has been successfully deleted.", call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
+    else:
+        logger.error(f"Failed to delete bot {bot_username_to_delete} for user {user_id_str} (maybe already deleted?).")
+        bot.edit_message_text(f"❌ Could not delete bot {html.escape(bot_username_to_delete)}.\n\nIt might have already been removed.", call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
+
+
+@callback_router.route("my_account")
+def callback_my_account(call):
+    user_id_str = str(call.from_user.id)
+    bot.answer_callback_query(call.id)
+    database = load_database()
+    user_info = database.get("users", {}).get(user_id_str, {})
+    msg = "👤 <b>Account Information</b>\n\n"
+    msg += f"<b>User ID:</b> <code>{user_id_str}</code>\n"
+    display_username = user_info.get('username', 'Not Set')
+    if display_username and display_username != "Unknown":
+         msg += f"<b>Username:</b> @{html.escape(display_username)}\n"
+    else:
+         msg += f"<b>Username:</b> Not Set\n"
+    msg += f"<b>Registration Date:</b> {user_info.get('registration_date', 'Unknown')}\n"
+    msg += f"<b>Bots Created:</b> {len(user_info.get('bots', []))} / 10\n\n"
+    msg += "For support, contact @tenocobot\n" # Placeholder
+    msg += f"Updates Channel: <a href=\"{CHANNEL_LINK}\">{CHANNEL_USERNAME}</a>"
+    markup = InlineKeyboardMarkup()
+    markup.row(InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_main"))
+    bot.edit_message_text(msg, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML", disable_web_page_preview=True)
+    logger.info(f"User {user_id_str} viewed 'My Account'.")
+
+
+@callback_router.route("back_to_main")
+def callback_back_to_main(call):
+    user_id_str = str(call.from_user.id)
+    username = call.from_user.username
+    first_name = call.from_user.first_name
+    bot.answer_callback_query(call.id)
+    if user_id_str in user_states:
+         logger.info(f"User {user_id_str} returned to main menu, clearing state '{user_states[user_id_str]}'.")
+         user_states.pop(user_id_str, None)
+    if user_id_str in user_data:
+         logger.info(f"User {user_id_str} returned to main menu, clearing user_data.")
+         user_data.pop(user_id_str, None)
+    welcome_msg = f"🤖 Welcome back to BotMaker, @{username if username else first_name}!\n\n"
+    welcome_msg += "Please select an option from the menu below:"
+    bot.edit_message_text(welcome_msg, call.message.chat.id, call.message.message_id, reply_markup=main_menu_keyboard(), parse_mode="HTML")
+    logger.info(f"User {user_id_str} returned to main menu via button.")
+
+
+# Admin approval/rejection (ensure bot_username in callbacks includes '@')
+@callback_router.route("approve_bot:")
+def callback_approve_bot(call):
+    if str(call.from_user.id) != str(ADMIN_ID):
+        bot.answer_callback_query(call.id, "⛔ You are not authorized for this action!", show_alert=True)
+        return
+    bot.answer_callback_query(call.id, "Processing approval...")
     try:
-        if call.data == "create_bot":
-            bot.answer_callback_query(call.id)
+        parts = call.data.split(":")
+        requester_id_str, bot_username_app = parts[1], parts[2] # bot_username_app includes @
+        logger.info(f"Admin {ADMIN_ID} initiated approval for bot {bot_username_app} by user {requester_id_str}.")
+        bot_found_updated = False
+        with database_lock:
             database = load_database()
-            if user_id_str in database["users"] and len(database["users"][user_id_str].get("bots", [])) >= 10:
-                bot.send_message(call.message.chat.id, "⚠️ You have reached the maximum limit of <b>10 bots!</b>", parse_mode="HTML")
-                logger.info(f"User {user_id_str} tried to create bot but reached limit.")
-                return
-            markup = InlineKeyboardMarkup()
-            for template in BOT_TEMPLATES:
-                 safe_template_name = template.replace(":", "_")
-                 markup.row(InlineKeyboardButton(template, callback_data=f"template:{safe_template_name}"))
-            markup.row(InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_main"))
-            bot.edit_message_text("Please select a bot template to start:", call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
-            logger.info(f"User {user_id_str} initiated bot creation. Showing templates.")
-
-        elif call.data.startswith("template:"):
-            bot.answer_callback_query(call.id)
-            template_name = call.data.split(":", 1)[1]
-            original_template_name = template_name.replace("_", ":")
-            if original_template_name in BOT_TEMPLATES:
-                 logger.info(f"User {user_id_str} selected template: {original_template_name}")
-                 user_data[user_id_str] = {
-                     "template": original_template_name,
-                     "must_join_channels": []
-                 }
-                 user_states[user_id_str] = "awaiting_bot_token"
-                 msg = "Great! Let's start configuring your bot.\n\n"
-                 msg += "Please send me the <b>API token</b> for the bot you want to create.\n\n"
-                 msg += "To get a token:\n"
-                 msg += "1. Open a chat with @BotFather on Telegram.\n"
-                 msg += "2. Send the <code>/newbot</code> command.\n"
-                 msg += "3. Follow the instructions to choose a name and username.\n"
-                 msg += "4. @BotFather will provide the API token. <b>Copy the token and paste it here.</b>"
-                 markup = InlineKeyboardMarkup()
-                 markup.row(InlineKeyboardButton("🔙 Cancel Creation", callback_data="back_to_main"))
-                 bot.edit_message_text(msg, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
-            else:
-                 logger.warning(f"User {user_id_str} selected an unknown template: {template_name}")
-                 bot.edit_message_text("Invalid template selected. Please try again.", call.message.chat.id, call.message.message_id, reply_markup=main_menu_keyboard())
+            bot_info_entry = get_indexed_bot(database, bot_username_app, requester_id_str)
+            if bot_info_entry:
+                bot_info_entry["status"] = "Approved"
+                save_database(database)
+                set_indexed_status(bot_username_app, "Approved")
+        if bot_info_entry:
+            bot_found_updated = True
+            logger.info(f"Bot {bot_username_app} status to 'Approved' for user {requester_id_str}.")
+            try:
+                bot.send_message(int(requester_id_str),
+                                 f"🎉 Good news!\n\nYour bot creation request for <b>{html.escape(bot_username_app)}</b> has been <b>approved</b>.\n\n"
+                                 f"It is now being processed and should be ready within 1-12 hours. I will notify you when it's active.",
+                                 parse_mode="HTML")
+            except Exception as e:
+                logger.error(f"Failed to notify user {requester_id_str} about bot approval: {e}", exc_info=True)
+                bot.send_message(ADMIN_ID, f"⚠️ Failed to notify user {requester_id_str} about approval of {html.escape(bot_username_app)}.\nError: {e}")
+            markup_admin = InlineKeyboardMarkup()
+            markup_admin.row(InlineKeyboardButton("✅ Mark as Active", callback_data=f"bot_done:{requester_id_str}:{bot_username_app}"))
+            markup_admin.row(InlineKeyboardButton("❌ Cancel Approval", callback_data=f"bot_cancel:{requester_id_str}:{bot_username_app}"))
+            deploy_note = "Deploying automatically; you will get a message when it is live or if it fails." if DEPLOY_ENABLED else "Use buttons when deployed or to cancel."
+            bot.edit_message_text(f"✅ Bot <b>{html.escape(bot_username_app)}</b> (User: {requester_id_str}) <b>approved</b>.\nUser notified. {deploy_note}",
+                                  call.message.chat.id, call.message.message_id, reply_markup=markup_admin, parse_mode="HTML")
+            if DEPLOY_ENABLED:
+                deploy_jobs.put((requester_id_str, bot_username_app))
+        if not bot_found_updated:
+            logger.error(f"Admin approval error: Bot {bot_username_app} for user {requester_id_str} not found.")
+            bot.edit_message_text(f"❌ Error: Could not find bot request for {html.escape(bot_username_app)} from user {requester_id_str}.",
+                                  call.message.chat.id, call.message.message_id, parse_mode="HTML")
+    except Exception as e:
+         logger.error(f"Error during bot approval for {call.data}: {e}", exc_info=True)
+         bot.edit_message_text("Unexpected error during approval.", call.message.chat.id, call.message.message_id)
 
-        elif call.data == "my_bots":
-            bot.answer_callback_query(call.id)
-            database = load_database()
-            user_bots_list = database.get("users", {}).get(user_id_str, {}).get("bots", [])
-            logger.debug(f"My Bots for {user_id_str}: {user_bots_list}") # Log the raw list
-            if not user_bots_list:
-                markup = InlineKeyboardMarkup()
-                markup.row(InlineKeyboardButton("🤖 Create a bot", callback_data="create_bot"))
-                markup.row(InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_main"))
-                bot.edit_message_text("You haven't created any bots with me yet.\n\nWould you like to create one now?", call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
-                logger.info(f"User {user_id_str} viewed 'My Bots' but has none.")
-            else:
-                 markup = InlineKeyboardMarkup(row_width=1)
-                 for bot_entry in user_bots_list:
-                     bot_name = bot_entry.get('bot_name', 'Unnamed Bot')
-                     bot_username_cb = bot_entry.get('bot_username', 'Unknown Username') # Should be like @username_bot
-                     bot_status = bot_entry.get('status', 'Unknown')
-                     # Pass bot_username_cb directly as it includes '@' which is consistent with storage
-                     markup.add(InlineKeyboardButton(f"{bot_name} (@{bot_username_cb.lstrip('@')}) - {bot_status}", callback_data=f"bot_info:{bot_username_cb}"))
-                 markup.add(InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_main"))
-                 bot.edit_message_text(f"Here are the bots you've created (Total: {len(user_bots_list)}):", call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
-                 logger.info(f"User {user_id_str} viewed 'My Bots'. Displayed {len(user_bots_list)} bots.")
-
-        elif call.data.startswith("bot_info:"):
-            bot.answer_callback_query(call.id)
-            bot_username_to_find = call.data.split(":", 1)[1] # This will be like "@username_bot"
-            logger.info(f"User {user_id_str} trying to view bot info for: '{bot_username_to_find}'")
-            database = load_database()
-            user_bots_list = database.get("users", {}).get(user_id_str, {}).get("bots", [])
-            
-            # Detailed logging for Issue 1 Diagnosis
-            db_bot_usernames = [b.get('bot_username') for b in user_bots_list]
-            logger.debug(f"User {user_id_str} looking for '{bot_username_to_find}'. Bots in DB for user: {db_bot_usernames}")
-
-            bot_data_entry = None
-            for b_entry in user_bots_list:
-                 current_bot_username_in_db = b_entry.get("bot_username")
-                 logger.debug(f"Comparing query:'{bot_username_to_find}' with DB entry:'{current_bot_username_in_db}'")
-                 if current_bot_username_in_db == bot_username_to_find:
-                     bot_data_entry = b_entry
-                     logger.info(f"Found match for '{bot_username_to_find}'")
-                     break
-            
-            if bot_data_entry:
-                msg = f"🤖 <b>Bot Details</b>\n\n"
-                msg += f"<b>Name:</b> {html.escape(bot_data_entry.get('bot_name', 'N/A'))}\n"
-                msg += f"<b>Username:</b> {html.escape(bot_data_entry.get('bot_username', 'N/A'))}\n" # Show with @
-                msg += f"<b>Status:</b> {html.escape(bot_data_entry.get('status', 'Unknown'))}\n"
-                msg += f"<b>Requested:</b> {html.escape(bot_data_entry.get('creation_request_date', 'N/A'))}\n"
-                config_details_str = bot_data_entry.get('config_details', 'Configuration not available.')
-                max_config_len = 3000
-                truncated_config = config_details_str[:max_config_len] + ("..." if len(config_details_str) > max_config_len else "")
-                msg += f"\n<b>Configuration:</b>\n<pre><code class=\"language-python\">{html.escape(truncated_config)}</code></pre>\n"
-                markup = InlineKeyboardMarkup()
-                markup.row(InlineKeyboardButton("🛠️ Edit Bot (Recreates)", callback_data=f"edit_bot_warn:{bot_username_to_find}"))
-                markup.row(InlineKeyboardButton("🗑️ Delete Bot", callback_data=f"delete_bot:{bot_username_to_find}"))
-                markup.row(InlineKeyboardButton("🔙 Back to My Bots", callback_data="my_bots"))
-                bot.edit_message_text(msg, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
-                logger.info(f"User {user_id_str} viewed info for bot {bot_username_to_find}.")
-            else:
-                 logger.warning(f"User {user_id_str} tried to view info for bot {bot_username_to_find}, but it was NOT found in their list: {db_bot_usernames}")
-                 bot.edit_message_text("Error: Could not find details for this bot.\n\nIt might have been deleted or there was an issue retrieving its data.", call.message.chat.id, call.message.message_id, reply_markup=main_menu_keyboard(), parse_mode="HTML")
 
-        elif call.data.startswith("edit_bot_warn:"):
-            bot.answer_callback_query(call.id)
-            bot_username_to_edit = call.data.split(":", 1)[1] # Includes @
-            markup = InlineKeyboardMarkup()
-            markup.row(
-                InlineKeyboardButton("⚠️ Yes, Delete & Recreate", callback_data=f"confirm_edit_recreate:{bot_username_to_edit}"),
-                InlineKeyboardButton("❌ Cancel", callback_data=f"bot_info:{bot_username_to_edit}")
-            )
-            warn_msg = (f"<b>WARNING!</b> Editing bot <b>{html.escape(bot_username_to_edit)}</b> means its current settings and record will be <b>deleted</b> from My Bots.\n\n"
-                        f"You will then be guided to create it again from scratch (you'll need its API token, etc.). This action cannot be undone.\n\n"
-                        f"Are you sure you want to proceed?")
-            bot.edit_message_text(warn_msg, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
-
-        elif call.data.startswith("confirm_edit_recreate:"):
-            bot_username_to_delete_and_edit = call.data.split(":", 1)[1] # Includes @
-            logger.info(f"User {user_id_str} confirmed edit (delete & recreate) for bot {bot_username_to_delete_and_edit}.")
-            database = load_database()
-            deleted_for_edit = False
-            if user_id_str in database.get("users", {}):
-                user_bots = database["users"][user_id_str].get("bots", [])
-                initial_bot_count = len(user_bots)
-                database["users"][user_id_str]["bots"] = [
-                    b for b in user_bots if b.get("bot_username") != bot_username_to_delete_and_edit
-                ]
-                if len(database["users"][user_id_str]["bots"]) < initial_bot_count:
-                    deleted_for_edit = True
-                    save_database(database)
-                    logger.info(f"Bot {bot_username_to_delete_and_edit} deleted for edit by user {user_id_str}.")
-            if deleted_for_edit:
-                bot.answer_callback_query(call.id, "Bot deleted. Starting recreation...")
-                create_markup = InlineKeyboardMarkup()
-                for template in BOT_TEMPLATES:
-                    safe_template_name = template.replace(":", "_")
-                    create_markup.row(InlineKeyboardButton(template, callback_data=f"template:{safe_template_name}"))
-                create_markup.row(InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_main"))
-                edit_msg = (f"Bot {html.escape(bot_username_to_delete_and_edit)} has been removed.\n\n"
-                            "Let's set up the new configuration. Please select a bot template to start:")
-                bot.edit_message_text(edit_msg, call.message.chat.id, call.message.message_id, reply_markup=create_markup, parse_mode="HTML")
-            else:
-                bot.answer_callback_query(call.id, "Error: Could not remove the bot for editing. It might have already been deleted.", show_alert=True)
-                logger.warning(f"Failed to find bot {bot_username_to_delete_and_edit} for deletion during edit process by user {user_id_str}.")
-                bot.edit_message_text("Could not find the bot to edit. Please check 'My Bots' again.", call.message.chat.id, call.message.message_id, reply_markup=main_menu_keyboard(), parse_mode="HTML")
-
-        elif call.data.startswith("delete_bot:"):
-             bot.answer_callback_query(call.id)
-             bot_username_to_delete = call.data.split(":", 1)[1] # Includes @
-             logger.warning(f"User {user_id_str} initiated deletion for bot {bot_username_to_delete}.")
-             markup = InlineKeyboardMarkup()
-             markup.row(
-                 InlineKeyboardButton("✅ Yes, Delete", callback_data=f"confirm_delete:{bot_username_to_delete}"),
-                 InlineKeyboardButton("❌ No, Cancel", callback_data=f"bot_info:{bot_username_to_delete}")
-              )
-             bot.edit_message_text(f"⚠️ <b>Are you sure you want to delete the bot {html.escape(bot_username_to_delete)}?</b>\n\nThis action cannot be undone and will remove its record from 'My Bots'.",
-                                   call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
-
-        elif call.data.startswith("confirm_delete:"):
-             bot_username_to_delete = call.data.split(":", 1)[1] # Includes @
-             logger.info(f"User {user_id_str} confirmed deletion for bot {bot_username_to_delete}.")
-             database = load_database()
-             deleted = False
-             if user_id_str in database.get("users", {}):
-                 initial_bot_count = len(database["users"][user_id_str].get("bots", []))
-                 database["users"][user_id_str]["bots"] = [
-                     b for b in database["users"][user_id_str].get("bots", [])
-                     if b.get("bot_username") != bot_username_to_delete
-                 ]
-                 if len(database["users"][user_id_str]["bots"]) < initial_bot_count:
-                      deleted = True
-                      save_database(database)
-                      logger.info(f"Successfully deleted bot {bot_username_to_delete} for user {user_id_str}.")
-             markup = InlineKeyboardMarkup()
-             markup.row(InlineKeyboardButton("🔙 Back to My Bots", callback_data="my_bots"))
-             if deleted:
-                 bot.edit_message_text(f"🗑️ Bot {html.escape(bot_username_to_delete)} has been successfully deleted.", call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
-             else:
-                 logger.error(f"Failed to delete bot {bot_username_to_delete} for user {user_id_str} (maybe already deleted?).")
-                 bot.edit_message_text(f"❌ Could not delete bot {html.escape(bot_username_to_delete)}.\n\nIt might have already been removed.", call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
-
-        elif call.data == "my_account":
-            bot.answer_callback_query(call.id)
+@callback_router.route("decline_bot:")
+def callback_decline_bot(call):
+    if str(call.from_user.id) != str(ADMIN_ID):
+        bot.answer_callback_query(call.id, "⛔ You are not authorized!", show_alert=True)
+        return
+    bot.answer_callback_query(call.id, "Processing decline...")
+    try:
+        parts = call.data.split(":")
+        requester_id_str, bot_username_dec = parts[1], parts[2] # Includes @
+        logger.info(f"Admin {ADMIN_ID} initiated decline for bot {bot_username_dec} by {requester_id_str}.")
+        bot_found_removed = False
+        with database_lock:
             database = load_database()
-            user_info = database.get("users", {}).get(user_id_str, {})
-            msg = "👤 <b>Account Information</b>\n\n"
-            msg += f"<b>User ID:</b> <code>{user_id_str}</code>\n"
-            display_username = user_info.get('username', 'Not Set')
-            if display_username and display_username != "Unknown":
-                 msg += f"<b>Username:</b> @{html.escape(display_username)}\n"
-            else:
-                 msg += f"<b>Username:</b> Not Set\n"
-            msg += f"<b>Registration Date:</b> {user_info.get('registration_date', 'Unknown')}\n"
-            msg += f"<b>Bots Created:</b> {len(user_info.get('bots', []))} / 10\n\n"
-            msg += "For support, contact @tenocobot\n" # Placeholder
-            msg += f"Updates Channel: <a href=\"{CHANNEL_LINK}\">{CHANNEL_USERNAME}</a>"
-            markup = InlineKeyboardMarkup()
-            markup.row(InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_main"))
-            bot.edit_message_text(msg, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML", disable_web_page_preview=True)
-            logger.info(f"User {user_id_str} viewed 'My Account'.")
-
-        elif call.data == "back_to_main":
-            bot.answer_callback_query(call.id)
-            if user_id_str in user_states:
-                 logger.info(f"User {user_id_str} returned to main menu, clearing state '{user_states[user_id_str]}'.")
-                 user_states.pop(user_id_str, None)
-            if user_id_str in user_data:
-                 logger.info(f"User {user_id_str} returned to main menu, clearing user_data.")
-                 user_data.pop(user_id_str, None)
-            welcome_msg = f"🤖 Welcome back to BotMaker, @{username if username else first_name}!\n\n"
-            welcome_msg += "Please select an option from the menu below:"
-            bot.edit_message_text(welcome_msg, call.message.chat.id, call.message.message_id, reply_markup=main_menu_keyboard(), parse_mode="HTML")
-            logger.info(f"User {user_id_str} returned to main menu via button.")
-
-        # Admin approval/rejection (ensure bot_username in callbacks includes '@')
-        elif call.data.startswith("approve_bot:"):
-             if str(call.from_user.id) != str(ADMIN_ID):
-                 bot.answer_callback_query(call.id, "⛔ You are not authorized for this action!", show_alert=True)
-                 return
-             bot.answer_callback_query(call.id, "Processing approval...")
-             try:
-                 parts = call.data.split(":")
-                 requester_id_str, bot_username_app = parts[1], parts[2] # bot_username_app includes @
-                 logger.info(f"Admin {ADMIN_ID} initiated approval for bot {bot_username_app} by user {requester_id_str}.")
-                 database = load_database()
-                 bot_found_updated = False
-                 if requester_id_str in database.get("users", {}):
-                     for bot_info_entry in database["users"][requester_id_str].get("bots", []):
-                         if bot_info_entry.get("bot_username") == bot_username_app:
-                             bot_info_entry["status"] = "Approved"
-                             save_database(database)
-                             bot_found_updated = True
-                             logger.info(f"Bot {bot_username_app} status to 'Approved' for user {requester_id_str}.")
-                             try:
-                                 bot.send_message(int(requester_id_str),
-                                                  f"🎉 Good news!\n\nYour bot creation request for <b>{html.escape(bot_username_app)}</b> has been <b>approved</b>.\n\n"
-                                                  f"It is now being processed and should be ready within 1-12 hours. I will notify you when it's active.",
-                                                  parse_mode="HTML")
-                             except Exception as e:
-                                 logger.error(f"Failed to notify user {requester_id_str} about bot approval: {e}", exc_info=True)
-                                 bot.send_message(ADMIN_ID, f"⚠️ Failed to notify user {requester_id_str} about approval of {html.escape(bot_username_app)}.\nError: {e}")
-                             markup_admin = InlineKeyboardMarkup()
-                             markup_admin.row(InlineKeyboardButton("✅ Mark as Active", callback_data=f"bot_done:{requester_id_str}:{bot_username_app}"))
-                             markup_admin.row(InlineKeyboardButton("❌ Cancel Approval", callback_data=f"bot_cancel:{requester_id_str}:{bot_username_app}"))
-                             bot.edit_message_text(f"✅ Bot <b>{html.escape(bot_username_app)}</b> (User: {requester_id_str}) <b>approved</b>.\nUser notified. Use buttons when deployed or to cancel.",
-                                                   call.message.chat.id, call.message.message_id, reply_markup=markup_admin, parse_mode="HTML")
-                             break
-                 if not bot_found_updated:
-                     logger.error(f"Admin approval error: Bot {bot_username_app} for user {requester_id_str} not found.")
-                     bot.edit_message_text(f"❌ Error: Could not find bot request for {html.escape(bot_username_app)} from user {requester_id_str}.",
-                                           call.message.chat.id, call.message.message_id, parse_mode="HTML")
-             except Exception as e:
-                  logger.error(f"Error during bot approval for {call.data}: {e}", exc_info=True)
-                  bot.edit_message_text("Unexpected error during approval.", call.message.chat.id, call.message.message_id)
-
-        elif call.data.startswith("decline_bot:"):
-            if str(call.from_user.id) != str(ADMIN_ID):
-                bot.answer_callback_query(call.id, "⛔ You are not authorized!", show_alert=True)
-                return
-            bot.answer_callback_query(call.id, "Processing decline...")
+            removed = remove_indexed_bot(database, bot_username_dec, requester_id_str)
+            if removed:
+                save_database(database)
+        if removed:
+            bot_found_removed = True
+            logger.info(f"Bot {bot_username_dec} declined and removed for user {requester_id_str}.")
             try:
-                parts = call.data.split(":")
-                requester_id_str, bot_username_dec = parts[1], parts[2] # Includes @
-                logger.info(f"Admin {ADMIN_ID} initiated decline for bot {bot_username_dec} by {requester_id_str}.")
-                database = load_database()
-                bot_found_removed = False
-                if requester_id_str in database.get("users", {}):
-                    user_bots_list = database["users"][requester_id_str].get("bots", [])
-                    new_bots_list = [b for b in user_bots_list if b.get("bot_username") != bot_username_dec]
-                    if len(new_bots_list) < len(user_bots_list):
-                        database["users"][requester_id_str]["bots"] = new_bots_list
-                        save_database(database)
-                        bot_found_removed = True
-                        logger.info(f"Bot {bot_username_dec} declined and removed for user {requester_id_str}.")
-                        try:
-                            bot.send_message(int(requester_id_str),
-                                             f"❌ Regarding your bot request for <b>{html.escape(bot_username_dec)}</b>:\n\n"
-                                             f"Unfortunately, your request has been <b>declined</b>.\n\n"
-                                             f"Please review your setup info or contact support. You can try creating a bot again later.",
-                                             parse_mode="HTML")
-                        except Exception as e:
-                            logger.error(f"Failed to notify user {requester_id_str} of decline: {e}", exc_info=True)
-                            bot.send_message(ADMIN_ID, f"⚠️ Failed to notify user {requester_id_str} of decline of {html.escape(bot_username_dec)}.\nError: {e}")
-                        bot.edit_message_text(f"❌ Bot request for <b>{html.escape(bot_username_dec)}</b> (User: {requester_id_str}) <b>declined</b> and removed.\nUser notified.",
-                                              call.message.chat.id, call.message.message_id, parse_mode="HTML")
-                if not bot_found_removed:
-                    logger.warning(f"Admin decline error: Bot {bot_username_dec} for user {requester_id_str} not found.")
-                    bot.edit_message_text(f"⚠️ Could not find bot request for {html.escape(bot_username_dec)} (User {requester_id_str}) to decline.",
-                                          call.message.chat.id, call.message.message_id, parse_mode="HTML")
+                bot.send_message(int(requester_id_str),
+                                 f"❌ Regarding your bot request for <b>{html.escape(bot_username_dec)}</b>:\n\n"
+                                 f"Unfortunately, your request has been <b>declined</b>.\n\n"
+                                 f"Please review your setup info or contact support. You can try creating a bot again later.",
+                                 parse_mode="HTML")
             except Exception as e:
-                logger.error(f"Error during bot decline for {call.data}: {e}", exc_info=True)
-                bot.edit_message_text("Unexpected error during decline.", call.message.chat.id, call.message.message_id)
+                logger.error(f"Failed to notify user {requester_id_str} of decline: {e}", exc_info=True)
+                bot.send_message(ADMIN_ID, f"⚠️ Failed to notify user {requester_id_str} of decline of {html.escape(bot_username_dec)}.\nError: {e}")
+            bot.edit_message_text(f"❌ Bot request for <b>{html.escape(bot_username_dec)}</b> (User: {requester_id_str}) <b>declined</b> and removed.\nUser notified.",
+                                  call.message.chat.id, call.message.message_id, parse_mode="HTML")
+        if not bot_found_removed:
+            logger.warning(f"Admin decline error: Bot {bot_username_dec} for user {requester_id_str} not found.")
+            bot.edit_message_text(f"⚠️ Could not find bot request for {html.escape(bot_username_dec)} (User {requester_id_str}) to decline.",
+                                  call.message.chat.id, call.message.message_id, parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Error during bot decline for {call.data}: {e}", exc_info=True)
+        bot.edit_message_text("Unexpected error during decline.", call.message.chat.id, call.message.message_id)
 
-        elif call.data.startswith("bot_done:"):
-            if str(call.from_user.id) != str(ADMIN_ID):
-                bot.answer_callback_query(call.id, "⛔ Unauthorized!", show_alert=True)
-                return
-            bot.answer_callback_query(call.id, "Marking as active...")
+
+@callback_router.route("bot_done:")
+def callback_bot_done(call):
+    if str(call.from_user.id) != str(ADMIN_ID):
+        bot.answer_callback_query(call.id, "⛔ Unauthorized!", show_alert=True)
+        return
+    bot.answer_callback_query(call.id, "Marking as active...")
+    try:
+        parts = call.data.split(":")
+        requester_id_str, bot_username_done = parts[1], parts[2] # Includes @
+        logger.info(f"Admin {ADMIN_ID} marking bot {bot_username_done} (User: {requester_id_str}) as 'Active'.")
+        bot_found_act = False
+        with database_lock:
+            database = load_database()
+            bot_info_entry = get_indexed_bot(database, bot_username_done, requester_id_str)
+            if bot_info_entry:
+                bot_info_entry["status"] = "Active"
+                save_database(database)
+                set_indexed_status(bot_username_done, "Active")
+        if bot_info_entry:
+            bot_found_act = True
+            logger.info(f"Bot {bot_username_done} status to 'Active' for user {requester_id_str}.")
             try:
-                parts = call.data.split(":")
-                requester_id_str, bot_username_done = parts[1], parts[2] # Includes @
-                logger.info(f"Admin {ADMIN_ID} marking bot {bot_username_done} (User: {requester_id_str}) as 'Active'.")
-                database = load_database()
-                bot_found_act = False
-                if requester_id_str in database.get("users", {}):
-                     for bot_info_entry in database["users"][requester_id_str].get("bots", []):
-                         if bot_info_entry.get("bot_username") == bot_username_done:
-                             bot_info_entry["status"] = "Active"
-                             save_database(database)
-                             bot_found_act = True
-                             logger.info(f"Bot {bot_username_done} status to 'Active' for user {requester_id_str}.")
-                             try:
-                                  bot.send_message(int(requester_id_str),
-                                                  f"🚀 Great news!\n\nYour bot <b>{html.escape(bot_username_done)}</b> is now <b>Active</b> and ready to use!\n\nYou can start interacting with it.",
-                                                  parse_mode="HTML")
-                             except Exception as e:
-                                 logger.error(f"Failed to notify user {requester_id_str} of bot readiness: {e}", exc_info=True)
-                                 bot.send_message(ADMIN_ID, f"⚠️ Failed to notify user {requester_id_str} that bot {html.escape(bot_username_done)} is ready.\nError: {e}")
-                             bot.edit_message_text(f"✅ Bot <b>{html.escape(bot_username_done)}</b> (User: {requester_id_str}) marked <b>Active</b>.\nUser notified.",
-                                                  call.message.chat.id, call.message.message_id, parse_mode="HTML")
-                             break
-                if not bot_found_act:
-                     logger.error(f"Admin mark active error: Bot {bot_username_done} for user {requester_id_str} not found.")
-                     bot.edit_message_text(f"❌ Error: Could not find bot {html.escape(bot_username_done)} for user {requester_id_str} to mark active.",
-                                           call.message.chat.id, call.message.message_id, parse_mode="HTML")
+                 bot.send_message(int(requester_id_str),
+                                 f"🚀 Great news!\n\nYour bot <b>{html.escape(bot_username_done)}</b> is now <b>Active</b> and ready to use!\n\nYou can start interacting with it.",
+                                 parse_mode="HTML")
             except Exception as e:
-                  logger.error(f"Error during 'bot_done' for {call.data}: {e}", exc_info=True)
-                  bot.edit_message_text("Unexpected error marking bot active.", call.message.chat.id, call.message.message_id)
+                logger.error(f"Failed to notify user {requester_id_str} of bot readiness: {e}", exc_info=True)
+                bot.send_message(ADMIN_ID, f"⚠️ Failed to notify user {requester_id_str} that bot {html.escape(bot_username_done)} is ready.\nError: {e}")
+            bot.edit_message_text(f"✅ Bot <b>{html.escape(bot_username_done)}</b> (User: {requester_id_str}) marked <b>Active</b>.\nUser notified.",
+                                 call.message.chat.id, call.message.message_id, parse_mode="HTML")
+        if not bot_found_act:
+             logger.error(f"Admin mark active error: Bot {bot_username_done} for user {requester_id_str} not found.")
+             bot.edit_message_text(f"❌ Error: Could not find bot {html.escape(bot_username_done)} for user {requester_id_str} to mark active.",
+                                   call.message.chat.id, call.message.message_id, parse_mode="HTML")
+    except Exception as e:
+          logger.error(f"Error during 'bot_done' for {call.data}: {e}", exc_info=True)
+          bot.edit_message_text("Unexpected error marking bot active.", call.message.chat.id, call.message.message_id)
 
-        elif call.data.startswith("bot_cancel:"):
-            if str(call.from_user.id) != str(ADMIN_ID):
-                bot.answer_callback_query(call.id, "⛔ Unauthorized!", show_alert=True)
-                return
-            bot.answer_callback_query(call.id, "Cancelling approval/development...")
+
+@callback_router.route("bot_cancel:")
+def callback_bot_cancel(call):
+    if str(call.from_user.id) != str(ADMIN_ID):
+        bot.answer_callback_query(call.id, "⛔ Unauthorized!", show_alert=True)
+        return
+    bot.answer_callback_query(call.id, "Cancelling approval/development...")
+    try:
+        parts = call.data.split(":")
+        requester_id_str, bot_username_can = parts[1], parts[2] # Includes @
+        logger.warning(f"Admin {ADMIN_ID} cancelling for bot {bot_username_can} by {requester_id_str}.")
+        bot_found_can = False
+        with database_lock:
+            database = load_database()
+            removed = remove_indexed_bot(database, bot_username_can, requester_id_str)
+            if removed:
+                save_database(database)
+        if removed:
+            undeploy_bot(bot_username_can)
+            bot_found_can = True
+            logger.info(f"Bot {bot_username_can} cancelled and removed for user {requester_id_str}.")
             try:
-                parts = call.data.split(":")
-                requester_id_str, bot_username_can = parts[1], parts[2] # Includes @
-                logger.warning(f"Admin {ADMIN_ID} cancelling for bot {bot_username_can} by {requester_id_str}.")
-                database = load_database()
-                bot_found_can = False
-                if requester_id_str in database.get("users", {}):
-                    user_bots_list = database["users"][requester_id_str].get("bots", [])
-                    new_bots_list = [b for b in user_bots_list if b.get("bot_username") != bot_username_can]
-                    if len(new_bots_list) < len(user_bots_list):
-                        database["users"][requester_id_str]["bots"] = new_bots_list
-                        save_database(database)
-                        bot_found_can = True
-                        logger.info(f"Bot {bot_username_can} cancelled and removed for user {requester_id_str}.")
-                        try:
-                            bot.send_message(int(requester_id_str),
-                                             f"⚠️ Regarding your bot <b>{html.escape(bot_username_can)}</b>:\n\n"
-                                             f"The approval/development has been <b>cancelled</b> by administration.\n\n"
-                                             f"Contact support if needed. You may try creating it again later.",
-                                             parse_mode="HTML")
-                        except Exception as e:
-                            logger.error(f"Failed to notify user {requester_id_str} of cancellation: {e}", exc_info=True)
-                            bot.send_message(ADMIN_ID, f"⚠️ Failed to notify user {requester_id_str} of cancellation of {html.escape(bot_username_can)}.\nError: {e}")
-                        bot.edit_message_text(f"❌ Approval/Development for <b>{html.escape(bot_username_can)}</b> (User: {requester_id_str}) <b>cancelled</b> and removed.\nUser notified.",
-                                              call.message.chat.id, call.message.message_id, parse_mode="HTML")
-                if not bot_found_can:
-                    logger.warning(f"Admin cancel error: Bot {bot_username_can} for user {requester_id_str} not found.")
-                    bot.edit_message_text(f"⚠️ Could not find bot {html.escape(bot_username_can)} (User {requester_id_str}) to cancel.",
-                                          call.message.chat.id, call.message.message_id, parse_mode="HTML")
+                bot.send_message(int(requester_id_str),
+                                 f"⚠️ Regarding your bot <b>{html.escape(bot_username_can)}</b>:\n\n"
+                                 f"The approval/development has been <b>cancelled</b> by administration.\n\n"
+                                 f"Contact support if needed. You may try creating it again later.",
+                                 parse_mode="HTML")
             except Exception as e:
-                  logger.error(f"Error 'bot_cancel' for {call.data}: {e}", exc_info=True)
-                  bot.edit_message_text("Unexpected error during cancellation.", call.message.chat.id, call.message.message_id)
-        else:
-            # Fallback for unhandled callbacks if no specific handler matched earlier
-            # List known prefixes that are handled by specific `startswith` blocks
-            known_prefixes = ["template:", "bot_info:", "edit_bot_warn:", "confirm_edit_recreate:", 
-                              "delete_bot:", "confirm_delete:", "approve_bot:", "decline_bot:", 
-                              "bot_done:", "bot_cancel:"]
-            is_known_prefix_callback = any(call.data.startswith(prefix) for prefix in known_prefixes)
-            
-            # List exact matches that are handled
-            known_exact_matches = ["check_subscription", "show_admin_instructions", "confirm_broadcast", 
-                                   "cancel_broadcast", "payment_channel_admin_done", "must_join_admin_done",
-                                   "must_join_yes", "must_join_no", "create_bot", "my_bots", "my_account", "back_to_main"]
-
-            if not is_known_prefix_callback and call.data not in known_exact_matches:
-                 logger.warning(f"Unhandled callback in general try-except: '{call.data}' from user {user_id_str}")
-                 try: bot.answer_callback_query(call.id, "Action not recognized or is currently unavailable.")
-                 except Exception: pass
+                logger.error(f"Failed to notify user {requester_id_str} of cancellation: {e}", exc_info=True)
+                bot.send_message(ADMIN_ID, f"⚠️ Failed to notify user {requester_id_str} of cancellation of {html.escape(bot_username_can)}.\nError: {e}")
+            bot.edit_message_text(f"❌ Approval/Development for <b>{html.escape(bot_username_can)}</b> (User: {requester_id_str}) <b>cancelled</b> and removed.\nUser notified.",
+                                  call.message.chat.id, call.message.message_id, parse_mode="HTML")
+        if not bot_found_can:
+            logger.warning(f"Admin cancel error: Bot {bot_username_can} for user {requester_id_str} not found.")
+            bot.edit_message_text(f"⚠️ Could not find bot {html.escape(bot_username_can)} (User {requester_id_str}) to cancel.",
+                                  call.message.chat.id, call.message.message_id, parse_mode="HTML")
+    except Exception as e:
+          logger.error(f"Error 'bot_cancel' for {call.data}: {e}", exc_info=True)
+          bot.edit_message_text("Unexpected error during cancellation.", call.message.chat.id, call.message.message_id)
+
+
+@bot.callback_query_handler(func=lambda call: True)
+def callback_handler(call):
+    user_id = call.from_user.id
+    username = call.from_user.username
+    first_name = call.from_user.first_name
+    logger.info(f"Received callback '{call.data}' from user {first_name or 'N/A'} (@{username or 'N/A'}, ID: {user_id})")
+
+    route, handler = callback_router.resolve(call.data or "")
+    if handler is None:
+        logger.warning(f"Unhandled callback: '{call.data}' from user {user_id}")
+        try: bot.answer_callback_query(call.id, "Action not recognized or is currently unavailable.")
+        except Exception: pass
+        return
+
+    started = time.perf_counter()
+    try:
+        handler(call)
     except Exception as e:
         logger.error(f"Generic callback error for callback '{call.data}', user {user_id}: {e}", exc_info=True)
         try: bot.answer_callback_query(call.id, "An internal error occurred. Please try again.", show_alert=True)
         except Exception: pass
+    finally:
+        callback_router.record(route, time.perf_counter() - started)
 
 
 @bot.message_handler(func=lambda message: str(message.from_user.id) in user_states and message.content_type == 'text')
@@ -755,8 +1438,8 @@ def handle_bot_creation(message):
         logger.info(f"Msg from user {user_id_str} in state '{state}'. Text: '{message.text[:50]}...'")
 
         if state and state.startswith("awaiting_must_join") and message.text.strip().lower() == "/done":
-            user_data.get(user_id_str, {}).pop("current_channel", None)
-            user_data.get(user_id_str, {}).pop("pending_channel_for_admin_check", None)
+            if user_id_str in user_data:
+                user_data.update(user_id_str, {}, remove=("current_channel", "pending_channel_for_admin_check"))
             user_states[user_id_str] = "awaiting_min_withdrawal"
             bot.send_message(message.chat.id, "👍 Channels/Links stage complete.\n\nNow, what should be the <b>minimum withdrawal amount</b> (e.g., <code>100</code>)?", parse_mode="HTML")
             logger.info(f"User {user_id_str} finished must-join via /done from state {state}. Proceeding to min withdrawal.")
@@ -778,8 +1461,16 @@ def handle_bot_creation(message):
                 if not bot_api_username:
                     bot.send_message(message.chat.id, "❌ Token is valid, but could not retrieve bot username. This is unusual. Please try another token or contact support.", reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("🔙 Cancel Creation", callback_data="back_to_main")), parse_mode="HTML")
                     return
-                user_data[user_id_str]["bot_token"] = token
-                user_data[user_id_str]["bot_username"] = f"@{bot_api_username}" # Store with @
+                existing_bot = find_registered_bot(token, bot_api_username)
+                if existing_bot:
+                    if existing_bot["owner"] == user_id_str:
+                        duplicate_msg = f"⚠️ <b>{html.escape(existing_bot['bot_username'])}</b> is already in your bots.\n\nUse 'My Bots' → Edit to change its configuration, or send a different token."
+                    else:
+                        duplicate_msg = "⚠️ This bot is already registered with BotMaker by another user.\n\nPlease create a new bot with @BotFather and send its token."
+                    bot.send_message(message.chat.id, duplicate_msg, reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("🔙 Cancel Creation", callback_data="back_to_main")), parse_mode="HTML")
+                    logger.warning(f"User {user_id_str} tried to register @{bot_api_username}, already registered as {existing_bot['bot_username']} by user {existing_bot['owner']}.")
+                    return
+                user_data.update(user_id_str, {"bot_token": token, "bot_username": f"@{bot_api_username}"}) # Username stored with @
                 user_states[user_id_str] = "awaiting_bot_name"
                 bot.send_message(message.chat.id, f"✅ Bot token is valid for <b>@{bot_api_username}</b>!\n(Username automatically detected).\n\nNow, please enter the <b>display name</b> for your bot (e.g., 'My Awesome Bot'):", parse_mode="HTML")
                 logger.info(f"User {user_id_str} provided valid token for @{bot_api_username}.")
@@ -796,7 +1487,7 @@ def handle_bot_creation(message):
             if len(bot_name) > 64:
                  bot.send_message(message.chat.id, "⚠️ Bot name too long (max 64 chars). Shorter name please.")
                  return
-            user_data[user_id_str]["bot_name"] = bot_name
+            user_data.update(user_id_str, {"bot_name": bot_name})
             user_states[user_id_str] = "awaiting_payment_channel"
             markup = InlineKeyboardMarkup().add(InlineKeyboardButton("❓ How to make bot admin?", callback_data="show_admin_instructions"))
             bot.send_message(message.chat.id, f"👍 Bot name: <b>{html.escape(bot_name)}</b>\nBot Username: <b>{html.escape(user_data[user_id_str]['bot_username'])}</b>\n\nPlease enter the link to your <b>Payment Proof Channel</b> (must be a public Telegram Channel, e.g., <code>https://t.me/MyPaymentProofs</code>).\n\n<i>Your new bot (<b>{html.escape(user_data[user_id_str]['bot_username'])}</b>) <b>must</b> be an <b>administrator</b> in this channel for it to work.</i>", reply_markup=markup, parse_mode="HTML")
@@ -808,7 +1499,7 @@ def handle_bot_creation(message):
             if not match:
                 bot.send_message(message.chat.id, "⚠️ Invalid link format or not a public Telegram Channel link.\n\nPlease provide a direct link like <code>https://t.me/YourChannelName</code> (not a group invite link like t.me/joinchat/... or t.me/+...).", parse_mode="HTML")
                 return
-            user_data[user_id_str]["payment_channel"] = channel_link
+            user_data.update(user_id_str, {"payment_channel": channel_link})
             user_states[user_id_str] = "awaiting_payment_channel_admin_confirm"
             markup = InlineKeyboardMarkup()
             markup.add(InlineKeyboardButton("✅ Done, Bot is Admin", callback_data="payment_channel_admin_done"))
@@ -853,7 +1544,7 @@ def handle_bot_creation(message):
             }
 
             if is_public_telegram_channel:
-                user_data[user_id_str]["pending_channel_for_admin_check"] = temp_channel_data
+                user_data.update(user_id_str, {"pending_channel_for_admin_check": temp_channel_data})
                 user_states[user_id_str] = "awaiting_must_join_public_channel_admin_confirm"
                 markup_mj_admin = InlineKeyboardMarkup()
                 markup_mj_admin.add(InlineKeyboardButton("✅ Done, Bot is Admin", callback_data="must_join_admin_done"))
@@ -867,9 +1558,7 @@ def handle_bot_creation(message):
             else: # For non-Telegram links OR non-public-channel Telegram links (groups, private, etc.)
                 temp_channel_data["check"] = False # Never mandatory by bot for these types
                 temp_channel_data["name"] = f"Link {len(user_data[user_id_str].get('must_join_channels', [])) + 1}"
-                if "must_join_channels" not in user_data[user_id_str]:
-                    user_data[user_id_str]["must_join_channels"] = []
-                user_data[user_id_str]["must_join_channels"].append(temp_channel_data)
+                user_data.update(user_id_str, {"must_join_channels": user_data[user_id_str].get("must_join_channels", []) + [temp_channel_data]})
                 link_type_msg = "Telegram link (group/private)" if is_telegram_link else "External web link"
                 bot.send_message(message.chat.id,
                                  f"{link_type_msg} added: {html.escape(channel_link_input)}\n(This type of link will not have a mandatory join check performed by the bot).\n\n"
@@ -897,7 +1586,7 @@ def handle_bot_creation(message):
                  if min_withdrawal < 0:
                      bot.send_message(message.chat.id, "⚠️ Minimum withdrawal cannot be negative.\nE.g., <code>100</code>.", parse_mode="HTML")
                      return
-                 user_data[user_id_str]["min_withdrawal"] = min_withdrawal
+                 user_data.update(user_id_str, {"min_withdrawal": min_withdrawal})
                  user_states[user_id_str] = "awaiting_max_withdrawal"
                  bot.send_message(message.chat.id, f"Min withdrawal: <b>{min_withdrawal:.2f}</b>\n\n<b>Max withdrawal amount</b> per request? (e.g., <code>1000</code>)", parse_mode="HTML")
                  logger.info(f"User {user_id_str} set min withdrawal to {min_withdrawal}.")
@@ -920,7 +1609,7 @@ def handle_bot_creation(message):
                  if max_withdrawal < min_withdrawal:
                      bot.send_message(message.chat.id, f"⚠️ Max withdrawal (<b>{max_withdrawal:.2f}</b>) must be >= min withdrawal (<b>{min_withdrawal:.2f}</b>).\nRe-enter max amount.", parse_mode="HTML")
                      return
-                 user_data[user_id_str]["max_withdrawal"] = max_withdrawal
+                 user_data.update(user_id_str, {"max_withdrawal": max_withdrawal})
                  user_states[user_id_str] = "awaiting_referral_reward"
                  bot.send_message(message.chat.id, f"Max withdrawal: <b>{max_withdrawal:.2f}</b>\n\nFinally, <b>referral reward amount</b>? (e.g., <code>5</code>, or <code>0</code> for no reward)", parse_mode="HTML")
                  logger.info(f"User {user_id_str} set max withdrawal to {max_withdrawal}.")
@@ -944,7 +1633,7 @@ def handle_bot_creation(message):
                 if referral_reward < 0:
                     bot.send_message(message.chat.id, "⚠️ Referral reward cannot be negative.\nE.g., <code>5</code> or <code>0</code>.", parse_mode="HTML")
                     return
-                user_data[user_id_str]["referral_reward"] = referral_reward
+                user_data.update(user_id_str, {"referral_reward": referral_reward})
                 logger.info(f"User {user_id_str} set referral reward to {referral_reward}.")
 
                 config_data_str = create_config_data(user_id_str)
@@ -954,28 +1643,44 @@ def handle_bot_creation(message):
                     bot.send_message(message.chat.id, "❌ Internal error finalizing config. Please try again.", reply_markup=main_menu_keyboard(), parse_mode="HTML")
                     return
 
-                database = load_database()
-                if user_id_str not in database["users"]: # Should exist from /start
-                    logger.warning(f"User {user_id_str} not in DB at end of creation, which is unusual. Registering.")
-                    database["users"][user_id_str] = {
-                        "username": message.from_user.username if message.from_user.username else "Unknown",
-                        "first_name": message.from_user.first_name if message.from_user.first_name else "Unknown",
-                        "registration_date": time.strftime("%Y-%m-%d %H:%M:%S"), "bots": []
-                    }
-                if "bots" not in database["users"][user_id_str]: database["users"][user_id_str]["bots"] = []
-
                 bot_name_final = user_data.get(user_id_str, {}).get("bot_name", "Unnamed Bot")
                 bot_username_final = user_data.get(user_id_str, {}).get("bot_username", "UnknownUsername") # Includes @
+                bot_token_final = user_data.get(user_id_str, {}).get("bot_token", "")
 
-                new_bot_entry_data = {
-                    "bot_name": bot_name_final,
-                    "bot_username": bot_username_final, # Stored with @
-                    "status": "Pending",
-                    "creation_request_date": time.strftime("%Y-%m-%d %H:%M:%S"),
-                    "config_details": config_data_str
-                }
-                database["users"][user_id_str]["bots"].append(new_bot_entry_data)
-                save_database(database) # Save the database
+                # One registration at a time, so two users submitting the same bot cannot both pass the check
+                with database_lock:
+                    database = load_database()
+                    if user_id_str not in database["users"]: # Should exist from /start
+                        logger.warning(f"User {user_id_str} not in DB at end of creation, which is unusual. Registering.")
+                        count_new_user()
+                        database["users"][user_id_str] = {
+                            "username": message.from_user.username if message.from_user.username else "Unknown",
+                            "first_name": message.from_user.first_name if message.from_user.first_name else "Unknown",
+                            "registration_date": time.strftime("%Y-%m-%d %H:%M:%S"), "bots": []
+                        }
+                    if "bots" not in database["users"][user_id_str]: database["users"][user_id_str]["bots"] = []
+
+                    # The same bot may have been registered while this user was still filling in the wizard
+                    existing_bot = find_registered_bot(bot_token_final, bot_username_final)
+                    if not existing_bot:
+                        new_bot_entry_data = {
+                            "bot_name": bot_name_final,
+                            "bot_username": bot_username_final, # Stored with @
+                            "status": "Pending",
+                            "creation_request_date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                            "config_details": config_data_str,
+                            "token_fingerprint": token_fingerprint(bot_token_final),
+                            "template": user_data.get(user_id_str, {}).get("template", BOT_TEMPLATES[0])
+                        }
+                        database["users"][user_id_str]["bots"].append(new_bot_entry_data)
+                        save_database(database) # Save the database
+                        index_bot(user_id_str, len(database["users"][user_id_str]["bots"]) - 1, new_bot_entry_data)
+                        count_bot_status(None, "Pending")
+                if existing_bot:
+                    logger.warning(f"Bot {bot_username_final} for user {user_id_str} was registered by user {existing_bot['owner']} during setup. Rejecting.")
+                    user_states.pop(user_id_str, None); user_data.pop(user_id_str, None)
+                    bot.send_message(message.chat.id, f"❌ {html.escape(bot_username_final)} has already been registered with BotMaker. Your request was not submitted.", reply_markup=main_menu_keyboard(), parse_mode="HTML")
+                    return
                 logger.info(f"Bot {bot_username_final} for user {user_id_str} saved as Pending. DB updated.")
 
                 payment_channel_final = user_data.get(user_id_str, {}).get("payment_channel", "Not Set")
@@ -1099,16 +1804,20 @@ def stats_command(message):
         bot.reply_to(message, "⛔ You are not authorized for this command.", parse_mode="HTML")
         return
 
-    database = load_database()
-    all_users = database.get("users", {})
-    total_users_count = len(all_users)
-    total_bots_count = 0
-    for user_id_stat in all_users:
-        total_bots_count += len(all_users[user_id_stat].get("bots", []))
+    current_stats = get_registry_stats()
             
     stats_message = f"📊 <b>BotMaker Statistics</b> 📊\n\n"
-    stats_message += f"👥 <b>Total Registered Users:</b> {total_users_count}\n"
-    stats_message += f"🤖 <b>Total Bots Created/Requested:</b> {total_bots_count}\n"
+    stats_message += f"👥 <b>Total Registered Users:</b> {current_stats['total_users']}\n"
+    stats_message += f"🤖 <b>Total Bots Created/Requested:</b> {current_stats['total_bots']}\n"
+    for status_stat, count_stat in sorted(current_stats["bots_by_status"].items()):
+        stats_message += f"   • {html.escape(status_stat)}: {count_stat}\n"
+    depths = bot.worker_pool.queue_depths()
+    stats_message += f"⚙️ <b>Handler Queues:</b> {' / '.join(str(d['depth']) for d in depths)} (peak {max(d['max_depth'] for d in depths)}, handled {sum(d['processed'] for d in depths)})\n"
+    route_timings = callback_router.timing_stats()[:CALLBACK_STATS_ROUTES]
+    if route_timings:
+        stats_message += "\n⏱ <b>Slowest Callback Routes:</b>\n"
+        for entry in route_timings:
+            stats_message += f"  • <code>{html.escape(entry['route'])}</code>: {entry['count']} calls, avg {entry['total'] / entry['count'] * 1000:.0f} ms, max {entry['max'] * 1000:.0f} ms\n"
     bot.send_message(ADMIN_ID, stats_message, parse_mode="HTML")
     logger.info(f"Admin {ADMIN_ID} requested /stats.")
 
@@ -1180,65 +1889,592 @@ def process_broadcast_content(message):
           bot.send_message(ADMIN_ID, "Error generating preview. Broadcast cancelled.", parse_mode="HTML")
           broadcast_temp_data.pop(str(ADMIN_ID), None)
 
-def send_broadcast_messages(admin_id_bc, text_content, photo_file_id, video_file_id, parse_mode_send):
-    db_send = load_database()
-    users_send = db_send.get("users", {})
-    total_users_send = len(users_send)
-    success_s = 0; failed_s = 0; block_s = 0
-    logger.info(f"Starting broadcast to {total_users_send} users.")
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now >= self.updated:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    wait = self.updated - now
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Telegram asked us to back off (retry_after): stop handing out tokens to every worker
+        with self.lock:
+            self.tokens = 0
+            self.updated = max(self.updated, time.monotonic() + seconds)
+
+
+broadcast_limiter = TokenBucket(BROADCAST_RATE_LIMIT)
+broadcast_jobs = {}
+
+
+class BroadcastJob:
+    def __init__(self, admin_id, content, user_ids, job_id=None, status="running", created=None):
+        self.job_id = job_id or uuid.uuid4().hex[:8]
+        self.admin_id = admin_id
+        self.content = content
+        self.user_ids = user_ids
+        self.total = len(user_ids)
+        self.created = created or time.strftime("%Y-%m-%d %H:%M:%S")
+        self.processed = 0
+        self.counts = {"sent": 0, "failed": 0, "blocked": 0}
+        self.status = status
+        self.stop_status = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.log_file = None
+        self.thread = None
+
+    @property
+    def state_path(self):
+        return os.path.join(BROADCAST_DIR, f"{self.job_id}.json")
+
+    @property
+    def log_path(self):
+        return os.path.join(BROADCAST_DIR, f"{self.job_id}.log")
+
+    @classmethod
+    def load(cls, state_path):
+        with open(state_path, "r") as f:
+            state = json.load(f)
+        return cls(state["admin_id"], state["content"], state["user_ids"], job_id=state["job_id"],
+                   status=state["status"], created=state["created"])
+
+    def save(self):
+        os.makedirs(BROADCAST_DIR, exist_ok=True)
+        state = {"job_id": self.job_id, "admin_id": self.admin_id, "content": self.content, "user_ids": self.user_ids,
+                 "status": self.status, "created": self.created}
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    # The result log is the job's cursor: every recipient listed there is done and is skipped on resume
+    def load_results(self):
+        done = set()
+        counts = {"sent": 0, "failed": 0, "blocked": 0}
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] in counts and parts[0] not in done:
+                        done.add(parts[0])
+                        counts[parts[1]] += 1
+        with self.lock:
+            self.counts = counts
+            self.processed = len(done)
+        return done
+
+    def record(self, user_id_str, result):
+        with self.lock:
+            self.processed += 1
+            self.counts[result] += 1
+            self.log_file.write(f"{user_id_str} {result}\n")
+            self.log_file.flush()
+
+    def progress(self):
+        with self.lock:
+            return dict(self.counts, job_id=self.job_id, status=self.status, processed=self.processed, total=self.total)
+
+    def request_stop(self, status):
+        self.stop_status = status
+        self.stopped.set()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+def deliver_broadcast_message(user_id, content):
+    if content["photo_id"]:
+        bot.send_photo(user_id, content["photo_id"], caption=content["text"], parse_mode=content["parse_mode"])
+    elif content["video_id"]:
+        bot.send_video(user_id, content["video_id"], caption=content["text"], parse_mode=content["parse_mode"])
+    elif content["text"]:
+        bot.send_message(user_id, content["text"], parse_mode=content["parse_mode"], disable_web_page_preview=True)
+
+
+def send_broadcast_to_user(user_id_str, content):
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        broadcast_limiter.acquire()
+        try:
+            deliver_broadcast_message(int(user_id_str), content)
+            return "sent"
+        except telebot.apihelper.ApiTelegramException as e_send:
+            if e_send.error_code == 429 and attempt < BROADCAST_MAX_RETRIES:
+                retry_after = ((e_send.result_json or {}).get("parameters") or {}).get("retry_after", 1)
+                logger.warning(f"Broadcast rate limited by Telegram, pausing all workers for {retry_after}s.")
+                broadcast_limiter.pause(retry_after)
+                continue
+            return classify_broadcast_error(user_id_str, e_send)
+        except Exception as e_send:
+            return classify_broadcast_error(user_id_str, e_send)
+    return "failed"
+
+
+def classify_broadcast_error(user_id_str, e_send):
+    error_msg_s = str(e_send).lower()
+    if "forbidden: bot was blocked by the user" in error_msg_s or \
+       "user is deactivated" in error_msg_s or \
+       "chat not found" in error_msg_s or \
+       "bot can't initiate conversation" in error_msg_s:
+        logger.warning(f"Broadcast fail user {user_id_str} (Blocked/Inactive): {e_send}")
+        return "blocked"
+    logger.error(f"Failed broadcast to user {user_id_str}: {e_send}", exc_info=False)
+    return "failed"
+
+
+def broadcast_worker(job, pending_users):
+    while not job.stopped.is_set():
+        try:
+            user_id_s_str = pending_users.get_nowait()
+        except queue.Empty:
+            return
+        job.record(user_id_s_str, send_broadcast_to_user(user_id_s_str, job.content))
+
+
+def format_broadcast_status(progress):
+    return (f"Processed: {progress['processed']} / {progress['total']}\n"
+            f"Sent: {progress['sent']}\nFailed: {progress['failed']}\nBlocked: {progress['blocked']}")
+
+
+def run_broadcast_job(job):
+    done = job.load_results()
+    verb_s = "resumed" if done else "started"
+    logger.info(f"Broadcast {job.job_id} {verb_s}: {job.total - len(done)} of {job.total} users left, {BROADCAST_WORKERS} workers.")
     status_msg_obj = None
     try:
-        status_msg_obj = bot.send_message(admin_id_bc, f"🚀 Broadcasting started...\n\nProcessed: 0 / {total_users_send}\nSent: 0\nFailed: 0\nBlocked: 0", parse_mode="HTML")
+        status_msg_obj = bot.send_message(job.admin_id, f"🚀 Broadcast <code>{job.job_id}</code> {verb_s}...\n\n{format_broadcast_status(job.progress())}", parse_mode="HTML")
     except Exception as e:
         logger.error(f"Failed to send initial broadcast status to admin: {e}")
 
-    last_update_s = time.time()
-    for i, user_id_s_str in enumerate(list(users_send.keys())):
-        try:
-            user_id_s = int(user_id_s_str)
-            if photo_file_id:
-                bot.send_photo(user_id_s, photo_file_id, caption=text_content, parse_mode=parse_mode_send)
-            elif video_file_id:
-                bot.send_video(user_id_s, video_file_id, caption=text_content, parse_mode=parse_mode_send)
-            elif text_content:
-                 bot.send_message(user_id_s, text_content, parse_mode=parse_mode_send, disable_web_page_preview=True)
-            success_s += 1
-        except Exception as e_send:
-             error_msg_s = str(e_send).lower()
-             if "forbidden: bot was blocked by the user" in error_msg_s or \
-                "user is deactivated" in error_msg_s or \
-                "chat not found" in error_msg_s or \
-                "bot can't initiate conversation" in error_msg_s:
-                  block_s += 1
-                  logger.warning(f"Broadcast fail user {user_id_s_str} (Blocked/Inactive): {e_send}")
-             else:
-                  failed_s += 1
-                  logger.error(f"Failed broadcast to user {user_id_s_str}: {e_send}", exc_info=False)
-        time.sleep(0.05) # Be respectful to Telegram API
-
-        processed_count = i + 1
-        if status_msg_obj and (time.time() - last_update_s > 2 or processed_count % 10 == 0 or processed_count == total_users_send) : # Update more frequently
+    pending_users = queue.Queue()
+    for user_id_s_str in job.user_ids:
+        if user_id_s_str not in done:
+            pending_users.put(user_id_s_str)
+    job.log_file = open(job.log_path, "a")
+    workers = [threading.Thread(target=broadcast_worker, args=(job, pending_users), name=f"broadcast-{job.job_id}-{n}", daemon=True)
+               for n in range(BROADCAST_WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    last_text_s = None
+    while any(worker.is_alive() for worker in workers):
+        for worker in workers:
+            worker.join(timeout=BROADCAST_STATUS_INTERVAL / len(workers))
+        update_text_s = f"Broadcasting <code>{job.job_id}</code>...\n\n{format_broadcast_status(job.progress())}"
+        if status_msg_obj and update_text_s != last_text_s:
             try:
-                 update_text_s = f"Broadcasting...\n\nProcessed: {processed_count} / {total_users_send}\nSent: {success_s}\nFailed: {failed_s}\nBlocked: {block_s}"
-                 bot.edit_message_text(update_text_s, chat_id=status_msg_obj.chat.id, message_id=status_msg_obj.message_id, parse_mode="HTML")
-                 last_update_s = time.time()
-            except telebot.apihelper.ApiTelegramException as edit_e_s: # Catch specific error for message not modified
+                bot.edit_message_text(update_text_s, chat_id=status_msg_obj.chat.id, message_id=status_msg_obj.message_id, parse_mode="HTML")
+                last_text_s = update_text_s
+            except telebot.apihelper.ApiTelegramException as edit_e_s:
                 if "message is not modified" not in str(edit_e_s).lower():
                     logger.warning(f"Could not update broadcast status: {edit_e_s}")
             except Exception as edit_e_s:
-                 logger.warning(f"Could not update broadcast status (general error): {edit_e_s}")
-
-
-    final_status_s = f"✅ <b>Broadcast Complete!</b>\n\nProcessed: {total_users_send} / {total_users_send}\nSent: {success_s}\nFailed: {failed_s}\nBlocked/Inactive: {block_s}"
+                logger.warning(f"Could not update broadcast status (general error): {edit_e_s}")
+
+    job.log_file.close()
+    with job.lock:
+        job.status = job.stop_status or "completed"
+    job.save()
+    progress = job.progress()
+    title_s = {"cancelled": "🛑 <b>Broadcast Cancelled</b>", "paused": "⏸ <b>Broadcast Paused</b>"}.get(progress["status"], "✅ <b>Broadcast Complete!</b>")
+    final_status_s = f"{title_s} (<code>{job.job_id}</code>)\n\n{format_broadcast_status(progress)}"
     if status_msg_obj:
         try: bot.edit_message_text(final_status_s, chat_id=status_msg_obj.chat.id, message_id=status_msg_obj.message_id, parse_mode="HTML")
         except Exception: # If edit fails, send new message
-            bot.send_message(admin_id_bc, final_status_s, parse_mode="HTML")
+            bot.send_message(job.admin_id, final_status_s, parse_mode="HTML")
     else:
-        bot.send_message(admin_id_bc, final_status_s, parse_mode="HTML")
-    logger.info(f"Broadcast end. Success: {success_s}, Failed: {failed_s}, Blocked: {block_s}")
+        bot.send_message(job.admin_id, final_status_s, parse_mode="HTML")
+    logger.info(f"Broadcast {job.job_id} end. Success: {progress['sent']}, Failed: {progress['failed']}, Blocked: {progress['blocked']}")
 
 
+def send_broadcast_messages(admin_id_bc, text_content, photo_file_id, video_file_id, parse_mode_send):
+    db_send = load_database()
+    content = {"text": text_content, "photo_id": photo_file_id, "video_id": video_file_id, "parse_mode": parse_mode_send}
+    job = BroadcastJob(admin_id_bc, content, list(db_send.get("users", {}).keys()))
+    broadcast_jobs[job.job_id] = job
+    start_broadcast_job(job)
+    return job
+
+
+def start_broadcast_job(job):
+    job.stop_status = None
+    job.stopped.clear()
+    with job.lock:
+        job.status = "running"
+    job.save()
+    job.thread = threading.Thread(target=run_broadcast_job, args=(job,), name=f"broadcast-{job.job_id}", daemon=True)
+    job.thread.start()
+
+
+def resume_broadcast_jobs():
+    if not os.path.isdir(BROADCAST_DIR):
+        return
+    for file_name in sorted(os.listdir(BROADCAST_DIR)):
+        if not file_name.endswith(".json") or file_name[:-len(".json")] in broadcast_jobs:
+            continue
+        try:
+            job = BroadcastJob.load(os.path.join(BROADCAST_DIR, file_name))
+        except Exception as e:
+            logger.error(f"Could not load broadcast job {file_name}: {e}", exc_info=True)
+            continue
+        broadcast_jobs[job.job_id] = job
+        if job.status == "running":
+            logger.info(f"Resuming interrupted broadcast {job.job_id}.")
+            start_broadcast_job(job)
+        else:
+            job.load_results()
+
+
+@bot.message_handler(commands=['broadcasts'])
+def broadcasts_command(message):
+    if str(message.from_user.id) != str(ADMIN_ID):
+        logger.warning(f"User {message.from_user.id} tried /broadcasts unauthorized.")
+        bot.reply_to(message, "⛔ You are not authorized.", parse_mode="HTML")
+        return
+    args = message.text.split()[1:]
+    if not args:
+        jobs_list = sorted(broadcast_jobs.values(), key=lambda j: j.created, reverse=True)[:10]
+        if not jobs_list:
+            bot.send_message(message.chat.id, "No broadcast jobs yet.")
+            return
+        lines = ["📣 <b>Broadcast Jobs</b>\n"]
+        for job in jobs_list:
+            p_bc = job.progress()
+            lines.append(f"<code>{job.job_id}</code> — {p_bc['status']} — {p_bc['processed']}/{p_bc['total']} "
+                         f"(sent {p_bc['sent']}, failed {p_bc['failed']}, blocked {p_bc['blocked']}) — {job.created}")
+        lines.append("\nUse <code>/broadcasts pause|resume|cancel &lt;id&gt;</code>.")
+        bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+        return
+
+    if len(args) != 2 or args[0] not in ("pause", "resume", "cancel"):
+        bot.send_message(message.chat.id, "Usage: <code>/broadcasts</code> or <code>/broadcasts pause|resume|cancel &lt;id&gt;</code>", parse_mode="HTML")
+        return
+    action, job_id = args
+    job = broadcast_jobs.get(job_id)
+    if not job:
+        bot.send_message(message.chat.id, f"Broadcast <code>{html.escape(job_id)}</code> not found.", parse_mode="HTML")
+        return
+    if action == "resume":
+        if job.is_running() or job.status not in ("paused", "running"):
+            bot.send_message(message.chat.id, f"Broadcast <code>{job_id}</code> is {job.status} and cannot be resumed.", parse_mode="HTML")
+            return
+        start_broadcast_job(job)
+    elif job.is_running():
+        job.request_stop("paused" if action == "pause" else "cancelled")
+    elif action == "cancel" and job.status == "paused":
+        with job.lock:
+            job.status = "cancelled"
+        job.save()
+    else:
+        bot.send_message(message.chat.id, f"Broadcast <code>{job_id}</code> is {job.status}; nothing to {action}.", parse_mode="HTML")
+        return
+    logger.info(f"Admin {ADMIN_ID} requested {action} for broadcast {job_id}.")
+    bot.send_message(message.chat.id, f"✅ Broadcast <code>{job_id}</code>: {action} requested.", parse_mode="HTML")
+
+
+class DeployError(Exception):
+    pass
+
+# Tell the admin when a deployed bot keeps crashing and is no longer restarted automatically
+def notify_crash_loop(child_status):
+    try:
+        bot.send_message(ADMIN_ID, f"🔥 Deployed bot <b>@{html.escape(child_status['name'])}</b> keeps failing "
+                                   f"({html.escape(child_status['last_problem'] or 'unknown')}) and will not be restarted.\n\n"
+                                   f"Check <code>{html.escape(CHILD_LOG_FILE)}</code> in its deploy directory, then use "
+                                   f"<code>/children restart {html.escape(child_status['name'])}</code>.", parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Failed to notify admin of crash loop in {child_status['name']}: {e}", exc_info=True)
+
+deploy_jobs = queue.Queue()
+deploy_supervisor = Supervisor(on_crash_loop=notify_crash_loop)
+atexit.register(deploy_supervisor.stop_all)
+
+def deployment_name(bot_username):
+    return bot_username.strip().lstrip("@")
+
+# Read CONFIG from rendered bot source without running it
+def extract_rendered_config(source):
+    tree = ast.parse(source)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == "CONFIG" for target in node.targets):
+            return ast.literal_eval(node.value)
+    raise DeployError("rendered bot has no CONFIG block")
+
+# Wait until tenant_runtime.py reports the tenant running; raises DeployError if it failed or never picked it up
+def wait_for_tenant(directory):
+    status_path = os.path.join(directory, TENANT_STATUS_FILE)
+    deadline = time.monotonic() + DEPLOY_TENANT_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            with open(status_path, "r") as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            status = {}
+        if status.get("status") == "running":
+            return
+        if status.get("status") == "failed":
+            raise DeployError(f"tenant_runtime.py could not start the bot: {status.get('error')}")
+        time.sleep(1)
+    raise DeployError(f"tenant_runtime.py did not start the bot within {DEPLOY_TENANT_TIMEOUT}s; is it running on '{TENANTS_DIR}'?")
+
+# Render the approved bot's template, start it and wait until it is running and answers getMe
+def deploy_bot(owner_id, bot_username):
+    database = load_database()
+    bot_entry = get_indexed_bot(database, bot_username, owner_id)
+    if bot_entry is None:
+        raise DeployError("the bot is no longer registered")
+    template_key = DEPLOY_TEMPLATE
+    try:
+        parse_config(bot_entry.get("config_details", ""))
+    except ConfigError as e:
+        raise DeployError(f"the bot's CONFIG is invalid: {e}")
+    rendered = render_template(template_key, bot_entry.get("config_details", ""))
+    if rendered is None:
+        raise DeployError(f"template '{template_key}' could not be read")
+
+    # The rendered file must compile, and its CONFIG must carry the token this bot was registered with
+    try:
+        compile(rendered, f"{deployment_name(bot_username)}/bot.py", "exec")
+        config = extract_rendered_config(rendered)
+    except (SyntaxError, ValueError) as e:
+        raise DeployError(f"rendered bot is not valid Python: {e}")
+    token = str(config.get("BOT_TOKEN", ""))
+    if not token or (bot_entry.get("token_fingerprint") and token_fingerprint(token) != bot_entry["token_fingerprint"]):
+        raise DeployError("the rendered CONFIG does not contain this bot's token")
+
+    name = deployment_name(bot_username)
+    if DEPLOY_MODE == "tenant":
+        directory = os.path.join(TENANTS_DIR, name)
+        os.makedirs(directory, exist_ok=True)
+        # A status left by an earlier deploy must not count for this one
+        if os.path.exists(os.path.join(directory, TENANT_STATUS_FILE)):
+            os.remove(os.path.join(directory, TENANT_STATUS_FILE))
+        with open(os.path.join(directory, "config.py"), "w", encoding="utf-8") as f:
+            f.write(bot_entry["config_details"])
+        with open(os.path.join(directory, "tenant.json"), "w") as f:
+            json.dump({"template": template_key, "enabled": True}, f)
+        try:
+            wait_for_tenant(directory)
+        except DeployError:
+            undeploy_bot(bot_username)
+            raise
+    else:
+        directory = os.path.join(DEPLOY_DIR, name)
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, "bot.py.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(rendered)
+        os.replace(tmp_path, os.path.join(directory, "bot.py"))
+        child = deploy_supervisor.start_child(name, directory)
+        time.sleep(DEPLOY_STARTUP_GRACE)
+        if not child.is_running():
+            deploy_supervisor.stop_child(name)
+            raise DeployError(f"the bot exited right after starting (code {child.process.returncode}); see {directory}/bot.log")
+
+    is_valid, info, _ = fetch_bot_info(token)
+    if not is_valid or bot_index_key(info.get("username", "")) != bot_index_key(bot_username):
+        undeploy_bot(bot_username)
+        raise DeployError("getMe failed for the deployed bot's token")
+    return directory
+
+# Stop a deployed bot (its directory and data are kept)
+def undeploy_bot(bot_username):
+    name = deployment_name(bot_username)
+    if deploy_supervisor.stop_child(name):
+        logger.info(f"Stopped deployed bot {bot_username}.")
+    tenant_settings = os.path.join(TENANTS_DIR, name, "tenant.json")
+    if os.path.exists(tenant_settings):
+        with open(tenant_settings, "r") as f:
+            settings = json.load(f)
+        settings["enabled"] = False
+        with open(tenant_settings, "w") as f:
+            json.dump(settings, f)
+        logger.info(f"Disabled tenant {bot_username}.")
+
+def mark_deployed_bot_active(owner_id, bot_username, directory):
+    with database_lock:
+        database = load_database()
+        bot_entry = get_indexed_bot(database, bot_username, owner_id)
+        if bot_entry is None:
+            raise DeployError("the bot was removed while it was being deployed")
+        bot_entry["status"] = "Active"
+        bot_entry["deployment"] = {"mode": DEPLOY_MODE, "directory": directory, "deployed_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+        save_database(database)
+        set_indexed_status(bot_username, "Active")
+
+def deploy_worker():
+    while True:
+        owner_id, bot_username = deploy_jobs.get()
+        started = time.monotonic()
+        try:
+            logger.info(f"Deploying bot {bot_username} for user {owner_id}...")
+            directory = deploy_bot(owner_id, bot_username)
+            try:
+                mark_deployed_bot_active(owner_id, bot_username, directory)
+            except Exception:
+                undeploy_bot(bot_username)
+                raise
+            logger.info(f"Bot {bot_username} for user {owner_id} deployed to {directory} and marked 'Active' in {time.monotonic() - started:.1f}s.")
+            try:
+                bot.send_message(int(owner_id),
+                                 f"🚀 Great news!\n\nYour bot <b>{html.escape(bot_username)}</b> is now <b>Active</b> and ready to use!\n\nYou can start interacting with it.",
+                                 parse_mode="HTML")
+            except Exception as e:
+                logger.error(f"Failed to notify user {owner_id} of bot readiness: {e}", exc_info=True)
+            bot.send_message(ADMIN_ID, f"🚀 Bot <b>{html.escape(bot_username)}</b> (User: {owner_id}) deployed and marked <b>Active</b> in {time.monotonic() - started:.0f}s.", parse_mode="HTML")
+        except Exception as e:
+            logger.error(f"Deploy of bot {bot_username} for user {owner_id} failed: {e}", exc_info=not isinstance(e, DeployError))
+            try:
+                bot.send_message(ADMIN_ID, f"⚠️ Automatic deploy of <b>{html.escape(bot_username)}</b> (User: {owner_id}) failed: {html.escape(str(e))}\n\nIt is still <b>Approved</b>. Deploy it by hand and use 'Mark as Active', or cancel it.", parse_mode="HTML")
+            except Exception as notify_err:
+                logger.error(f"Failed to notify admin of deploy failure: {notify_err}")
+
+def start_deploy_workers():
+    for i in range(DEPLOY_WORKERS):
+        threading.Thread(target=deploy_worker, name=f"deploy-{i}", daemon=True).start()
+
+# Restart the child processes of bots deployed before this run (tenant mode bots belong to tenant_runtime.py)
+def start_deployed_bots():
+    if DEPLOY_MODE != "process" or not os.path.isdir(DEPLOY_DIR):
+        return
+    for name in sorted(os.listdir(DEPLOY_DIR)):
+        directory = os.path.join(DEPLOY_DIR, name)
+        indexed = lookup_bot(name)
+        if indexed and indexed["status"] == "Active" and os.path.exists(os.path.join(directory, "bot.py")):
+            try:
+                deploy_supervisor.start_child(name, directory)
+            except Exception as e:
+                logger.error(f"Could not start deployed bot {name}: {e}", exc_info=True)
+
+# Short "1d 2h", "3h 4m", "5m 6s" form of a number of seconds
+def format_duration(seconds):
+    seconds = int(seconds)
+    days, hours, minutes = seconds // 86400, seconds // 3600 % 24, seconds // 60 % 60
+    if days:
+        return f"{days}d {hours}h"
+    if hours:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m {seconds % 60}s"
+
+@bot.message_handler(commands=['children'])
+def children_command(message):
+    if str(message.from_user.id) != str(ADMIN_ID):
+        logger.warning(f"User {message.from_user.id} tried /children unauthorized.")
+        bot.reply_to(message, "⛔ You are not authorized.", parse_mode="HTML")
+        return
+    args = message.text.split()[1:]
+    if not args:
+        children = sorted(deploy_supervisor.status(), key=lambda c: c["name"].lower())
+        if not children:
+            bot.send_message(message.chat.id, "No deployed bots are running in this process." if DEPLOY_MODE == "process"
+                             else "Deployed bots run in tenant_runtime.py (tenant mode); nothing is supervised here.")
+            return
+        state_icons = {"running": "🟢", "stopping": "🟡", "backoff": "🟡", "crash-loop": "🔴"}
+        lines = [f"🧩 <b>Deployed Bots</b> ({len(children)})\n"]
+        for child in children:
+            line = f"{state_icons.get(child['state'], '⚪')} <b>@{html.escape(child['name'])}</b> — {child['state']}, restarts {child['restarts']}"
+            if child["pid"]:
+                line += f"\n   pid {child['pid']}, up {format_duration(child['uptime'])}, {child['rss_mb']:.0f} MB, CPU {child['cpu_percent']:.0f}%"
+                if child["heartbeat_age"] is not None:
+                    line += f", heartbeat {child['heartbeat_age']:.0f}s ago"
+            if child["last_problem"]:
+                line += f"\n   last failure: {html.escape(child['last_problem'])}"
+            lines.append(line)
+        lines.append("\nUse <code>/children restart|stop &lt;bot&gt;</code>.")
+        bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+        return
+
+    if len(args) != 2 or args[0] not in ("restart", "stop"):
+        bot.send_message(message.chat.id, "Usage: <code>/children</code> or <code>/children restart|stop &lt;bot&gt;</code>", parse_mode="HTML")
+        return
+    action, name = args[0], deployment_name(args[1])
+    done = deploy_supervisor.restart_child(name) if action == "restart" else deploy_supervisor.stop_child(name)
+    if not done:
+        bot.send_message(message.chat.id, f"No deployed bot <code>{html.escape(name)}</code> is supervised here.", parse_mode="HTML")
+        return
+    logger.info(f"Admin {ADMIN_ID} requested {action} of deployed bot {name}.")
+    bot.send_message(message.chat.id, f"✅ <b>@{html.escape(name)}</b>: {action} done.", parse_mode="HTML")
+
+webhook_updates = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+webhook_secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+        if not hmac.compare_digest(self.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), webhook_secret):
+            logger.warning(f"Rejected webhook request from {self.client_address[0]}: bad secret token.")
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = 0
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            self.send_error(400)
+            return
+        try:
+            update_json = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error(400)
+            return
+        try:
+            webhook_updates.put_nowait(update_json)
+        except queue.Full:
+            logger.warning("Webhook update queue is full; asking Telegram to redeliver.")
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(f"Webhook {self.client_address[0]}: {format % args}")
+
+def webhook_worker():
+    while True:
+        update_json = webhook_updates.get()
+        try:
+            bot.process_new_updates([telebot.types.Update.de_json(update_json)])
+        except Exception as e:
+            logger.error(f"Error handling webhook update {update_json.get('update_id')}: {e}", exc_info=True)
+
+def start_webhook_server():
+    # A single dispatcher keeps updates in arrival order; handlers still run on the per-chat pool,
+    # whose bounded queues back up into webhook_updates and from there into 503s for Telegram
+    threading.Thread(target=webhook_worker, name="webhook-dispatcher", daemon=True).start()
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookRequestHandler)
+    server.daemon_threads = True
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{server.server_port}{WEBHOOK_PATH}")
+    return server
+
+def run_webhook():
+    server = start_webhook_server()
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=webhook_secret)
+    logger.info(f"Webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
 if __name__ == "__main__":
     logger.info("--- Starting BotMaker Bot ---")
     logger.info(f"Token: ...{TOKEN[-6:]}")
@@ -1262,7 +2498,26 @@ if __name__ == "__main__":
         logger.critical(f"BOT CONNECTION FAILED! Check Network or Token. Error: {conn_err_main}", exc_info=True)
         exit(1)
 
+    resume_broadcast_jobs()
+    if DEPLOY_ENABLED:
+        if DEPLOY_TEMPLATE not in DEPLOYABLE_TEMPLATES:
+            logger.critical(f"DEPLOY_TEMPLATE '{DEPLOY_TEMPLATE}' cannot be deployed; use one of {', '.join(DEPLOYABLE_TEMPLATES)} or set DEPLOY_ENABLED = False")
+            exit(1)
+        try:
+            load_templates(required=[DEPLOY_TEMPLATE])  # Templates are read and prepared once; restart the maker after editing one
+        except TemplateError as e:
+            logger.critical(f"Cannot deploy bots: {e}")
+            exit(1)
+        start_deploy_workers()
+    start_deployed_bots()
+
+    if WEBHOOK_URL:
+        logger.info("Starting bot in webhook mode...")
+        run_webhook()
+        exit(0)
+
     logger.info("Starting bot polling loop...")
+    bot.remove_webhook()  # getUpdates is refused while a webhook from an earlier webhook-mode run is set
     while True:
         try:
             bot.polling(none_stop=True, interval=0, timeout=30)
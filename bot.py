@@ -1,108 +1,142 @@
 import telebot
+import requests
 import re
-import os
-import tempfile
 import traceback
+import json
+import queue
+import threading
+import hmac
+import secrets
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from template_renderer import TEMPLATES, ConfigError, prepared_templates, load_templates, parse_config, render_template
 
 # Bot token
 BOT_TOKEN = ""
 bot = telebot.TeleBot(BOT_TOKEN)
 
+# Update handlers run on HANDLER_WORKERS threads; updates from one chat always go to the same thread
+HANDLER_WORKERS = 4
+HANDLER_QUEUE_SIZE = 100  # Updates waiting per handler thread before dispatch blocks
+
+# Bot API connection pool
+HTTP_POOL_SIZE = HANDLER_WORKERS + 1
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 30
+
+def create_http_session():
+    """Create a keep-alive session that retries only failed connections and 502/503/504 on GETs"""
+    session = requests.Session()
+    retries = Retry(total=3, connect=3, read=0, status=2, backoff_factor=0.5,
+                    status_forcelist=(502, 503, 504), allowed_methods=frozenset(["GET"]))
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE, max_retries=retries, pool_block=True)
+    session.mount("https://", adapter)
+    return session
+
+telebot.apihelper.session = create_http_session()
+telebot.apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+telebot.apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+
+class ChatWorkerPool:
+    """Drop-in replacement for telebot's worker pool: every update is hashed by chat id onto one
+    worker queue, so one user's updates run in order while different users run in parallel"""
+
+    def __init__(self, telebot_instance, num_workers, queue_size=0):
+        self.telebot = telebot_instance
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(num_workers)]
+        self.exception_event = threading.Event()
+        self.exception_info = None
+        self.running = True
+        self.workers = [threading.Thread(target=self._work, args=(i,), name=f"chat-worker-{i}", daemon=True) for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    @staticmethod
+    def chat_key(update):
+        chat = getattr(update, "chat", None) or getattr(getattr(update, "message", None), "chat", None)
+        if chat is not None:
+            return chat.id
+        user = getattr(update, "from_user", None)
+        return user.id if user is not None else 0
+
+    def put(self, func, *args, **kwargs):
+        index = self.chat_key(args[0]) % len(self.queues) if args else 0
+        self.queues[index].put((func, args, kwargs))
+
+    def _work(self, index):
+        tasks = self.queues[index]
+        while self.running:
+            try:
+                func, args, kwargs = tasks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                handled = self.telebot.exception_handler.handle(e) if self.telebot.exception_handler else False
+                if not handled:
+                    print(f"Error in update handler: {e}")
+                    traceback.print_exc()
+                    # Surfaced by the polling loop like telebot's own pool does
+                    self.exception_info = e
+                    self.exception_event.set()
+
+    def raise_exceptions(self):
+        if self.exception_event.is_set():
+            raise self.exception_info
+
+    def clear_exceptions(self):
+        self.exception_event.clear()
+
+    def close(self):
+        self.running = False
+        for worker in self.workers:
+            if worker is not threading.current_thread():
+                worker.join()
+
+bot.worker_pool.close()
+bot.worker_pool = ChatWorkerPool(bot, HANDLER_WORKERS, HANDLER_QUEUE_SIZE)
+
+# Webhook mode: set WEBHOOK_URL to the public https base URL (e.g. behind a TLS-terminating
+# reverse proxy forwarding to WEBHOOK_HOST:WEBHOOK_PORT). Leave it empty to use long polling.
+WEBHOOK_URL = ""
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""  # Generated per run if empty
+WEBHOOK_QUEUE_SIZE = 500
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+MAX_CONFIG_ERRORS = 10  # Problems listed when a forwarded configuration is rejected
+
 # Store user states and data
 user_states = {}
 user_configs = {}
 
-# Template files content
-TEMPLATES = {
-    'naira': 'nairabot_template.py',
-    'ton': 'tonbot_template.py',
-    'star': 'starbot_template.py'
-}
-
 def extract_config_from_message(message_text):
-    """Extract configuration dictionary from the forwarded message"""
-    try:
-        # Find the CONFIG section
-        config_start = message_text.find('CONFIG = {')
-        if config_start == -1:
-            return None
-            
-        # Find the matching closing brace
-        brace_count = 0
-        config_end = config_start
-        in_config = False
-        
-        for i, char in enumerate(message_text[config_start:], config_start):
-            if char == '{':
-                brace_count += 1
-                in_config = True
-            elif char == '}':
-                brace_count -= 1
-                if in_config and brace_count == 0:
-                    config_end = i + 1
-                    break
-        
-        config_text = message_text[config_start:config_end]
-        return config_text
-    except Exception as e:
-        print(f"Error extracting config: {e}")
-        return None
+    """Extract the CONFIG block from the forwarded message and validate it against CONFIG_SCHEMA
 
-def read_template_file(template_name):
-    """Read the template file content"""
-    try:
-        template_file = TEMPLATES.get(template_name)
-        if not template_file:
-            print(f"Template '{template_name}' not found in TEMPLATES")
-            return None
-            
-        if not os.path.exists(template_file):
-            print(f"Template file does not exist: {template_file}")
-            return None
-        
-        with open(template_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-            print(f"Successfully read template file: {template_file} ({len(content)} chars)")
-            return content
-    except Exception as e:
-        print(f"Error reading template file {template_name}: {e}")
-        traceback.print_exc()
-        return None
+    Returns the `CONFIG = {...}` source; raises ConfigError listing every problem found.
+    """
+    config_text, _ = parse_config(message_text)
+    return config_text
 
-def replace_config_in_template(template_content, new_config):
-    """Replace the configuration in template file (lines 19-47)"""
-    try:
-        lines = template_content.split('\n')
-        
-        # Remove lines 18-46 (0-indexed, so 18-46 covers lines 19-47)
-        if len(lines) >= 47:
-            # Keep lines before config
-            before_config = lines[:18]
-            # Keep lines after config
-            after_config = lines[47:]
-            
-            # Insert new config
-            new_lines = before_config + [new_config] + after_config
-            return '\n'.join(new_lines)
-        else:
-            # If template is shorter, just append the config
-            return template_content + '\n\n' + new_config
-            
-    except Exception as e:
-        print(f"Error replacing config: {e}")
-        traceback.print_exc()
-        return None
+def config_error_text(error):
+    """Reply explaining why a forwarded configuration was rejected"""
+    shown = error.errors[:MAX_CONFIG_ERRORS]
+    text = "❌ The configuration was rejected:\n\n" + "\n".join(f"• {problem}" for problem in shown)
+    if len(error.errors) > len(shown):
+        text += f"\n• ...and {len(error.errors) - len(shown)} more"
+    return text + "\n\nPlease fix it and forward the configuration message again."
 
 def create_template_keyboard():
     """Create inline keyboard for template selection"""
     markup = InlineKeyboardMarkup(row_width=1)
     
-    # Only add buttons for templates that exist
-    available_templates = []
-    for template_name, template_file in TEMPLATES.items():
-        if os.path.exists(template_file):
-            available_templates.append(template_name)
+    # Only add buttons for templates that were loaded at startup
+    available_templates = [template_name for template_name in TEMPLATES if template_name in prepared_templates]
     
     if not available_templates:
         # No templates available, create a message about it
@@ -116,6 +150,12 @@ def create_template_keyboard():
             buttons.append(InlineKeyboardButton("🪙 TON Bot Template", callback_data="template_ton"))
         elif template_name == 'star':
             buttons.append(InlineKeyboardButton("⭐ Star Bot Template", callback_data="template_star"))
+        elif template_name == 'naira_async':
+            buttons.append(InlineKeyboardButton("💰 Naira Bot Template (asyncio)", callback_data="template_naira_async"))
+        elif template_name == 'ton_async':
+            buttons.append(InlineKeyboardButton("🪙 TON Bot Template (asyncio)", callback_data="template_ton_async"))
+        elif template_name == 'star_async':
+            buttons.append(InlineKeyboardButton("⭐ Star Bot Template (asyncio)", callback_data="template_star_async"))
     
     markup.add(*buttons)
     return markup
@@ -123,10 +163,7 @@ def create_template_keyboard():
 @bot.message_handler(commands=['start'])
 def start_command(message):
     # Check which templates are available
-    available_templates = []
-    for template_name, template_file in TEMPLATES.items():
-        if os.path.exists(template_file):
-            available_templates.append(template_name.upper())
+    available_templates = [template_name.upper() for template_name in TEMPLATES if template_name in prepared_templates]
     
     if available_templates:
         templates_text = f"Available templates: {', '.join(available_templates)}"
@@ -153,42 +190,44 @@ def handle_message(message):
         
         # Check if this is a forwarded configuration message
         if message.text and "New Bot Creation Request" in message.text and "CONFIG = {" in message.text:
-            # Extract configuration
-            config = extract_config_from_message(message.text)
+            # Extract and validate configuration
+            try:
+                config = extract_config_from_message(message.text)
+            except ConfigError as e:
+                print(f"Config rejected for user {user_id}: {e}")
+                bot.reply_to(message, config_error_text(e))
+                return
             
-            if config:
-                user_configs[user_id] = config
-                user_states[user_id] = 'waiting_template'
-                
-                print(f"Config stored for user {user_id}")
-                print(f"Config preview: {config[:100]}...")
-                
-                keyboard = create_template_keyboard()
-                if keyboard:
-                    bot.reply_to(message, 
-                        "✅ Configuration extracted successfully!\n\n"
-                        "Please select the bot template you'd like to use:",
-                        reply_markup=keyboard)
-                else:
-                    bot.reply_to(message, 
-                        "✅ Configuration extracted successfully!\n\n"
-                        "❌ However, no template files are available. "
-                        "Please contact the bot administrator to add template files.")
+            user_configs[user_id] = config
+            user_states[user_id] = 'waiting_template'
+            
+            print(f"Config stored for user {user_id}")
+            print(f"Config preview: {config[:100]}...")
+            
+            keyboard = create_template_keyboard()
+            if keyboard:
+                bot.reply_to(message, 
+                    "✅ Configuration extracted successfully!\n\n"
+                    "Please select the bot template you'd like to use:",
+                    reply_markup=keyboard)
             else:
                 bot.reply_to(message, 
-                    "❌ Could not extract configuration from the message. "
-                    "Please make sure you forwarded a valid configuration message.")
+                    "✅ Configuration extracted successfully!\n\n"
+                    "❌ However, no template files are available. "
+                    "Please contact the bot administrator to add template files.")
         
         elif user_id in user_states and user_states[user_id] == 'waiting_config':
             # This handles the case where user sends config after selecting template
             if message.text and "CONFIG = {" in message.text:
-                config = extract_config_from_message(message.text)
-                if config:
-                    user_configs[user_id] = config
-                    # Process with previously selected template
-                    process_bot_creation(message, user_states.get(f"{user_id}_template"))
-                else:
-                    bot.reply_to(message, "❌ Invalid configuration format. Please forward a valid configuration message.")
+                try:
+                    config = extract_config_from_message(message.text)
+                except ConfigError as e:
+                    print(f"Config rejected for user {user_id}: {e}")
+                    bot.reply_to(message, config_error_text(e))
+                    return
+                user_configs[user_id] = config
+                # Process with previously selected template
+                process_bot_creation(message, user_states.get(f"{user_id}_template"))
             else:
                 bot.reply_to(message, "Please forward a valid configuration message containing 'CONFIG = {'")
         
@@ -259,21 +298,11 @@ def process_bot_creation_from_callback(call, template_type):
             )
             return
         
-        # Read template file
-        template_content = read_template_file(template_type)
-        if not template_content:
-            bot.edit_message_text(
-                f"❌ Could not read {template_type} template file. Template file '{TEMPLATES.get(template_type)}' is missing or unreadable.",
-                call.message.chat.id,
-                call.message.message_id
-            )
-            return
-        
-        # Replace config in template
-        new_bot_content = replace_config_in_template(template_content, config)
+        # Render the preloaded template with this config
+        new_bot_content = render_template(template_type, config)
         if not new_bot_content:
             bot.edit_message_text(
-                "❌ Could not process the template. Please try again.",
+                f"❌ Could not read {template_type} template file. Template file '{TEMPLATES.get(template_type)}' is missing or unreadable.",
                 call.message.chat.id,
                 call.message.message_id
             )
@@ -289,11 +318,6 @@ def process_bot_creation_from_callback(call, template_type):
         except:
             pass
         
-        # Create temporary file
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False, encoding='utf-8') as tmp_file:
-            tmp_file.write(new_bot_content)
-            tmp_file_path = tmp_file.name
-        
         # Update message to show completion
         bot.edit_message_text(
             f"✅ {template_type.upper()} bot created successfully!",
@@ -304,19 +328,16 @@ def process_bot_creation_from_callback(call, template_type):
         # Send file to user
         filename = f"{bot_name}_{template_type}_bot.py"
         
-        with open(tmp_file_path, 'rb') as file:
-            bot.send_document(
-                call.message.chat.id,
-                file,
-                caption=f"🤖 Your {template_type.upper()} bot is ready!\n\n"
-                       f"📁 Filename: {filename}\n"
-                       f"✅ Configuration applied successfully!\n\n"
-                       f"You can now run this bot file.",
-                visible_file_name=filename
-            )
+        bot.send_document(
+            call.message.chat.id,
+            new_bot_content.encode('utf-8'),
+            caption=f"🤖 Your {template_type.upper()} bot is ready!\n\n"
+                   f"📁 Filename: {filename}\n"
+                   f"✅ Configuration applied successfully!\n\n"
+                   f"You can now run this bot file.",
+            visible_file_name=filename
+        )
         
-        # Clean up
-        os.unlink(tmp_file_path)
         cleanup_user_data(user_id)
             
         bot.send_message(call.message.chat.id, "✅ Bot created successfully! You can create another bot by forwarding a new configuration message.")
@@ -344,21 +365,11 @@ def process_bot_creation(message, template_type):
         # Send processing message
         processing_msg = bot.send_message(message.chat.id, f"🔄 Creating your {template_type.upper()} bot...")
         
-        # Read template file
-        template_content = read_template_file(template_type)
-        if not template_content:
-            bot.edit_message_text(
-                f"❌ Could not read {template_type} template file. Template file '{TEMPLATES.get(template_type)}' is missing or unreadable.",
-                message.chat.id,
-                processing_msg.message_id
-            )
-            return
-        
-        # Replace config in template
-        new_bot_content = replace_config_in_template(template_content, config)
+        # Render the preloaded template with this config
+        new_bot_content = render_template(template_type, config)
         if not new_bot_content:
             bot.edit_message_text(
-                "❌ Could not process the template. Please try again.",
+                f"❌ Could not read {template_type} template file. Template file '{TEMPLATES.get(template_type)}' is missing or unreadable.",
                 message.chat.id,
                 processing_msg.message_id
             )
@@ -374,30 +385,22 @@ def process_bot_creation(message, template_type):
         except:
             pass
         
-        # Create temporary file
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False, encoding='utf-8') as tmp_file:
-            tmp_file.write(new_bot_content)
-            tmp_file_path = tmp_file.name
-        
         # Delete processing message
         bot.delete_message(message.chat.id, processing_msg.message_id)
         
         # Send file to user
         filename = f"{bot_name}_{template_type}_bot.py"
         
-        with open(tmp_file_path, 'rb') as file:
-            bot.send_document(
-                message.chat.id,
-                file,
-                caption=f"🤖 Your {template_type.upper()} bot is ready!\n\n"
-                       f"📁 Filename: {filename}\n"
-                       f"✅ Configuration applied successfully!\n\n"
-                       f"You can now run this bot file.",
-                visible_file_name=filename
-            )
+        bot.send_document(
+            message.chat.id,
+            new_bot_content.encode('utf-8'),
+            caption=f"🤖 Your {template_type.upper()} bot is ready!\n\n"
+                   f"📁 Filename: {filename}\n"
+                   f"✅ Configuration applied successfully!\n\n"
+                   f"You can now run this bot file.",
+            visible_file_name=filename
+        )
         
-        # Clean up
-        os.unlink(tmp_file_path)
         cleanup_user_data(user_id)
             
         bot.send_message(message.chat.id, "✅ Bot created successfully! You can create another bot by forwarding a new configuration message.")
@@ -417,17 +420,17 @@ def cleanup_user_data(user_id):
         del user_states[f"{user_id}_template"]
 
 def check_template_files():
-    """Check which template files exist and report status"""
+    """Load and prepare the template files once, and report status"""
+    load_templates()
     print("\n📋 Template File Status:")
     print("-" * 40)
     
     all_exist = True
     for template_name, template_file in TEMPLATES.items():
-        if os.path.exists(template_file):
-            file_size = os.path.getsize(template_file)
-            print(f"✅ {template_name.upper()}: {template_file} ({file_size} bytes)")
+        if template_name in prepared_templates:
+            print(f"✅ {template_name.upper()}: {template_file} ({prepared_templates[template_name].size} chars)")
         else:
-            print(f"❌ {template_name.upper()}: {template_file} (NOT FOUND)")
+            print(f"❌ {template_name.upper()}: {template_file} (NOT FOUND or not valid Python)")
             all_exist = False
     
     print("-" * 40)
@@ -440,6 +443,75 @@ def check_template_files():
     
     return all_exist
 
+webhook_updates = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+webhook_secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """Accept Telegram updates posted to WEBHOOK_PATH and queue them for the dispatcher"""
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+        if not hmac.compare_digest(self.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), webhook_secret):
+            print(f"Rejected webhook request from {self.client_address[0]}: bad secret token")
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = 0
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            self.send_error(400)
+            return
+        try:
+            update_json = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error(400)
+            return
+        try:
+            webhook_updates.put_nowait(update_json)
+        except queue.Full:
+            # Telegram redelivers updates that get a non-2xx answer
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def webhook_worker():
+    """Hand queued webhook updates to the per-chat handler pool, in arrival order"""
+    while True:
+        update_json = webhook_updates.get()
+        try:
+            bot.process_new_updates([telebot.types.Update.de_json(update_json)])
+        except Exception as e:
+            print(f"Error handling webhook update {update_json.get('update_id')}: {e}")
+            traceback.print_exc()
+
+def start_webhook_server():
+    """Start the webhook HTTP server and its dispatcher thread"""
+    # A single dispatcher keeps updates in arrival order; handlers run on the same per-chat pool as
+    # polling, whose bounded queues back up into webhook_updates and from there into 503s for Telegram
+    threading.Thread(target=webhook_worker, name="webhook-dispatcher", daemon=True).start()
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookRequestHandler)
+    server.daemon_threads = True
+    print(f"🌐 Webhook server listening on {WEBHOOK_HOST}:{server.server_port}{WEBHOOK_PATH}")
+    return server
+
+def run_webhook():
+    """Register the webhook with Telegram and serve updates until interrupted"""
+    server = start_webhook_server()
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=webhook_secret, max_connections=HANDLER_WORKERS)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
 if __name__ == "__main__":
     print("🤖 Bot Template Creator is starting...")
     
@@ -449,7 +521,11 @@ if __name__ == "__main__":
     print("\nBot is ready to receive configuration messages!")
     
     try:
-        bot.polling(none_stop=True, timeout=60, long_polling_timeout=60)
+        if WEBHOOK_URL:
+            run_webhook()
+        else:
+            bot.remove_webhook()
+            bot.polling(none_stop=True, timeout=60, long_polling_timeout=60)
     except KeyboardInterrupt:
         print("\n🛑 Bot stopped by user")
     except Exception as e:
@@ -0,0 +1,1866 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from telebot import types, util, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+import logging
+import datetime
+import sqlite3
+import copy
+import uuid
+import atexit
+import signal
+import sys
+from types import MappingProxyType
+from collections import OrderedDict
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Configuration
+CONFIG = {
+    "BOT_TOKEN": "",  # Replace with your actual bot token
+    "ADMIN_ID": 6341715879,  # Replace with your Telegram ID
+    "REFERRAL_REWARD": 50,  # Naira reward for referrals
+    "MIN_WITHDRAWAL": 100,  # Minimum withdrawal amount
+    "MAX_WITHDRAWAL": 200,  # Maximum withdrawal amount
+    "WITHDRAWAL_ENABLED": True,  # Set to False to disable withdrawals
+    "MUST_JOIN_CHANNELS": [
+        {"name": "Telegram Channel", "url": "https://t.me/tenocoofficial", "check": True},
+        {"name": "WhatsApp Group 1", "url": "https://chat.whatsapp.com/HaHHnbKmsol7ydJWDMId7h", "check": False},
+         {"name": "WhatsApp Channel", "url": "https://whatsapp.com/channel/0029Vb5bMeGL2AU0ydO03l3p", "check": False},
+          {"name": "Telegram Group 1", "url": "https://t.me/+-E0CYuv1doszMTVk", "check": False},
+        {"name": "Telegram Channel 2", "url": "https://t.me/Lucky_cash_channel", "check": False},
+        {"name": "Telegram Channel 3", "url": "https://t.me/AyCryptoz_2", "check": False},
+        {"name": "Telegram Channel 4", "url": "https://t.me/KINGROGGISALPHA", "check": False},
+        
+        {"name": "Mammon's Payment Channel", "url": "https://t.me/mammons_channel", "check": True}
+    ],
+    
+    "TASKS": [
+        {"name": "Task 1", "url": "https://t.me/tenocoofficial", "reward": 10},
+        {"name": "Task 2", "url": "https://t.me/Lucky_cash_channel", "reward": 15},
+         {"name": "Task 3", "url": "https://t.me/AyCryptoz_2", "reward": 15},
+          {"name": "Task 4", "url": "https://t.me/KINGROGGISALPHA", "reward": 15}
+    ],
+    "PAYMENT_CHANNEL": "https://t.me/mammons_channel",
+    "BOT_USERNAME": "@Macleo_bot",
+    "BOT_NAME": "Mammon"
+}
+
+# File paths
+DATABASE_FILE = "database.json"
+SQLITE_DATABASE_FILE = "database.db"
+JOURNAL_FILE = "database.journal"
+SNAPSHOT_FILE = "database.snapshot.json"
+CONFIG_FILE = "config.json"
+STATS_FILE = "stats.json"
+
+# Storage engine for user data: "sqlite" (one row per user), "json" (in-memory, flushed to
+# database.json) or "journal" (in-memory, every change appended to database.journal)
+STORAGE_ENGINE = "sqlite"
+FLUSH_INTERVAL = 5  # Seconds between background flushes of the json engine
+FLUSH_EVERY_MUTATIONS = 100  # Flush the json engine early after this many changes
+JOURNAL_COMPACT_BYTES = 4 * 1024 * 1024  # Compact the journal into a new snapshot past this size
+STATS_FLUSH_INTERVAL = 10  # Seconds between writes of the in-memory stats counters to stats.json
+BROADCAST_DIR = "broadcasts"  # Job state (<id>.json) and per-recipient result logs (<id>.log)
+BROADCAST_DELAY = 0.05  # Seconds between broadcast messages to stay under Telegram's rate limits
+MEMBERSHIP_CACHE_SIZE = 10000  # Most (channel, user) membership results kept in memory
+MEMBERSHIP_TTL = 300  # Seconds a "member" result is trusted
+MEMBERSHIP_NEGATIVE_TTL = 5  # Seconds a "not a member" result is trusted (kept short: users verify right after joining)
+VERIFY_TIMEOUT = 10  # Seconds a verify click may wait for all channel checks; unfinished ones count as unknown and the user is asked to retry
+
+
+# Initialize bot. Handlers are coroutines; blocking storage calls are run with asyncio.to_thread
+bot = AsyncTeleBot(CONFIG["BOT_TOKEN"])
+
+# User withdrawal states
+user_withdrawal_data = {}
+
+# Ensure files exist
+def ensure_files_exist():
+    try:
+        # Ensure database.json exists
+        if not os.path.exists(DATABASE_FILE):
+            with open(DATABASE_FILE, 'w') as f:
+                json.dump({}, f)
+            logger.info(f"Created {DATABASE_FILE}")
+
+        # Ensure config.json exists
+        if not os.path.exists(CONFIG_FILE):
+            with open(CONFIG_FILE, 'w') as f:
+                json.dump(CONFIG, f, indent=4)
+            logger.info(f"Created {CONFIG_FILE}")
+        else:
+            # Load existing config and ensure it has all required keys
+            with open(CONFIG_FILE, 'r') as f:
+                existing_config = json.load(f)
+
+            # Check if all required keys exist, otherwise add them
+            updated = False
+            for key, value in CONFIG.items():
+                if key not in existing_config:
+                    existing_config[key] = value
+                    updated = True
+
+            if updated:
+                with open(CONFIG_FILE, 'w') as f:
+                    json.dump(existing_config, f, indent=4)
+                logger.info(f"Updated {CONFIG_FILE} with missing keys")
+
+        # Ensure stats.json exists
+        if not os.path.exists(STATS_FILE):
+            with open(STATS_FILE, 'w') as f:
+                json.dump({
+                    "total_users": 0,
+                    "messages_received": 0,
+                    "messages_sent": 0,
+                    "withdrawals": 0,
+                    "total_withdrawal_amount": 0,
+                    "total_referrals": 0,
+                    "start_date": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+                    "blocked_users": 0
+                }, f)
+            logger.info(f"Created {STATS_FILE}")
+    except Exception as e:
+        logger.error(f"Error ensuring files exist: {e}")
+
+# Make a read-only copy of a config value (dicts become mapping proxies, lists tuples)
+def freeze_config(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze_config(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze_config(item) for item in value)
+    return value
+
+# Parsed config.json shared by all handler threads, keyed by the file's mtime and size
+config_cache = {"signature": None, "config": None}
+config_cache_lock = threading.Lock()
+
+# Load configuration from config.json (re-parsed only when the file changes on disk)
+def load_config():
+    try:
+        file_stat = os.stat(CONFIG_FILE)
+    except FileNotFoundError:
+        return freeze_config(CONFIG)
+    except Exception as e:
+        logger.error(f"Error loading config: {e}")
+        return config_cache["config"] or freeze_config(CONFIG)
+
+    signature = (file_stat.st_mtime_ns, file_stat.st_size)
+    with config_cache_lock:
+        if config_cache["signature"] == signature:
+            return config_cache["config"]
+        try:
+            with open(CONFIG_FILE, 'r') as f:
+                config = freeze_config(json.load(f))
+        except Exception as e:
+            # Keep serving the last good config (e.g. while the file is being edited)
+            logger.error(f"Error loading config: {e}")
+            return config_cache["config"] or freeze_config(CONFIG)
+        if config_cache["config"] is not None and config_cache["config"].get("MUST_JOIN_CHANNELS") != config.get("MUST_JOIN_CHANNELS"):
+            membership_cache.clear()  # Cached results may be for channels that are no longer required
+        config_cache["signature"] = signature
+        config_cache["config"] = config
+        return config
+
+# Save configuration to config.json
+def save_config(config_data):
+    try:
+        with open(CONFIG_FILE, 'w') as f:
+            json.dump(config_data, f, indent=4)
+    except Exception as e:
+        logger.error(f"Error saving config: {e}")
+
+# Load database from database.json
+def load_database(path=DATABASE_FILE):
+    try:
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                return json.load(f)
+        return {}
+    except Exception as e:
+        logger.error(f"Error loading database: {e}")
+        return {}
+
+# Default record for a new user
+def new_user_record():
+    return {
+        "balance": 0,
+        "referrals": [],
+        "join_date": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        "withdrawals": []
+    }
+
+# JSON storage engine: users stay in memory, changed records are marked dirty and a
+# background thread flushes them to database.json every FLUSH_INTERVAL seconds or
+# FLUSH_EVERY_MUTATIONS changes. Records are replaced, never mutated in place, so a
+# flush can serialize a shallow snapshot without holding the lock.
+# The referral index (referrer -> set of referred users, referred user -> referrer) and
+# the running totals for /stats are rebuilt on load and kept up to date on every change.
+class JSONStorage:
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL, flush_every=FLUSH_EVERY_MUTATIONS):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.users = load_database(self.path)
+        self._index_referrals()
+        self._compute_totals()
+        self.dirty = set()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, name="json-storage-flush", daemon=True)
+        self.flusher.start()
+
+    def _index_referrals(self):
+        self.referral_sets = {}
+        self.referred_by = {}
+        for user_id, data in self.users.items():
+            self._index_user(user_id, data)
+
+    # Referral lists are append-only, so indexing only ever adds entries
+    def _index_user(self, user_id, data):
+        referrals = self.referral_sets.setdefault(user_id, set())
+        for referred_id in data.get("referrals", []):
+            if referred_id not in referrals:
+                referrals.add(referred_id)
+                self.referred_by.setdefault(referred_id, user_id)
+
+    def _compute_totals(self):
+        self.totals = {"total_users": 0, "total_balance": 0, "pending_withdrawals": 0, "pending_withdrawal_amount": 0}
+        for data in self.users.values():
+            self._add_to_totals(data, 1)
+
+    # Add (sign=1) or remove (sign=-1) one user's contribution to the running totals
+    def _add_to_totals(self, data, sign):
+        pending = [w for w in data.get("withdrawals", []) if w.get("status") == "pending"]
+        self.totals["total_users"] += sign
+        self.totals["total_balance"] += sign * data.get("balance", 0)
+        self.totals["pending_withdrawals"] += sign * len(pending)
+        self.totals["pending_withdrawal_amount"] += sign * sum(w.get("amount", 0) for w in pending)
+
+    def _replace_user(self, user_id, data):
+        old = self.users.get(user_id)
+        if old is not None:
+            self._add_to_totals(old, -1)
+        self._add_to_totals(data, 1)
+        self.users[user_id] = data
+        self._mark_dirty(user_id)
+
+    def _mark_dirty(self, user_id):
+        self.dirty.add(user_id)
+        if len(self.dirty) >= self.flush_every:
+            self.wakeup.set()
+
+    def has_user(self, user_id):
+        with self.lock:
+            return user_id in self.users
+
+    def get_user(self, user_id):
+        with self.lock:
+            data = self.users.get(user_id)
+        return copy.deepcopy(data) if data is not None else None
+
+    def put_user(self, user_id, data):
+        data = copy.deepcopy(data)
+        with self.lock:
+            self._replace_user(user_id, data)
+            self._index_user(user_id, data)
+
+    # A user can only ever be credited once, to whichever referrer came first
+    def add_referral(self, referrer_id, referred_id, reward):
+        with self.lock:
+            if referred_id in self.referred_by:
+                return False
+            referrer = self.users.get(referrer_id) or new_user_record()
+            referrer = dict(referrer, referrals=referrer["referrals"] + [referred_id],
+                            balance=referrer["balance"] + reward)
+            self._replace_user(referrer_id, referrer)
+            self.referral_sets.setdefault(referrer_id, set()).add(referred_id)
+            self.referred_by[referred_id] = referrer_id
+            return True
+
+    def get_referrer(self, user_id):
+        with self.lock:
+            return self.referred_by.get(user_id)
+
+    def count_referrals(self, user_id):
+        with self.lock:
+            return len(self.referral_sets.get(user_id, ()))
+
+    def add_withdrawal(self, user_id, record):
+        with self.lock:
+            user = self.users.get(user_id)
+            if user is None or user["balance"] < record["amount"]:
+                return False
+            user = dict(user, balance=user["balance"] - record["amount"],
+                        withdrawals=user.get("withdrawals", []) + [dict(record)])
+            self._replace_user(user_id, user)
+            return True
+
+    def user_ids(self):
+        with self.lock:
+            return list(self.users.keys())
+
+    def count_users(self):
+        with self.lock:
+            return len(self.users)
+
+    def aggregates(self):
+        with self.lock:
+            return dict(self.totals)
+
+    # Written to a temp file, then atomically replaced; raises on failure so flush() can retry
+    def _write_snapshot(self, snapshot):
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(snapshot, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.path)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                flushed = set(self.dirty)
+                snapshot = dict(self.users)
+                self.dirty.clear()
+            try:
+                self._write_snapshot(snapshot)
+            except Exception:
+                # Keep them dirty so the next flush writes them again
+                with self.lock:
+                    self.dirty |= flushed
+                raise
+            logger.debug(f"Flushed {len(flushed)} changed users to {self.path}")
+
+    def _flush_loop(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing database: {e}")
+
+    def close(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.flusher.join(timeout=self.flush_interval)
+        self.flush()
+
+# Journal storage engine: users stay in memory and every change is appended (and fsync'd)
+# to database.journal as one JSON line. On startup the snapshot is loaded and the journal
+# replayed; once the journal grows past JOURNAL_COMPACT_BYTES a background thread rotates
+# it to database.journal.1, writes a new snapshot and removes the rotated journal.
+class JournalStorage(JSONStorage):
+    def __init__(self, path, snapshot_path, compact_bytes=JOURNAL_COMPACT_BYTES):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.compact_bytes = compact_bytes
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.dirty = set()
+        self.seq = 0
+        self.users = {}
+        self.journal_size = 0
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self._replay()
+        self.journal = open(self.path, 'a')
+        self.flusher = threading.Thread(target=self._compact_loop, name="journal-compaction", daemon=True)
+        self.flusher.start()
+
+    def _replay(self):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+            self.users = snapshot["users"]
+            self.seq = snapshot["seq"]
+        else:
+            # First start on the journal engine: seed from database.json
+            self.users = load_database()
+        self._index_referrals()
+        self._compute_totals()
+
+        replayed = 0
+        for journal_path in (self.path + ".1", self.path):
+            if not os.path.exists(journal_path):
+                continue
+            with open(journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Ignoring incomplete entry at the end of {journal_path}")
+                        break
+                    if event["seq"] <= self.seq:
+                        continue
+                    self._apply(event)
+                    self.seq = event["seq"]
+                    replayed += 1
+
+        # Fold everything replayed into a fresh snapshot so the journal starts empty
+        self._write_snapshot({"seq": self.seq, "users": dict(self.users)})
+        open(self.path, 'w').close()
+        if os.path.exists(self.path + ".1"):
+            os.remove(self.path + ".1")
+        logger.info(f"Loaded {len(self.users)} users from {self.snapshot_path}, replayed {replayed} journal entries")
+
+    def _apply(self, event):
+        op = event["op"]
+        if op == "put":
+            JSONStorage.put_user(self, event["user_id"], event["data"])
+        elif op == "update":
+            user = dict(self.users.get(event["user_id"]) or new_user_record())
+            user.update(event.get("set", {}))
+            for key, entries in event.get("append", {}).items():
+                user[key] = user.get(key, []) + entries
+            for key in event.get("unset", []):
+                user.pop(key, None)
+            JSONStorage.put_user(self, event["user_id"], user)
+        elif op == "referral":
+            if event["referrer_id"] not in self.users:
+                JSONStorage.put_user(self, event["referrer_id"], dict(new_user_record(), join_date=event["date"]))
+            JSONStorage.add_referral(self, event["referrer_id"], event["referred_id"], event["reward"])
+        elif op == "withdrawal":
+            JSONStorage.add_withdrawal(self, event["user_id"], event["record"])
+        else:
+            logger.warning(f"Unknown journal operation: {op}")
+
+    def _append(self, event):
+        self.seq += 1
+        event = dict(event, seq=self.seq, date=datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"))
+        line = json.dumps(event) + "\n"
+        self.journal.write(line)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_size += len(line.encode())
+        return event
+
+    def _mark_dirty(self, user_id):
+        if self.journal_size >= self.compact_bytes:
+            self.wakeup.set()
+
+    # Changes to one user as a journal entry: changed fields, entries appended to lists (referrals and
+    # withdrawals grow with the user) and removed fields, so the entry stays small as the record grows
+    @staticmethod
+    def _diff(old, new):
+        changes, appended = {}, {}
+        for key, value in new.items():
+            previous = old.get(key)
+            if key in old and value == previous:
+                continue
+            if isinstance(value, list) and isinstance(previous, list) and value[:len(previous)] == previous:
+                appended[key] = value[len(previous):]
+            else:
+                changes[key] = value
+        removed = [key for key in old if key not in new]
+        return {name: part for name, part in (("set", changes), ("append", appended), ("unset", removed)) if part}
+
+    # New users are journaled whole; existing ones only by what changed, replayed onto the stored record
+    def put_user(self, user_id, data):
+        with self.lock:
+            old = self.users.get(user_id)
+            if old is None:
+                self._append({"op": "put", "user_id": user_id, "data": data})
+            else:
+                changes = self._diff(old, data)
+                if changes:
+                    self._append(dict(changes, op="update", user_id=user_id))
+            super().put_user(user_id, data)
+
+    def add_referral(self, referrer_id, referred_id, reward):
+        with self.lock:
+            if referred_id in self.referred_by:
+                return False
+            self._apply(self._append({"op": "referral", "referrer_id": referrer_id,
+                                      "referred_id": referred_id, "reward": reward}))
+            return True
+
+    def add_withdrawal(self, user_id, record):
+        with self.lock:
+            user = self.users.get(user_id)
+            if user is None or user["balance"] < record["amount"]:
+                return False
+            self._append({"op": "withdrawal", "user_id": user_id, "record": record})
+            return super().add_withdrawal(user_id, record)
+
+    def _write_snapshot(self, snapshot):
+        tmp_file = self.snapshot_path + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.snapshot_path)
+
+    # Move the journal to database.journal.1. If an earlier compaction failed to write its snapshot, the
+    # old .1 still holds entries no snapshot has, so the journal is appended to it instead of replacing it.
+    def _rotate_journal(self):
+        rotated = self.path + ".1"
+        if not os.path.exists(rotated):
+            os.replace(self.path, rotated)
+            return
+        with open(self.path, 'r') as journal, open(rotated, 'a') as target:
+            for line in journal:
+                target.write(line)
+            target.flush()
+            os.fsync(target.fileno())
+        os.remove(self.path)
+
+    def compact(self):
+        with self.flush_lock:
+            with self.lock:
+                if self.journal_size == 0:
+                    return
+                self.journal.close()
+                self._rotate_journal()
+                self.journal = open(self.path, 'a')
+                self.journal_size = 0
+                snapshot = {"seq": self.seq, "users": dict(self.users)}
+            self._write_snapshot(snapshot)
+            os.remove(self.path + ".1")
+            logger.info(f"Compacted journal into {self.snapshot_path} at seq {snapshot['seq']}")
+
+    def flush(self):
+        with self.lock:
+            self.journal.flush()
+
+    def _compact_loop(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if self.stopped.is_set():
+                break
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Error compacting journal: {e}")
+
+    def close(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.flusher.join(timeout=5)
+        with self.lock:
+            self.journal.close()
+
+# SQLite storage engine: one row per user, referrals and withdrawals in their own tables
+class SQLiteStorage:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            balance NUMERIC NOT NULL DEFAULT 0,
+            join_date TEXT,
+            extra TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE TABLE IF NOT EXISTS referrals (
+            referrer_id TEXT NOT NULL,
+            referred_id TEXT NOT NULL,
+            PRIMARY KEY (referrer_id, referred_id)
+        );
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            amount NUMERIC NOT NULL,
+            date TEXT,
+            status TEXT,
+            account_number TEXT,
+            bank_name TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals (referred_id);
+        CREATE INDEX IF NOT EXISTS idx_withdrawals_user ON withdrawals (user_id);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self._compute_totals()
+
+    # Running totals for /stats: computed once on open, then adjusted by each write
+    def _compute_totals(self):
+        with self.lock:
+            users, balance = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(balance), 0) FROM users").fetchone()
+            pending, pending_amount = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM withdrawals WHERE status = 'pending'"
+            ).fetchone()
+        self.totals = {"total_users": users, "total_balance": balance,
+                       "pending_withdrawals": pending, "pending_withdrawal_amount": pending_amount}
+
+    # Writes collect their changes in a delta that is applied once the transaction has committed,
+    # so a failed or rolled back write leaves the totals untouched
+    def _new_delta(self):
+        return dict.fromkeys(self.totals, 0)
+
+    def _apply_delta(self, delta):
+        for key, value in delta.items():
+            self.totals[key] += value
+
+    def has_user(self, user_id):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row is not None
+
+    def get_user(self, user_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT balance, join_date, extra FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            referrals = [r[0] for r in self.conn.execute(
+                "SELECT referred_id FROM referrals WHERE referrer_id = ? ORDER BY rowid", (user_id,)
+            )]
+            withdrawals = [
+                {"amount": r[0], "date": r[1], "status": r[2], "account_number": r[3], "bank_name": r[4]}
+                for r in self.conn.execute(
+                    "SELECT amount, date, status, account_number, bank_name FROM withdrawals "
+                    "WHERE user_id = ? ORDER BY id", (user_id,)
+                )
+            ]
+        data = {"balance": row[0], "referrals": referrals, "join_date": row[1], "withdrawals": withdrawals}
+        data.update(json.loads(row[2]))
+        return data
+
+    # Referrals and withdrawals are append-only: entries beyond the stored count are inserted
+    def put_user(self, user_id, data):
+        extra = {k: v for k, v in data.items() if k not in ("balance", "referrals", "join_date", "withdrawals")}
+        delta = self._new_delta()
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                old = self.conn.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
+                if old is None:
+                    delta["total_users"] += 1
+                delta["total_balance"] += data.get("balance", 0) - (old[0] if old else 0)
+                self.conn.execute(
+                    "INSERT INTO users (user_id, balance, join_date, extra) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET balance = excluded.balance, "
+                    "join_date = excluded.join_date, extra = excluded.extra",
+                    (user_id, data.get("balance", 0), data.get("join_date"), json.dumps(extra))
+                )
+                referrals = data.get("referrals", [])
+                stored = self.conn.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,)).fetchone()[0]
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO referrals (referrer_id, referred_id) VALUES (?, ?)",
+                    [(user_id, str(referred_id)) for referred_id in referrals[stored:]]
+                )
+                withdrawals = data.get("withdrawals", [])
+                stored = self.conn.execute("SELECT COUNT(*) FROM withdrawals WHERE user_id = ?", (user_id,)).fetchone()[0]
+                for record in withdrawals[stored:]:
+                    self._insert_withdrawal(user_id, record, delta)
+            self._apply_delta(delta)
+
+    # A user can only ever be credited once, to whichever referrer came first
+    def add_referral(self, referrer_id, referred_id, reward):
+        delta = self._new_delta()
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                already_referred = self.conn.execute(
+                    "SELECT 1 FROM referrals WHERE referred_id = ?", (referred_id,)
+                ).fetchone()
+                if already_referred:
+                    return False
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO users (user_id, join_date) VALUES (?, ?)",
+                    (referrer_id, new_user_record()["join_date"])
+                )
+                delta["total_users"] += cursor.rowcount
+                self.conn.execute(
+                    "INSERT INTO referrals (referrer_id, referred_id) VALUES (?, ?)", (referrer_id, referred_id)
+                )
+                self.conn.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (reward, referrer_id))
+                delta["total_balance"] += reward
+            self._apply_delta(delta)
+            return True
+
+    def get_referrer(self, user_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT referrer_id FROM referrals WHERE referred_id = ? ORDER BY rowid LIMIT 1", (user_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def count_referrals(self, user_id):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,)).fetchone()[0]
+
+    def add_withdrawal(self, user_id, record):
+        delta = self._new_delta()
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                cursor = self.conn.execute(
+                    "UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?",
+                    (record["amount"], user_id, record["amount"])
+                )
+                if cursor.rowcount == 0:
+                    return False
+                delta["total_balance"] -= record["amount"]
+                self._insert_withdrawal(user_id, record, delta)
+            self._apply_delta(delta)
+            return True
+
+    def _insert_withdrawal(self, user_id, record, delta):
+        if record.get("status") == "pending":
+            delta["pending_withdrawals"] += 1
+            delta["pending_withdrawal_amount"] += record.get("amount", 0)
+        self.conn.execute(
+            "INSERT INTO withdrawals (user_id, amount, date, status, account_number, bank_name) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, record.get("amount", 0), record.get("date"), record.get("status"),
+             record.get("account_number"), record.get("bank_name"))
+        )
+
+    def user_ids(self):
+        with self.lock:
+            return [r[0] for r in self.conn.execute("SELECT user_id FROM users")]
+
+    def count_users(self):
+        with self.lock:
+            return self.totals["total_users"]
+
+    def aggregates(self):
+        with self.lock:
+            return dict(self.totals)
+
+    # Import users from database.json the first time the SQLite database is used
+    def import_json(self, path):
+        if self.count_users() > 0 or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as f:
+                db = json.load(f)
+        except Exception as e:
+            logger.error(f"Error reading {path} for import: {e}")
+            return
+        for user_id, data in db.items():
+            self.put_user(user_id, data)
+        if db:
+            logger.info(f"Imported {len(db)} users from {path} into {self.path}")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# Active storage engine (opened by init_storage)
+storage = None
+
+def init_storage():
+    global storage
+    if storage is not None:
+        return storage
+    if STORAGE_ENGINE == "sqlite":
+        storage = SQLiteStorage(SQLITE_DATABASE_FILE)
+        storage.import_json(DATABASE_FILE)
+    elif STORAGE_ENGINE == "journal":
+        storage = JournalStorage(JOURNAL_FILE, SNAPSHOT_FILE)
+    else:
+        storage = JSONStorage(DATABASE_FILE)
+    atexit.register(storage.close)
+    logger.info(f"Using {STORAGE_ENGINE} storage engine")
+    return storage
+
+# Thread-safe database operations
+db_lock = threading.Lock()
+
+def user_exists(user_id):
+    with db_lock:
+        return storage.has_user(str(user_id))
+
+def get_user_data(user_id):
+    with db_lock:
+        user_id_str = str(user_id)
+        data = storage.get_user(user_id_str)
+        if data is None:
+            data = new_user_record()
+            storage.put_user(user_id_str, data)
+        return data
+
+def update_user_data(user_id, data):
+    with db_lock:
+        storage.put_user(str(user_id), data)
+
+# Credit a referral once; returns False if the referral was already counted
+def credit_referral(referrer_id, referred_id, reward):
+    with db_lock:
+        return storage.add_referral(str(referrer_id), str(referred_id), reward)
+
+# Who referred this user (None if they joined without a referral link)
+def get_referrer(user_id):
+    with db_lock:
+        return storage.get_referrer(str(user_id))
+
+def count_referrals(user_id):
+    with db_lock:
+        return storage.count_referrals(str(user_id))
+
+# Debit the balance and record the withdrawal; returns False if the balance is too low
+def record_withdrawal(user_id, record):
+    with db_lock:
+        return storage.add_withdrawal(str(user_id), record)
+
+# Load stats from stats.json
+def load_stats():
+    try:
+        if os.path.exists(STATS_FILE):
+            with open(STATS_FILE, 'r') as f:
+                return json.load(f)
+        return {
+            "total_users": 0,
+            "messages_received": 0,
+            "messages_sent": 0,
+            "withdrawals": 0,
+            "total_withdrawal_amount": 0,
+            "total_referrals": 0,
+            "start_date": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+            "blocked_users": 0
+        }
+    except Exception as e:
+        logger.error(f"Error loading stats: {e}")
+        return {
+            "total_users": 0,
+            "messages_received": 0,
+            "messages_sent": 0,
+            "withdrawals": 0,
+            "total_withdrawal_amount": 0,
+            "total_referrals": 0,
+            "start_date": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+            "blocked_users": 0
+        }
+
+# Save stats to stats.json (written to a temp file, then atomically replaced)
+def save_stats(stats):
+    try:
+        tmp_file = STATS_FILE + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(stats, f, indent=4)
+        os.replace(tmp_file, STATS_FILE)
+    except Exception as e:
+        logger.error(f"Error saving stats: {e}")
+
+# In-memory stats counters: handlers only touch memory, a background thread writes
+# stats.json every STATS_FLUSH_INTERVAL seconds and once more at exit
+class StatsCounters:
+    def __init__(self, flush_interval=STATS_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.values = load_stats()
+        self.changed = False
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, name="stats-flush", daemon=True)
+        self.flusher.start()
+
+    def update(self, key, value=1, increment=True):
+        with self.lock:
+            if key in self.values:
+                if increment:
+                    self.values[key] += value
+                else:
+                    self.values[key] = value
+                self.changed = True
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def flush(self):
+        with self.lock:
+            if not self.changed:
+                return
+            stats = dict(self.values)
+            self.changed = False
+        save_stats(stats)
+
+    def _flush_loop(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.flusher.join(timeout=self.flush_interval)
+        self.flush()
+
+# Active stats counters (created by init_stats)
+stats_counters = None
+
+def init_stats():
+    global stats_counters
+    if stats_counters is None:
+        stats_counters = StatsCounters()
+        atexit.register(stats_counters.close)
+    return stats_counters
+
+def update_stats(key, value=1, increment=True):
+    stats_counters.update(key, value, increment)
+
+# Bounded LRU cache whose entries expire after a per-entry TTL
+class TTLCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if entry[1] <= time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# (channel, user) -> joined, so repeated verify clicks don't each cost a get_chat_member call
+membership_cache = TTLCache(MEMBERSHIP_CACHE_SIZE)
+
+# Check if user is a member of a channel; None when Telegram couldn't be asked (rate limit, network), so the answer is unknown
+async def is_member(user_id, chat_id):
+    try:
+        # Extract username from URL if it's a full URL
+        if chat_id.startswith("@") and "/" not in chat_id:
+            channel_username = chat_id
+        else:
+            # Extract channel username from potentially different formats
+            if "/" in chat_id:
+                parts = chat_id.split("/")
+                channel_username = "@" + parts[-1]
+            else:
+                channel_username = "@" + chat_id
+
+        cache_key = (channel_username.lower(), user_id)
+        cached = membership_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        member = await bot.get_chat_member(channel_username, user_id)
+        joined = member.status in ['member', 'administrator', 'creator']
+        membership_cache.set(cache_key, joined, MEMBERSHIP_TTL if joined else MEMBERSHIP_NEGATIVE_TTL)
+        return joined
+    except asyncio_helper.ApiTelegramException as e:
+        logger.error(f"Error checking membership: {e}")
+        if e.error_code == 400:
+            return False  # Channel not found or the bot isn't an admin there: the user can't pass
+        return None
+    except Exception as e:
+        logger.error(f"Error checking membership: {e}")
+        return None
+
+# Check all required channels at once; stop at the first one the user hasn't joined.
+# Returns None instead of False when a check failed or didn't finish in time, so a slow or
+# rate-limited API never reports a member as "not joined".
+async def has_joined_all(user_id, channel_names):
+    if not channel_names:
+        return True
+    pending = {asyncio.ensure_future(is_member(user_id, name)) for name in channel_names}
+    deadline = asyncio.get_running_loop().time() + VERIFY_TIMEOUT
+    unknown = False
+    try:
+        while pending:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                logger.warning(f"Verification of user {user_id} timed out with {len(pending)} checks unfinished")
+                return None
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                joined = future.result()
+                if joined is False:
+                    return False
+                if joined is None:
+                    unknown = True
+        return None if unknown else True
+    finally:
+        for future in pending:
+            future.cancel()
+
+# Create keyboard with channel buttons
+def channels_keyboard():
+    config = load_config()
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    buttons = []
+
+    for channel in config["MUST_JOIN_CHANNELS"]:
+        buttons.append(types.InlineKeyboardButton(text=channel["name"], url=channel["url"]))
+
+    # Add buttons in groups of 2
+    for i in range(0, len(buttons), 2):
+        if i + 1 < len(buttons):
+            markup.add(buttons[i], buttons[i + 1])
+        else:
+            markup.add(buttons[i])
+
+    markup.add(types.InlineKeyboardButton(text="✅ Verify Membership", callback_data="verify_membership"))
+    return markup
+
+# Create main menu keyboard
+def main_menu_keyboard():
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(
+        types.InlineKeyboardButton(text="👥 Referrals", callback_data="referrals"),
+        types.InlineKeyboardButton(text="📝 Tasks", callback_data="tasks")
+    )
+    markup.add(types.InlineKeyboardButton(text="💰 Withdraw", callback_data="withdraw"))
+    return markup
+
+# Create tasks keyboard
+def tasks_keyboard():
+    config = load_config()
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    buttons = []
+
+    for i, task in enumerate(config["TASKS"]):
+        buttons.append(types.InlineKeyboardButton(text=f"{task['name']} (+{task['reward']}₦)", url=task["url"]))
+
+    # Add buttons in groups of 2
+    for i in range(0, len(buttons), 2):
+        if i + 1 < len(buttons):
+            markup.add(buttons[i], buttons[i + 1])
+        else:
+            markup.add(buttons[i])
+
+    markup.add(types.InlineKeyboardButton(text="🔙 Back to Menu", callback_data="main_menu"))
+    return markup
+
+# Pending next-step handlers by chat id (AsyncTeleBot has no register_next_step_handler)
+next_step_handlers = {}
+
+# Send the chat's next message to handler instead of the normal handlers
+def register_next_step_handler(message, handler):
+    next_step_handlers[message.chat.id] = handler
+
+# Next-step dispatcher; registered first so it sees replies before the command and fallback handlers
+@bot.message_handler(func=lambda message: message.chat.id in next_step_handlers, content_types=util.content_type_media)
+async def handle_next_step(message):
+    handler = next_step_handlers.pop(message.chat.id, None)
+    if handler:
+        await handler(message)
+
+# Broadcast command handler
+@bot.message_handler(commands=['broadcast'])
+async def broadcast_command(message):
+    try:
+        update_stats("messages_received")
+        # Check if user is admin
+        if message.from_user.id == CONFIG["ADMIN_ID"]:
+            await bot.send_message(message.chat.id, "Please send the message you want to broadcast.")
+            register_next_step_handler(message, process_broadcast_message)
+            update_stats("messages_sent")
+        else:
+            await bot.send_message(message.chat.id, "❌ You are not authorized to use this command.")
+            update_stats("messages_sent")
+    except Exception as e:
+        logger.error(f"Error in broadcast command: {e}")
+        try:
+            await bot.send_message(message.chat.id, "An error occurred while processing the broadcast command.")
+            update_stats("messages_sent")
+        except:
+            pass
+
+async def process_broadcast_message(message):
+    try:
+        update_stats("messages_received")
+        content = broadcast_content_from_message(message)
+        if content is None:
+            await bot.send_message(message.chat.id, "Unsupported broadcast content type.") # Notify admin about unsupported type
+            update_stats("messages_sent")
+            return
+
+        job = BroadcastJob(message.chat.id, content, await asyncio.to_thread(storage.user_ids))
+        broadcast_jobs[job.job_id] = job
+        await start_broadcast_job(job)
+        await bot.send_message(message.chat.id, f"Broadcast {job.job_id} started for {job.total} users.\nUse /broadcasts to check progress, pause, resume or cancel it.")
+        update_stats("messages_sent")
+    except Exception as e:
+        logger.error(f"Error processing broadcast message: {e}")
+        try:
+            await bot.send_message(message.chat.id, "An error occurred while processing the broadcast.")
+            update_stats("messages_sent")
+        except:
+            pass
+
+# Capture what the admin sent in a form that can be saved and re-sent after a restart
+def broadcast_content_from_message(message):
+    if message.text:
+        return {"type": "text", "text": message.text}
+    elif message.photo:
+        return {"type": "photo", "file_id": message.photo[-1].file_id, "caption": message.caption}
+    elif message.video:
+        return {"type": "video", "file_id": message.video.file_id, "caption": message.caption}
+    elif message.forward_from_chat:
+        return {"type": "forward", "from_chat_id": message.forward_from_chat.id, "message_id": message.forward_from_message_id}
+    elif message.forward_from:
+        return {"type": "forward", "from_chat_id": message.chat.id, "message_id": message.message_id} # Handle forwarded messages from users
+    return None
+
+# Send the saved broadcast content to one user
+async def send_broadcast_content(user_id, content):
+    if content["type"] == "text":
+        await bot.send_message(user_id, content["text"])
+    elif content["type"] == "photo":
+        await bot.send_photo(user_id, content["file_id"], caption=content["caption"])
+    elif content["type"] == "video":
+        await bot.send_video(user_id, content["file_id"], caption=content["caption"])
+    else:
+        await bot.forward_message(user_id, content["from_chat_id"], content["message_id"])
+
+# Broadcast job persisted under BROADCAST_DIR so it survives restarts
+class BroadcastJob:
+    def __init__(self, admin_chat_id, content, user_ids, job_id=None, status="running", created=None):
+        self.job_id = job_id or uuid.uuid4().hex[:8]
+        self.admin_chat_id = admin_chat_id
+        self.content = content
+        self.user_ids = user_ids
+        self.total = len(user_ids)
+        self.created = created or time.strftime("%Y-%m-%d %H:%M:%S")
+        self.status = status
+        self.counts = {"sent": 0, "failed": 0, "blocked": 0}
+        self.processed = 0
+        self.stop_status = None
+        self.task = None
+
+    @property
+    def state_path(self):
+        return os.path.join(BROADCAST_DIR, f"{self.job_id}.json")
+
+    @property
+    def log_path(self):
+        return os.path.join(BROADCAST_DIR, f"{self.job_id}.log")
+
+    @classmethod
+    def load(cls, state_path):
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        return cls(state["admin_chat_id"], state["content"], state["user_ids"], job_id=state["job_id"],
+                   status=state["status"], created=state["created"])
+
+    def save(self):
+        os.makedirs(BROADCAST_DIR, exist_ok=True)
+        state = {"job_id": self.job_id, "admin_chat_id": self.admin_chat_id, "content": self.content,
+                 "user_ids": self.user_ids, "status": self.status, "created": self.created}
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    # The result log is the job's cursor: every user listed there is done and is skipped on resume
+    def load_results(self):
+        done = set()
+        counts = {"sent": 0, "failed": 0, "blocked": 0}
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] in counts and parts[0] not in done:
+                        done.add(parts[0])
+                        counts[parts[1]] += 1
+        self.counts = counts
+        self.processed = len(done)
+        return done
+
+    def progress(self):
+        return dict(self.counts, status=self.status, processed=self.processed, total=self.total)
+
+    def request_stop(self, status):
+        self.stop_status = status
+
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+broadcast_jobs = {}
+
+# Append one result line to a broadcast log (runs in a worker thread)
+def append_result(log_file, line):
+    log_file.write(line)
+    log_file.flush()
+
+# Send a broadcast to every user not yet in its result log; log file I/O stays off the event loop
+async def run_broadcast_job(job):
+    done = await asyncio.to_thread(job.load_results)
+    logger.info(f"Broadcast {job.job_id}: {job.total - len(done)} of {job.total} users left")
+    log_file = await asyncio.to_thread(open, job.log_path, 'a')
+    try:
+        for user_id in job.user_ids:
+            if job.stop_status:
+                break
+            if user_id in done:
+                continue
+            result = "sent"
+            try:
+                if user_id.isdigit():
+                    await send_broadcast_content(int(user_id), job.content)
+                    update_stats("messages_sent")
+                    await asyncio.sleep(BROADCAST_DELAY) # Add a small delay to avoid rate limiting
+                else:
+                    logger.warning(f"Skipping non-integer user ID: {user_id}")
+                    result = "failed"
+            except asyncio_helper.ApiTelegramException as e:
+                if e.result_json and e.result_json.get('description') == 'Forbidden: bot was blocked by the user':
+                    logger.warning(f"Bot blocked by user {user_id}")
+                    update_stats("blocked_users")
+                    result = "blocked"
+                else:
+                    logger.error(f"Failed to broadcast to user {user_id}: {e}")
+                    result = "failed"
+            except Exception as e:
+                logger.error(f"An unexpected error occurred while broadcasting to user {user_id}: {e}")
+                result = "failed"
+
+            await asyncio.to_thread(append_result, log_file, f"{user_id} {result}\n")
+            job.processed += 1
+            job.counts[result] += 1
+    finally:
+        await asyncio.to_thread(log_file.close)
+
+    job.status = job.stop_status or "completed"
+    await asyncio.to_thread(job.save)
+
+    progress = job.progress()
+    active_users = progress["total"] - progress["blocked"]
+    try:
+        await bot.send_message(job.admin_chat_id, f"Broadcast {job.job_id} {progress['status']}.\nProcessed: {progress['processed']}/{progress['total']}\nSuccessful: {progress['sent']}\nFailed: {progress['failed'] + progress['blocked']}\nUsers who blocked the bot: {progress['blocked']}\nActive users remaining: {active_users}")
+        update_stats("messages_sent")
+    except Exception as e:
+        logger.error(f"Error sending broadcast report: {e}")
+
+# Start (or restart) a broadcast job as a background task
+async def start_broadcast_job(job):
+    job.stop_status = None
+    job.status = "running"
+    await asyncio.to_thread(job.save)
+    job.task = asyncio.create_task(run_broadcast_job(job))
+
+# Load saved broadcast jobs and resume the ones a restart interrupted
+async def resume_broadcast_jobs():
+    if not os.path.isdir(BROADCAST_DIR):
+        return
+    for file_name in sorted(os.listdir(BROADCAST_DIR)):
+        if not file_name.endswith(".json") or file_name[:-len(".json")] in broadcast_jobs:
+            continue
+        try:
+            job = await asyncio.to_thread(BroadcastJob.load, os.path.join(BROADCAST_DIR, file_name))
+        except Exception as e:
+            logger.error(f"Could not load broadcast job {file_name}: {e}")
+            continue
+        broadcast_jobs[job.job_id] = job
+        if job.status == "running":
+            logger.info(f"Resuming interrupted broadcast {job.job_id}")
+            await start_broadcast_job(job)
+        else:
+            await asyncio.to_thread(job.load_results)
+
+# Broadcast jobs command handler: list, pause, resume or cancel
+@bot.message_handler(commands=['broadcasts'])
+async def broadcasts_command(message):
+    try:
+        update_stats("messages_received")
+
+        # Check if user is admin
+        if message.from_user.id != CONFIG["ADMIN_ID"]:
+            await bot.send_message(message.chat.id, "❌ You don't have permission to use this command.")
+            update_stats("messages_sent")
+            return
+
+        args = message.text.split()[1:]
+        if not args:
+            jobs = sorted(broadcast_jobs.values(), key=lambda j: j.created, reverse=True)[:10]
+            if not jobs:
+                reply = "No broadcast jobs yet."
+            else:
+                lines = ["📣 Broadcast Jobs\n"]
+                for job in jobs:
+                    p = job.progress()
+                    lines.append(f"{job.job_id} - {p['status']} - {p['processed']}/{p['total']} (sent {p['sent']}, failed {p['failed']}, blocked {p['blocked']}) - {job.created}")
+                lines.append("\nUse /broadcasts pause|resume|cancel <id>")
+                reply = "\n".join(lines)
+        elif len(args) != 2 or args[0] not in ("pause", "resume", "cancel"):
+            reply = "Usage: /broadcasts or /broadcasts pause|resume|cancel <id>"
+        else:
+            action, job_id = args
+            job = broadcast_jobs.get(job_id)
+            if not job:
+                reply = f"Broadcast {job_id} not found."
+            elif action == "resume":
+                if job.is_running() or job.status not in ("paused", "running"):
+                    reply = f"Broadcast {job_id} is {job.status} and cannot be resumed."
+                else:
+                    await start_broadcast_job(job)
+                    reply = f"Broadcast {job_id} resumed."
+            elif job.is_running():
+                job.request_stop("paused" if action == "pause" else "cancelled")
+                reply = f"Broadcast {job_id}: {action} requested."
+            elif action == "cancel" and job.status == "paused":
+                job.status = "cancelled"
+                await asyncio.to_thread(job.save)
+                reply = f"Broadcast {job_id} cancelled."
+            else:
+                reply = f"Broadcast {job_id} is {job.status}; nothing to {action}."
+
+        await bot.send_message(message.chat.id, reply)
+        update_stats("messages_sent")
+    except Exception as e:
+        logger.error(f"Error in broadcasts command: {e}")
+        try:
+            await bot.send_message(message.chat.id, "An error occurred. Please try again.")
+            update_stats("messages_sent")
+        except:
+            pass
+
+# Start command handler
+@bot.message_handler(commands=['start'])
+async def start_command(message):
+    try:
+        update_stats("messages_received")
+        user_id = message.from_user.id
+        username = message.from_user.username or f"user{user_id}"
+        is_new_user = not await asyncio.to_thread(user_exists, user_id)
+        await asyncio.to_thread(get_user_data, user_id)  # Creates the record of a new user
+
+        # Check if this is a referral
+        if len(message.text.split()) > 1:
+            try:
+                referrer_id = message.text.split()[1]
+                if referrer_id.isdigit() and str(user_id) != referrer_id:
+                    config = load_config()
+                    referral_reward = config["REFERRAL_REWARD"]
+
+                    # Add referral to referrer's list and credit the reward
+                    if await asyncio.to_thread(credit_referral, referrer_id, user_id, referral_reward):
+                        # Update stats
+                        update_stats("total_referrals")
+
+                        # Notify referrer
+                        try:
+                            await bot.send_message(
+                                int(referrer_id),
+                                f"🎉 Congratulations! You have a new referral: @{username}\n"
+                                f"You earned {referral_reward}₦!"
+                            )
+                            update_stats("messages_sent")
+                        except Exception as e:
+                            logger.error(f"Error sending referral notification: {e}")
+            except Exception as e:
+                logger.error(f"Error processing referral: {e}")
+
+        # Count new user
+        if is_new_user:
+            update_stats("total_users")
+
+        # Send join channels message
+        welcome_text = (
+            f"👋 Hello, @{username}!\n\n"
+            f"Please join our channels and groups to continue:\n\n"
+            f"This bot was made using: @tenocomakerbot"
+        )
+
+        await bot.send_message(
+            message.chat.id,
+            welcome_text,
+            reply_markup=channels_keyboard(),
+            parse_mode="HTML"
+        )
+        update_stats("messages_sent")
+
+    except Exception as e:
+        logger.error(f"Error in start command: {e}")
+        try:
+            await bot.send_message(message.chat.id, "An error occurred. Please try again.")
+            update_stats("messages_sent")
+        except:
+            pass
+
+# Callback query handler
+@bot.callback_query_handler(func=lambda call: True)
+async def callback_handler(call):
+    try:
+        user_id = call.from_user.id
+        username = call.from_user.username or f"user{user_id}"
+        user_data = await asyncio.to_thread(get_user_data, user_id)
+        config = load_config()  # Reload config for every callback to get latest settings
+
+        # Handle verification callback
+        if call.data == "verify_membership":
+            # Check required channels
+            required_channels = [ch for ch in config["MUST_JOIN_CHANNELS"] if ch["check"]]
+            try:
+                all_joined = await has_joined_all(user_id, [channel["url"].split("/")[-1] for channel in required_channels])
+            except Exception as e:
+                logger.error(f"Error in verification: {e}")
+                all_joined = None
+
+            if all_joined:
+                # User joined all required channels, show main menu
+                welcome_text = (
+                    f"✅ Verification successful!\n\n"
+                    f"👋 Welcome to {config['BOT_NAME']}, @{username}!\n\n"
+                    f"💰 Your Balance: {user_data['balance']}₦\n\n"
+                    f"Please select an option below:"
+                )
+
+                await bot.edit_message_text(
+                    welcome_text,
+                    call.message.chat.id,
+                    call.message.message_id,
+                    reply_markup=main_menu_keyboard(),
+                    parse_mode="HTML"
+                )
+                update_stats("messages_sent")
+            elif all_joined is None:
+                # Membership couldn't be checked right now (busy or rate limited); don't claim the user hasn't joined
+                await bot.answer_callback_query(
+                    call.id,
+                    "⏳ Couldn't check your channels right now. Please tap verify again in a moment.",
+                    show_alert=True
+                )
+            else:
+                # User hasn't joined all required channels
+                await bot.answer_callback_query(
+                    call.id,
+                    "❌ You need to join all the required channels to continue or the bot may not be an admin in the Telegram channel.",
+                    show_alert=True
+                )
+
+        # Handle main menu callback
+        elif call.data == "main_menu":
+            welcome_text = (
+                f"👋 Welcome back, @{username}!\n\n"
+                f"💰 Your Balance: {user_data['balance']}₦\n\n"
+                f"Please select an option below:"
+            )
+
+            await bot.edit_message_text(
+                welcome_text,
+                call.message.chat.id,
+                call.message.message_id,
+                reply_markup=main_menu_keyboard(),
+                parse_mode="HTML"
+            )
+            update_stats("messages_sent")
+
+        # Handle referrals callback
+        elif call.data == "referrals":
+            referral_link = f"https://t.me/{config['BOT_USERNAME'].replace('@', '')}?start={user_id}"
+            referral_count = await asyncio.to_thread(count_referrals, user_id)
+            referral_reward = config["REFERRAL_REWARD"]
+
+            referral_text = (
+                f"👥 Your Referrals: {referral_count}\n\n"
+                f"💰 Earn {referral_reward}₦ for each new referral!\n\n"
+                f"🔗 Your Referral Link:\n"
+                f"{referral_link}\n\n"
+                f"Share this link with friends and earn money when they join!"
+            )
+
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton(text="🔙 Back to Menu", callback_data="main_menu"))
+
+            await bot.edit_message_text(
+                referral_text,
+                call.message.chat.id,
+                call.message.message_id,
+                reply_markup=markup,
+                parse_mode="HTML"
+            )
+            update_stats("messages_sent")
+
+        # Handle tasks callback
+        elif call.data == "tasks":
+            tasks_text = (
+                "📝 Available Tasks\n\n"
+                "Complete these tasks to earn rewards:"
+            )
+
+            await bot.edit_message_text(
+                tasks_text,
+                call.message.chat.id,
+                call.message.message_id,
+                reply_markup=tasks_keyboard(),
+                parse_mode="HTML"
+            )
+            update_stats("messages_sent")
+
+        # Handle withdraw callback
+        elif call.data == "withdraw":
+            if not config["WITHDRAWAL_ENABLED"]:
+                await bot.answer_callback_query(call.id, "❌ Withdrawals are currently disabled.", show_alert=True)
+                return
+
+            withdraw_text = (
+                f"💰 Withdrawal\n\n"
+                f"Your Balance: {user_data['balance']}₦\n\n"
+                f"Minimum Withdrawal: {config['MIN_WITHDRAWAL']}₦\n"
+                f"Please enter the amount you want to withdraw:"
+            )
+
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton(text="🔙 Back to Menu", callback_data="main_menu"))
+
+            await bot.edit_message_text(
+                withdraw_text,
+                call.message.chat.id,
+                call.message.message_id,
+                reply_markup=markup,
+                parse_mode="HTML"
+            )
+            update_stats("messages_sent")
+
+            # Register next step handler for withdrawal amount
+            register_next_step_handler(call.message, process_withdrawal_amount)
+
+    except Exception as e:
+        logger.error(f"Error in callback handler: {e}")
+        try:
+            await bot.answer_callback_query(call.id, "An error occurred. Please try again.")
+        except:
+            pass
+
+# Process withdrawal amount
+async def process_withdrawal_amount(message):
+    try:
+        update_stats("messages_received")
+        user_id = message.from_user.id
+        user_data = await asyncio.to_thread(get_user_data, user_id)
+        config = load_config()
+
+        # Check if message is a valid number
+        if not message.text.isdigit():
+            await bot.send_message(
+                message.chat.id,
+                "❌ Please enter a valid number.",
+                reply_markup=main_menu_keyboard()
+            )
+            update_stats("messages_sent")
+            return
+
+        amount = int(message.text)
+
+        # Check minimum and maximum withdrawal
+        if amount < config["MIN_WITHDRAWAL"]:
+            await bot.send_message(
+                message.chat.id,
+                f"❌ Minimum withdrawal amount is {config['MIN_WITHDRAWAL']}₦.",
+                reply_markup=main_menu_keyboard()
+            )
+            update_stats("messages_sent")
+            return
+
+        if amount > config["MAX_WITHDRAWAL"]:
+            await bot.send_message(
+                message.chat.id,
+                f"❌ Maximum withdrawal amount is {config['MAX_WITHDRAWAL']}₦.",
+                reply_markup=main_menu_keyboard()
+            )
+            update_stats("messages_sent")
+            return
+
+        # Check user balance
+        if amount > user_data["balance"]:
+            await bot.send_message(
+                message.chat.id,
+                f"❌ Insufficient balance. Your balance is {user_data['balance']}₦.",
+                reply_markup=main_menu_keyboard()
+            )
+            update_stats("messages_sent")
+            return
+
+        # Store withdrawal amount and ask for account number
+        user_withdrawal_data[user_id] = {"amount": amount}
+        await bot.send_message(
+            message.chat.id,
+            "Please enter your account number:"
+        )
+        register_next_step_handler(message, process_withdrawal_account_number)
+
+    except Exception as e:
+        logger.error(f"Error processing withdrawal amount: {e}")
+        try:
+            await bot.send_message(message.chat.id, "An error occurred. Please try again.")
+            update_stats("messages_sent")
+        except:
+            pass
+
+# Process withdrawal account number
+async def process_withdrawal_account_number(message):
+    try:
+        update_stats("messages_received")
+        user_id = message.from_user.id
+        account_number = message.text
+
+        if user_id not in user_withdrawal_data:
+            await bot.send_message(message.chat.id, "❌ Something went wrong. Please try the withdrawal again.")
+            return
+
+        user_withdrawal_data[user_id]["account_number"] = account_number
+        await bot.send_message(
+            message.chat.id,
+            "Please send the name of your bank:"
+        )
+        register_next_step_handler(message, process_withdrawal_bank_name)
+
+    except Exception as e:
+        logger.error(f"Error processing withdrawal account number: {e}")
+        try:
+            await bot.send_message(message.chat.id, "An error occurred. Please try again.")
+            update_stats("messages_sent")
+        except:
+            pass
+
+# Process withdrawal bank name
+async def process_withdrawal_bank_name(message):
+    try:
+        update_stats("messages_received")
+        user_id = message.from_user.id
+        username = message.from_user.username or f"user{user_id}"
+        user_data = await asyncio.to_thread(get_user_data, user_id)
+        config = load_config()
+        bank_name = message.text
+
+        if user_id not in user_withdrawal_data or "amount" not in user_withdrawal_data[user_id] or "account_number" not in user_withdrawal_data[user_id]:
+            await bot.send_message(message.chat.id, "❌ Something went wrong. Please try the withdrawal again.")
+            return
+
+        amount = user_withdrawal_data[user_id]["amount"]
+        account_number = user_withdrawal_data[user_id]["account_number"]
+
+        # Record withdrawal and debit the balance
+        withdrawal_record = {
+            "amount": amount,
+            "date": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+            "status": "pending",
+            "account_number": account_number,
+            "bank_name": bank_name
+        }
+
+        if not await asyncio.to_thread(record_withdrawal, user_id, withdrawal_record):
+            await bot.send_message(
+                message.chat.id,
+                "❌ Insufficient balance. Please try the withdrawal again.",
+                reply_markup=main_menu_keyboard()
+            )
+            update_stats("messages_sent")
+            del user_withdrawal_data[user_id]
+            return
+
+        # Send withdrawal request to payment channel
+        try:
+            payment_channel = CONFIG["PAYMENT_CHANNEL"]
+            if payment_channel.startswith("https://t.me/"):
+                channel_username = payment_channel.split("/")[-1]
+                if not channel_username.startswith("@"):
+                    channel_username = "@" + channel_username
+                await bot.send_message(
+                    channel_username,
+                    f"✅ New Withdrawal Paid!\n\n"
+                    f"👤 User: @{username} ({user_id})\n"
+                    f"🏦 Bank: {bank_name}\n"
+                    f"💳 Account Number: <code>{account_number}</code>\n"
+                    f"💸 Amount: {amount}₦\n"
+                    f"👥 Total Referrals: {len(user_data['referrals'])}\n\n"
+                    f"Bot: {config['BOT_USERNAME']}",
+                    parse_mode="HTML"
+                )
+            else:
+                # Assume it's already a username or chat ID
+                await bot.send_message(
+                    payment_channel,
+                    f"💰 New Withdrawal Request!\n\n"
+                    f"👤 User: @{username} (ID: {user_id})\n"
+                    f"🏦 Bank: {bank_name}\n"
+                    f"💳 Account Number: <code>{account_number}</code>\n"
+                    f"💸 Amount: {amount}₦\n"
+                    f"👥 Total Referrals: {len(user_data['referrals'])}\n\n"
+                    f"Bot: {config['BOT_USERNAME']}",
+                    parse_mode="HTML"
+                )
+            update_stats("messages_sent")
+        except Exception as e:
+            logger.error(f"Error sending withdrawal request to channel: {e}")
+
+        # Notify user
+        success_message = (
+            f"✅ Withdrawal Request Submitted!\n\n"
+            f"💰 Amount: {amount}₦\n"
+            f"🏦 Bank: {bank_name}\n"
+            f"💳 Account Number: {account_number}\n"
+            f"⏱️ Processing Time: 1-12 hours\n\n"
+            f"Your payment will be processed soon. Looting, having multiple accounts, or any form of cheating will result in your withdrawal not being approved. You can check status in our payment channel:\n"
+            f"{CONFIG['PAYMENT_CHANNEL']}"
+        )
+
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton(text="📢 Payment Channel", url=CONFIG["PAYMENT_CHANNEL"]))
+        markup.add(types.InlineKeyboardButton(text="🔙 Back to Menu", callback_data="main_menu"))
+
+        await bot.send_message(
+            message.chat.id,
+            success_message,
+            reply_markup=markup,
+            parse_mode="HTML"
+        )
+        update_stats("messages_sent")
+
+        # Clear user withdrawal data
+        if user_id in user_withdrawal_data:
+            del user_withdrawal_data[user_id]
+
+    except Exception as e:
+        logger.error(f"Error processing withdrawal bank name: {e}")
+        try:
+            await bot.send_message(message.chat.id, "An error occurred. Please try again.")
+            update_stats("messages_sent")
+        except:
+            pass
+
+# Stats command handler
+@bot.message_handler(commands=['stats'])
+async def stats_command(message):
+    try:
+        update_stats("messages_received")
+
+        # Check if user is admin
+        if message.from_user.id != CONFIG["ADMIN_ID"]:
+            await bot.send_message(message.chat.id, "❌ You don't have permission to use this command.")
+            update_stats("messages_sent")
+            return
+
+        stats = stats_counters.snapshot()
+        totals = await asyncio.to_thread(storage.aggregates)
+        total_users = totals["total_users"]
+
+        # Calculate additional stats
+        active_users = total_users - stats.get('blocked_users', 0)
+        total_balance = totals["total_balance"]
+
+        # Format start date
+        start_date = stats.get("start_date", "N/A")
+        if start_date != "N/A":
+            try:
+                start_date_obj = datetime.datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S").replace(tzinfo=datetime.timezone.utc)
+                now = datetime.datetime.now(datetime.timezone.utc)
+                days_running = (now - start_date_obj).days
+            except ValueError as e:
+                logger.error(f"Error parsing start date: {e}")
+                days_running = "N/A"
+        else:
+            days_running = "N/A"
+
+        stats_text = (
+            f"📊 Bot Statistics\n\n"
+            f"👤 Total Users: {total_users}\n"
+            f"✅ Active Users (Did not block): {active_users}\n"
+            f"🚫 Blocked Users: {stats.get('blocked_users', 0)}\n"
+            f"🔄 Total Referrals: {stats.get('total_referrals', 0)}\n"
+            f"💵 Total Payouts: {total_balance}₦\n"
+            f"⏳ Pending Withdrawals: {totals['pending_withdrawals']} ({totals['pending_withdrawal_amount']}₦)\n"
+        )
+        if days_running != "N/A":
+            stats_text += f"⏳ Bot Running For: {days_running} days\n"
+
+        await bot.send_message(message.chat.id, stats_text, parse_mode="HTML")
+        update_stats("messages_sent")
+
+    except Exception as e:
+        logger.error(f"Error in stats command: {e}")
+        try:
+            await bot.send_message(message.chat.id, "An error occurred. Please try again.")
+            update_stats("messages_sent")
+        except:
+            pass
+
+# Handle all text messages (for debugging and fallback)
+@bot.message_handler(func=lambda message: True)
+async def handle_all_messages(message):
+    try:
+        update_stats("messages_received")
+
+        # Just redirect to main menu
+        user_id = message.from_user.id
+        username = message.from_user.username or f"user{user_id}"
+        user_data = await asyncio.to_thread(get_user_data, user_id)
+
+        welcome_text = (
+            f"👋 Hi @{username}!\n\n"
+            f"💰 Your Balance: {user_data['balance']}₦\n\n"
+            f"Please select an option below:"
+        )
+
+        await bot.send_message(
+            message.chat.id,
+            welcome_text,
+            reply_markup=main_menu_keyboard(),
+            parse_mode="HTML"
+        )
+        update_stats("messages_sent")
+
+    except Exception as e:
+        logger.error(f"Error in message handler: {e}")
+        try:
+            await bot.send_message(message.chat.id, "An error occurred. Please try again.")
+            update_stats("messages_sent")
+        except:
+            pass
+
+# Print all config variables for debugging
+def print_config():
+    try:
+        logger.info("Current configuration:")
+        config = load_config()
+        for key, value in config.items():
+            if key == "MUST_JOIN_CHANNELS":
+                logger.info(f"{key}: {len(value)} channels configured")
+            elif key == "TASKS":
+                logger.info(f"{key}: {len(value)} tasks configured")
+            else:
+                logger.info(f"{key}: {value}")
+    except Exception as e:
+        logger.error(f"Error printing config: {e}")
+
+# Main function
+async def main():
+    # SIGTERM (systemd, docker) exits through sys.exit, so the atexit hooks flush storage and stats
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    # Ensure all required files exist
+    await asyncio.to_thread(ensure_files_exist)
+    await asyncio.to_thread(init_storage)
+    init_stats()
+    await resume_broadcast_jobs()
+
+    # Print config for debugging
+    print_config()
+
+    logger.info("Starting bot...")
+    await bot.delete_webhook()
+    # infinity_polling restarts polling itself after network errors
+    await bot.infinity_polling(timeout=60, logger_level=logging.ERROR)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -3,10 +3,26 @@ import json
 import time
 import threading
 import telebot
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from telebot import types
 import logging
 import datetime
 import re
+import sqlite3
+import copy
+import uuid
+import queue
+import hmac
+import secrets
+import atexit
+import signal
+import sys
+from types import MappingProxyType
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # Configure logging
 logging.basicConfig(
@@ -48,12 +64,146 @@ CONFIG = {
 
 # File paths
 DATABASE_FILE = "database.json"
+SQLITE_DATABASE_FILE = "database.db"
+JOURNAL_FILE = "database.journal"
+SNAPSHOT_FILE = "database.snapshot.json"
 CONFIG_FILE = "config.json"
 STATS_FILE = "stats.json"
 
+# Storage engine for user data: "sqlite" (one row per user), "json" (in-memory, flushed to
+# database.json) or "journal" (in-memory, every change appended to database.journal)
+STORAGE_ENGINE = "sqlite"
+FLUSH_INTERVAL = 5  # Seconds between background flushes of the json engine
+FLUSH_EVERY_MUTATIONS = 100  # Flush the json engine early after this many changes
+JOURNAL_COMPACT_BYTES = 4 * 1024 * 1024  # Compact the journal into a new snapshot past this size
+STATS_FLUSH_INTERVAL = 10  # Seconds between writes of the in-memory stats counters to stats.json
+BROADCAST_DIR = "broadcasts"  # Job state (<id>.json) and per-recipient result logs (<id>.log)
+BROADCAST_DELAY = 0.05  # Seconds between broadcast messages to stay under Telegram's rate limits
+MEMBERSHIP_CACHE_SIZE = 10000  # Most (channel, user) membership results kept in memory
+MEMBERSHIP_TTL = 300  # Seconds a "member" result is trusted
+MEMBERSHIP_NEGATIVE_TTL = 5  # Seconds a "not a member" result is trusted (kept short: users verify right after joining)
+VERIFY_WORKERS = 8  # Threads shared by all verify clicks for parallel channel checks
+VERIFY_TIMEOUT = 10  # Seconds a verify click may wait for all channel checks; unfinished ones count as unknown and the user is asked to retry
+HANDLER_WORKERS = 4  # Threads running update handlers; updates from one chat always go to the same thread
+HANDLER_QUEUE_SIZE = 1000  # Updates waiting per handler thread before dispatch blocks (backpressure on polling/webhook)
+HTTP_POOL_SIZE = VERIFY_WORKERS + HANDLER_WORKERS + 2  # Keep-alive connections to the Bot API: verify threads, handlers, polling, broadcast
+HTTP_CONNECT_TIMEOUT = 10  # Seconds to establish a connection to the Bot API
+HTTP_READ_TIMEOUT = 30  # Seconds to wait for a Bot API response (long polling adds its own timeout)
+HEARTBEAT_FILE = os.environ.get("BOT_HEARTBEAT_FILE", "")  # Set by the maker's supervisor, which restarts the bot when it goes stale
+HEARTBEAT_INTERVAL = 10  # Seconds between heartbeats
+HEARTBEAT_STALL_TIMEOUT = 120  # Seconds a handler thread, the polling loop or the webhook dispatcher may make no progress before heartbeats stop
+
+# Webhook mode: set WEBHOOK_URL to the public https base URL (e.g. behind a TLS-terminating reverse
+# proxy forwarding to WEBHOOK_HOST:WEBHOOK_PORT). Leave it empty to use long polling.
+WEBHOOK_URL = ""
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""  # X-Telegram-Bot-Api-Secret-Token value; a random one is generated per run if empty
+WEBHOOK_QUEUE_SIZE = 1000  # Updates waiting for a worker; when full Telegram gets a 503 and redelivers later
+WEBHOOK_MAX_BODY = 1024 * 1024
+
 # Initialize bot
 bot = telebot.TeleBot(CONFIG["BOT_TOKEN"])
 
+# One keep-alive connection pool shared by every Bot API call. Only connection failures and
+# 502/503/504 on GET requests are retried, so a send is never repeated after Telegram got it.
+def create_http_session():
+    session = requests.Session()
+    retries = Retry(total=3, connect=3, read=0, status=2, backoff_factor=0.5,
+                    status_forcelist=(502, 503, 504), allowed_methods=frozenset(["GET"]))
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE, max_retries=retries, pool_block=True)
+    session.mount("https://", adapter)
+    return session
+
+http_session = create_http_session()
+telebot.apihelper.session = http_session
+telebot.apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+telebot.apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+
+# Last time each long-running loop made progress (handler threads, polling, webhook dispatcher), checked by the heartbeat
+progress_ticks = {}
+
+def mark_progress(name):
+    progress_ticks[name] = time.time()
+
+# Drop-in replacement for telebot's worker pool: every update is hashed by chat id onto one
+# worker queue, so one user's updates run in order while different users run in parallel
+class ChatWorkerPool:
+    def __init__(self, telebot_instance, num_workers, queue_size=0):
+        self.telebot = telebot_instance
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(num_workers)]
+        self.max_depths = [0] * num_workers
+        self.processed = [0] * num_workers
+        self.exception_event = threading.Event()
+        self.exception_info = None
+        self.running = True
+        self.workers = [threading.Thread(target=self._work, args=(i,), name=f"chat-worker-{i}", daemon=True) for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    @staticmethod
+    def chat_key(update):
+        chat = getattr(update, "chat", None) or getattr(getattr(update, "message", None), "chat", None)
+        if chat is not None:
+            return chat.id
+        user = getattr(update, "from_user", None)
+        return user.id if user is not None else 0
+
+    def put(self, func, *args, **kwargs):
+        index = self.chat_key(args[0]) % len(self.queues) if args else 0
+        self.queues[index].put((func, args, kwargs))
+        self.max_depths[index] = max(self.max_depths[index], self.queues[index].qsize())
+
+    def _work(self, index):
+        tasks = self.queues[index]
+        while self.running:
+            # Idle threads tick every 0.5s too; only a thread stuck inside a handler stops ticking
+            mark_progress(f"chat-worker-{index}")
+            try:
+                func, args, kwargs = tasks.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                handled = self.telebot.exception_handler.handle(e) if self.telebot.exception_handler else False
+                if not handled:
+                    # Surfaced by the polling loop like telebot's own pool does
+                    self.exception_info = e
+                    self.exception_event.set()
+            finally:
+                self.processed[index] += 1
+
+    def queue_depths(self):
+        return [{"depth": tasks.qsize(), "max_depth": self.max_depths[i], "processed": self.processed[i]}
+                for i, tasks in enumerate(self.queues)]
+
+    def raise_exceptions(self):
+        if self.exception_event.is_set():
+            raise self.exception_info
+
+    def clear_exceptions(self):
+        self.exception_event.clear()
+
+    def close(self):
+        self.running = False
+        for worker in self.workers:
+            if worker is not threading.current_thread():
+                worker.join()
+
+bot.worker_pool.close()
+bot.worker_pool = ChatWorkerPool(bot, HANDLER_WORKERS, HANDLER_QUEUE_SIZE)
+
+# getUpdates returns at least once per long-polling timeout, so a polling loop that stops calling it has stalled
+def get_updates_with_progress(*args, **kwargs):
+    try:
+        return telebot.TeleBot.get_updates(bot, *args, **kwargs)
+    finally:
+        mark_progress("polling")
+
+bot.get_updates = get_updates_with_progress
+
 # User withdrawal states
 user_withdrawal_data = {}
 
@@ -105,16 +255,44 @@ def ensure_files_exist():
     except Exception as e:
         logger.error(f"Error ensuring files exist: {e}")
 
-# Load configuration from config.json
+# Make a read-only copy of a config value (dicts become mapping proxies, lists tuples)
+def freeze_config(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze_config(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze_config(item) for item in value)
+    return value
+
+# Parsed config.json shared by all handler threads, keyed by the file's mtime and size
+config_cache = {"signature": None, "config": None}
+config_cache_lock = threading.Lock()
+
+# Load configuration from config.json (re-parsed only when the file changes on disk)
 def load_config():
     try:
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r') as f:
-                return json.load(f)
-        return CONFIG
+        file_stat = os.stat(CONFIG_FILE)
+    except FileNotFoundError:
+        return freeze_config(CONFIG)
     except Exception as e:
         logger.error(f"Error loading config: {e}")
-        return CONFIG
+        return config_cache["config"] or freeze_config(CONFIG)
+
+    signature = (file_stat.st_mtime_ns, file_stat.st_size)
+    with config_cache_lock:
+        if config_cache["signature"] == signature:
+            return config_cache["config"]
+        try:
+            with open(CONFIG_FILE, 'r') as f:
+                config = freeze_config(json.load(f))
+        except Exception as e:
+            # Keep serving the last good config (e.g. while the file is being edited)
+            logger.error(f"Error loading config: {e}")
+            return config_cache["config"] or freeze_config(CONFIG)
+        if config_cache["config"] is not None and config_cache["config"].get("MUST_JOIN_CHANNELS") != config.get("MUST_JOIN_CHANNELS"):
+            membership_cache.clear()  # Cached results may be for channels that are no longer required
+        config_cache["signature"] = signature
+        config_cache["config"] = config
+        return config
 
 # Save configuration to config.json
 def save_config(config_data):
@@ -125,46 +303,640 @@ def save_config(config_data):
         logger.error(f"Error saving config: {e}")
 
 # Load database from database.json
-def load_database():
+def load_database(path=DATABASE_FILE):
     try:
-        if os.path.exists(DATABASE_FILE):
-            with open(DATABASE_FILE, 'r') as f:
+        if os.path.exists(path):
+            with open(path, 'r') as f:
                 return json.load(f)
         return {}
     except Exception as e:
         logger.error(f"Error loading database: {e}")
         return {}
 
-# Save database to database.json
-def save_database(db):
-    try:
-        with open(DATABASE_FILE, 'w') as f:
-            json.dump(db, f, indent=4)
-    except Exception as e:
-        logger.error(f"Error saving database: {e}")
+# Default record for a new user
+def new_user_record():
+    return {
+        "balance": 0,
+        "referrals": [],
+        "join_date": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        "withdrawals": []
+    }
+
+# JSON storage engine: users stay in memory, changed records are marked dirty and a
+# background thread flushes them to database.json every FLUSH_INTERVAL seconds or
+# FLUSH_EVERY_MUTATIONS changes. Records are replaced, never mutated in place, so a
+# flush can serialize a shallow snapshot without holding the lock.
+# The referral index (referrer -> set of referred users, referred user -> referrer) and
+# the running totals for /stats are rebuilt on load and kept up to date on every change.
+class JSONStorage:
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL, flush_every=FLUSH_EVERY_MUTATIONS):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.users = load_database(self.path)
+        self._index_referrals()
+        self._compute_totals()
+        self.dirty = set()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, name="json-storage-flush", daemon=True)
+        self.flusher.start()
+
+    def _index_referrals(self):
+        self.referral_sets = {}
+        self.referred_by = {}
+        for user_id, data in self.users.items():
+            self._index_user(user_id, data)
+
+    # Referral lists are append-only, so indexing only ever adds entries
+    def _index_user(self, user_id, data):
+        referrals = self.referral_sets.setdefault(user_id, set())
+        for referred_id in data.get("referrals", []):
+            if referred_id not in referrals:
+                referrals.add(referred_id)
+                self.referred_by.setdefault(referred_id, user_id)
+
+    def _compute_totals(self):
+        self.totals = {"total_users": 0, "total_balance": 0, "pending_withdrawals": 0, "pending_withdrawal_amount": 0}
+        for data in self.users.values():
+            self._add_to_totals(data, 1)
+
+    # Add (sign=1) or remove (sign=-1) one user's contribution to the running totals
+    def _add_to_totals(self, data, sign):
+        pending = [w for w in data.get("withdrawals", []) if w.get("status") == "pending"]
+        self.totals["total_users"] += sign
+        self.totals["total_balance"] += sign * data.get("balance", 0)
+        self.totals["pending_withdrawals"] += sign * len(pending)
+        self.totals["pending_withdrawal_amount"] += sign * sum(w.get("amount", 0) for w in pending)
+
+    def _replace_user(self, user_id, data):
+        old = self.users.get(user_id)
+        if old is not None:
+            self._add_to_totals(old, -1)
+        self._add_to_totals(data, 1)
+        self.users[user_id] = data
+        self._mark_dirty(user_id)
+
+    def _mark_dirty(self, user_id):
+        self.dirty.add(user_id)
+        if len(self.dirty) >= self.flush_every:
+            self.wakeup.set()
+
+    def has_user(self, user_id):
+        with self.lock:
+            return user_id in self.users
+
+    def get_user(self, user_id):
+        with self.lock:
+            data = self.users.get(user_id)
+        return copy.deepcopy(data) if data is not None else None
+
+    def put_user(self, user_id, data):
+        data = copy.deepcopy(data)
+        with self.lock:
+            self._replace_user(user_id, data)
+            self._index_user(user_id, data)
+
+    # A user can only ever be credited once, to whichever referrer came first
+    def add_referral(self, referrer_id, referred_id, reward):
+        with self.lock:
+            if referred_id in self.referred_by:
+                return False
+            referrer = self.users.get(referrer_id) or new_user_record()
+            referrer = dict(referrer, referrals=referrer["referrals"] + [referred_id],
+                            balance=referrer["balance"] + reward)
+            self._replace_user(referrer_id, referrer)
+            self.referral_sets.setdefault(referrer_id, set()).add(referred_id)
+            self.referred_by[referred_id] = referrer_id
+            return True
+
+    def get_referrer(self, user_id):
+        with self.lock:
+            return self.referred_by.get(user_id)
+
+    def count_referrals(self, user_id):
+        with self.lock:
+            return len(self.referral_sets.get(user_id, ()))
+
+    def add_withdrawal(self, user_id, record):
+        with self.lock:
+            user = self.users.get(user_id)
+            if user is None or user["balance"] < record["amount"]:
+                return False
+            user = dict(user, balance=user["balance"] - record["amount"],
+                        withdrawals=user.get("withdrawals", []) + [dict(record)])
+            self._replace_user(user_id, user)
+            return True
+
+    def user_ids(self):
+        with self.lock:
+            return list(self.users.keys())
+
+    def count_users(self):
+        with self.lock:
+            return len(self.users)
+
+    def aggregates(self):
+        with self.lock:
+            return dict(self.totals)
+
+    # Written to a temp file, then atomically replaced; raises on failure so flush() can retry
+    def _write_snapshot(self, snapshot):
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(snapshot, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.path)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                flushed = set(self.dirty)
+                snapshot = dict(self.users)
+                self.dirty.clear()
+            try:
+                self._write_snapshot(snapshot)
+            except Exception:
+                # Keep them dirty so the next flush writes them again
+                with self.lock:
+                    self.dirty |= flushed
+                raise
+            logger.debug(f"Flushed {len(flushed)} changed users to {self.path}")
+
+    def _flush_loop(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing database: {e}")
+
+    def close(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.flusher.join(timeout=self.flush_interval)
+        self.flush()
+
+# Journal storage engine: users stay in memory and every change is appended (and fsync'd)
+# to database.journal as one JSON line. On startup the snapshot is loaded and the journal
+# replayed; once the journal grows past JOURNAL_COMPACT_BYTES a background thread rotates
+# it to database.journal.1, writes a new snapshot and removes the rotated journal.
+class JournalStorage(JSONStorage):
+    def __init__(self, path, snapshot_path, compact_bytes=JOURNAL_COMPACT_BYTES):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.compact_bytes = compact_bytes
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.dirty = set()
+        self.seq = 0
+        self.users = {}
+        self.journal_size = 0
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self._replay()
+        self.journal = open(self.path, 'a')
+        self.flusher = threading.Thread(target=self._compact_loop, name="journal-compaction", daemon=True)
+        self.flusher.start()
+
+    def _replay(self):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.load(f)
+            self.users = snapshot["users"]
+            self.seq = snapshot["seq"]
+        else:
+            # First start on the journal engine: seed from database.json
+            self.users = load_database()
+        self._index_referrals()
+        self._compute_totals()
+
+        replayed = 0
+        for journal_path in (self.path + ".1", self.path):
+            if not os.path.exists(journal_path):
+                continue
+            with open(journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Ignoring incomplete entry at the end of {journal_path}")
+                        break
+                    if event["seq"] <= self.seq:
+                        continue
+                    self._apply(event)
+                    self.seq = event["seq"]
+                    replayed += 1
+
+        # Fold everything replayed into a fresh snapshot so the journal starts empty
+        self._write_snapshot({"seq": self.seq, "users": dict(self.users)})
+        open(self.path, 'w').close()
+        if os.path.exists(self.path + ".1"):
+            os.remove(self.path + ".1")
+        logger.info(f"Loaded {len(self.users)} users from {self.snapshot_path}, replayed {replayed} journal entries")
+
+    def _apply(self, event):
+        op = event["op"]
+        if op == "put":
+            JSONStorage.put_user(self, event["user_id"], event["data"])
+        elif op == "update":
+            user = dict(self.users.get(event["user_id"]) or new_user_record())
+            user.update(event.get("set", {}))
+            for key, entries in event.get("append", {}).items():
+                user[key] = user.get(key, []) + entries
+            for key in event.get("unset", []):
+                user.pop(key, None)
+            JSONStorage.put_user(self, event["user_id"], user)
+        elif op == "referral":
+            if event["referrer_id"] not in self.users:
+                JSONStorage.put_user(self, event["referrer_id"], dict(new_user_record(), join_date=event["date"]))
+            JSONStorage.add_referral(self, event["referrer_id"], event["referred_id"], event["reward"])
+        elif op == "withdrawal":
+            JSONStorage.add_withdrawal(self, event["user_id"], event["record"])
+        else:
+            logger.warning(f"Unknown journal operation: {op}")
+
+    def _append(self, event):
+        self.seq += 1
+        event = dict(event, seq=self.seq, date=datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"))
+        line = json.dumps(event) + "\n"
+        self.journal.write(line)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_size += len(line.encode())
+        return event
+
+    def _mark_dirty(self, user_id):
+        if self.journal_size >= self.compact_bytes:
+            self.wakeup.set()
+
+    # Changes to one user as a journal entry: changed fields, entries appended to lists (referrals and
+    # withdrawals grow with the user) and removed fields, so the entry stays small as the record grows
+    @staticmethod
+    def _diff(old, new):
+        changes, appended = {}, {}
+        for key, value in new.items():
+            previous = old.get(key)
+            if key in old and value == previous:
+                continue
+            if isinstance(value, list) and isinstance(previous, list) and value[:len(previous)] == previous:
+                appended[key] = value[len(previous):]
+            else:
+                changes[key] = value
+        removed = [key for key in old if key not in new]
+        return {name: part for name, part in (("set", changes), ("append", appended), ("unset", removed)) if part}
+
+    # New users are journaled whole; existing ones only by what changed, replayed onto the stored record
+    def put_user(self, user_id, data):
+        with self.lock:
+            old = self.users.get(user_id)
+            if old is None:
+                self._append({"op": "put", "user_id": user_id, "data": data})
+            else:
+                changes = self._diff(old, data)
+                if changes:
+                    self._append(dict(changes, op="update", user_id=user_id))
+            super().put_user(user_id, data)
+
+    def add_referral(self, referrer_id, referred_id, reward):
+        with self.lock:
+            if referred_id in self.referred_by:
+                return False
+            self._apply(self._append({"op": "referral", "referrer_id": referrer_id,
+                                      "referred_id": referred_id, "reward": reward}))
+            return True
+
+    def add_withdrawal(self, user_id, record):
+        with self.lock:
+            user = self.users.get(user_id)
+            if user is None or user["balance"] < record["amount"]:
+                return False
+            self._append({"op": "withdrawal", "user_id": user_id, "record": record})
+            return super().add_withdrawal(user_id, record)
+
+    def _write_snapshot(self, snapshot):
+        tmp_file = self.snapshot_path + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.snapshot_path)
+
+    # Move the journal to database.journal.1. If an earlier compaction failed to write its snapshot, the
+    # old .1 still holds entries no snapshot has, so the journal is appended to it instead of replacing it.
+    def _rotate_journal(self):
+        rotated = self.path + ".1"
+        if not os.path.exists(rotated):
+            os.replace(self.path, rotated)
+            return
+        with open(self.path, 'r') as journal, open(rotated, 'a') as target:
+            for line in journal:
+                target.write(line)
+            target.flush()
+            os.fsync(target.fileno())
+        os.remove(self.path)
+
+    def compact(self):
+        with self.flush_lock:
+            with self.lock:
+                if self.journal_size == 0:
+                    return
+                self.journal.close()
+                self._rotate_journal()
+                self.journal = open(self.path, 'a')
+                self.journal_size = 0
+                snapshot = {"seq": self.seq, "users": dict(self.users)}
+            self._write_snapshot(snapshot)
+            os.remove(self.path + ".1")
+            logger.info(f"Compacted journal into {self.snapshot_path} at seq {snapshot['seq']}")
+
+    def flush(self):
+        with self.lock:
+            self.journal.flush()
+
+    def _compact_loop(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if self.stopped.is_set():
+                break
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"Error compacting journal: {e}")
+
+    def close(self):
+        self.stopped.set()
+        self.wakeup.set()
+        self.flusher.join(timeout=5)
+        with self.lock:
+            self.journal.close()
+
+# SQLite storage engine: one row per user, referrals and withdrawals in their own tables
+class SQLiteStorage:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            balance NUMERIC NOT NULL DEFAULT 0,
+            join_date TEXT,
+            extra TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE TABLE IF NOT EXISTS referrals (
+            referrer_id TEXT NOT NULL,
+            referred_id TEXT NOT NULL,
+            PRIMARY KEY (referrer_id, referred_id)
+        );
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            amount NUMERIC NOT NULL,
+            date TEXT,
+            status TEXT,
+            account_number TEXT,
+            bank_name TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_referrals_referred ON referrals (referred_id);
+        CREATE INDEX IF NOT EXISTS idx_withdrawals_user ON withdrawals (user_id);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        self._compute_totals()
+
+    # Running totals for /stats: computed once on open, then adjusted by each write
+    def _compute_totals(self):
+        with self.lock:
+            users, balance = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(balance), 0) FROM users").fetchone()
+            pending, pending_amount = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM withdrawals WHERE status = 'pending'"
+            ).fetchone()
+        self.totals = {"total_users": users, "total_balance": balance,
+                       "pending_withdrawals": pending, "pending_withdrawal_amount": pending_amount}
+
+    # Writes collect their changes in a delta that is applied once the transaction has committed,
+    # so a failed or rolled back write leaves the totals untouched
+    def _new_delta(self):
+        return dict.fromkeys(self.totals, 0)
+
+    def _apply_delta(self, delta):
+        for key, value in delta.items():
+            self.totals[key] += value
+
+    def has_user(self, user_id):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row is not None
+
+    def get_user(self, user_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT balance, join_date, extra FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            referrals = [r[0] for r in self.conn.execute(
+                "SELECT referred_id FROM referrals WHERE referrer_id = ? ORDER BY rowid", (user_id,)
+            )]
+            withdrawals = [
+                {"amount": r[0], "date": r[1], "status": r[2], "account_number": r[3], "bank_name": r[4]}
+                for r in self.conn.execute(
+                    "SELECT amount, date, status, account_number, bank_name FROM withdrawals "
+                    "WHERE user_id = ? ORDER BY id", (user_id,)
+                )
+            ]
+        data = {"balance": row[0], "referrals": referrals, "join_date": row[1], "withdrawals": withdrawals}
+        data.update(json.loads(row[2]))
+        return data
+
+    # Referrals and withdrawals are append-only: entries beyond the stored count are inserted
+    def put_user(self, user_id, data):
+        extra = {k: v for k, v in data.items() if k not in ("balance", "referrals", "join_date", "withdrawals")}
+        delta = self._new_delta()
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                old = self.conn.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)).fetchone()
+                if old is None:
+                    delta["total_users"] += 1
+                delta["total_balance"] += data.get("balance", 0) - (old[0] if old else 0)
+                self.conn.execute(
+                    "INSERT INTO users (user_id, balance, join_date, extra) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET balance = excluded.balance, "
+                    "join_date = excluded.join_date, extra = excluded.extra",
+                    (user_id, data.get("balance", 0), data.get("join_date"), json.dumps(extra))
+                )
+                referrals = data.get("referrals", [])
+                stored = self.conn.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,)).fetchone()[0]
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO referrals (referrer_id, referred_id) VALUES (?, ?)",
+                    [(user_id, str(referred_id)) for referred_id in referrals[stored:]]
+                )
+                withdrawals = data.get("withdrawals", [])
+                stored = self.conn.execute("SELECT COUNT(*) FROM withdrawals WHERE user_id = ?", (user_id,)).fetchone()[0]
+                for record in withdrawals[stored:]:
+                    self._insert_withdrawal(user_id, record, delta)
+            self._apply_delta(delta)
+
+    # A user can only ever be credited once, to whichever referrer came first
+    def add_referral(self, referrer_id, referred_id, reward):
+        delta = self._new_delta()
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                already_referred = self.conn.execute(
+                    "SELECT 1 FROM referrals WHERE referred_id = ?", (referred_id,)
+                ).fetchone()
+                if already_referred:
+                    return False
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO users (user_id, join_date) VALUES (?, ?)",
+                    (referrer_id, new_user_record()["join_date"])
+                )
+                delta["total_users"] += cursor.rowcount
+                self.conn.execute(
+                    "INSERT INTO referrals (referrer_id, referred_id) VALUES (?, ?)", (referrer_id, referred_id)
+                )
+                self.conn.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (reward, referrer_id))
+                delta["total_balance"] += reward
+            self._apply_delta(delta)
+            return True
+
+    def get_referrer(self, user_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT referrer_id FROM referrals WHERE referred_id = ? ORDER BY rowid LIMIT 1", (user_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def count_referrals(self, user_id):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM referrals WHERE referrer_id = ?", (user_id,)).fetchone()[0]
+
+    def add_withdrawal(self, user_id, record):
+        delta = self._new_delta()
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                cursor = self.conn.execute(
+                    "UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?",
+                    (record["amount"], user_id, record["amount"])
+                )
+                if cursor.rowcount == 0:
+                    return False
+                delta["total_balance"] -= record["amount"]
+                self._insert_withdrawal(user_id, record, delta)
+            self._apply_delta(delta)
+            return True
+
+    def _insert_withdrawal(self, user_id, record, delta):
+        if record.get("status") == "pending":
+            delta["pending_withdrawals"] += 1
+            delta["pending_withdrawal_amount"] += record.get("amount", 0)
+        self.conn.execute(
+            "INSERT INTO withdrawals (user_id, amount, date, status, account_number, bank_name) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, record.get("amount", 0), record.get("date"), record.get("status"),
+             record.get("account_number"), record.get("bank_name"))
+        )
+
+    def user_ids(self):
+        with self.lock:
+            return [r[0] for r in self.conn.execute("SELECT user_id FROM users")]
+
+    def count_users(self):
+        with self.lock:
+            return self.totals["total_users"]
+
+    def aggregates(self):
+        with self.lock:
+            return dict(self.totals)
+
+    # Import users from database.json the first time the SQLite database is used
+    def import_json(self, path):
+        if self.count_users() > 0 or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r') as f:
+                db = json.load(f)
+        except Exception as e:
+            logger.error(f"Error reading {path} for import: {e}")
+            return
+        for user_id, data in db.items():
+            self.put_user(user_id, data)
+        if db:
+            logger.info(f"Imported {len(db)} users from {path} into {self.path}")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# Active storage engine (opened by init_storage)
+storage = None
+
+def init_storage():
+    global storage
+    if storage is not None:
+        return storage
+    if STORAGE_ENGINE == "sqlite":
+        storage = SQLiteStorage(SQLITE_DATABASE_FILE)
+        storage.import_json(DATABASE_FILE)
+    elif STORAGE_ENGINE == "journal":
+        storage = JournalStorage(JOURNAL_FILE, SNAPSHOT_FILE)
+    else:
+        storage = JSONStorage(DATABASE_FILE)
+    atexit.register(storage.close)
+    logger.info(f"Using {STORAGE_ENGINE} storage engine")
+    return storage
 
 # Thread-safe database operations
 db_lock = threading.Lock()
 
+def user_exists(user_id):
+    with db_lock:
+        return storage.has_user(str(user_id))
+
 def get_user_data(user_id):
     with db_lock:
-        db = load_database()
         user_id_str = str(user_id)
-        if user_id_str not in db:
-            db[user_id_str] = {
-                "balance": 0,
-                "referrals": [],
-                "join_date": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
-                "withdrawals": []
-            }
-            save_database(db)
-        return db[user_id_str]
+        data = storage.get_user(user_id_str)
+        if data is None:
+            data = new_user_record()
+            storage.put_user(user_id_str, data)
+        return data
 
 def update_user_data(user_id, data):
     with db_lock:
-        db = load_database()
-        db[str(user_id)] = data
-        save_database(db)
+        storage.put_user(str(user_id), data)
+
+# Credit a referral once; returns False if the referral was already counted
+def credit_referral(referrer_id, referred_id, reward):
+    with db_lock:
+        return storage.add_referral(str(referrer_id), str(referred_id), reward)
+
+# Who referred this user (None if they joined without a referral link)
+def get_referrer(user_id):
+    with db_lock:
+        return storage.get_referrer(str(user_id))
+
+def count_referrals(user_id):
+    with db_lock:
+        return storage.count_referrals(str(user_id))
+
+# Debit the balance and record the withdrawal; returns False if the balance is too low
+def record_withdrawal(user_id, record):
+    with db_lock:
+        return storage.add_withdrawal(str(user_id), record)
 
 # Load stats from stats.json
 def load_stats():
@@ -195,28 +967,108 @@ def load_stats():
             "blocked_users": 0
         }
 
-# Save stats to stats.json
+# Save stats to stats.json (written to a temp file, then atomically replaced)
 def save_stats(stats):
     try:
-        with open(STATS_FILE, 'w') as f:
+        tmp_file = STATS_FILE + ".tmp"
+        with open(tmp_file, 'w') as f:
             json.dump(stats, f, indent=4)
+        os.replace(tmp_file, STATS_FILE)
     except Exception as e:
         logger.error(f"Error saving stats: {e}")
 
-# Thread-safe stats operations
-stats_lock = threading.Lock()
+# In-memory stats counters: handlers only touch memory, a background thread writes
+# stats.json every STATS_FLUSH_INTERVAL seconds and once more at exit
+class StatsCounters:
+    def __init__(self, flush_interval=STATS_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.values = load_stats()
+        self.changed = False
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, name="stats-flush", daemon=True)
+        self.flusher.start()
+
+    def update(self, key, value=1, increment=True):
+        with self.lock:
+            if key in self.values:
+                if increment:
+                    self.values[key] += value
+                else:
+                    self.values[key] = value
+                self.changed = True
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
 
-def update_stats(key, value=1, increment=True):
-    with stats_lock:
-        stats = load_stats()
-        if key in stats:
-            if increment:
-                stats[key] += value
-            else:
-                stats[key] = value
+    def flush(self):
+        with self.lock:
+            if not self.changed:
+                return
+            stats = dict(self.values)
+            self.changed = False
         save_stats(stats)
 
-# Check if user is a member of a channel
+    def _flush_loop(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.flusher.join(timeout=self.flush_interval)
+        self.flush()
+
+# Active stats counters (created by init_stats)
+stats_counters = None
+
+def init_stats():
+    global stats_counters
+    if stats_counters is None:
+        stats_counters = StatsCounters()
+        atexit.register(stats_counters.close)
+    return stats_counters
+
+def update_stats(key, value=1, increment=True):
+    stats_counters.update(key, value, increment)
+
+# Bounded LRU cache whose entries expire after a per-entry TTL
+class TTLCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if entry[1] <= time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# (channel, user) -> joined, so repeated verify clicks don't each cost a get_chat_member call
+membership_cache = TTLCache(MEMBERSHIP_CACHE_SIZE)
+
+# Check if user is a member of a channel; None when Telegram couldn't be asked (rate limit, network), so the answer is unknown
 def is_member(user_id, chat_id):
     try:
         # Extract username from URL if it's a full URL
@@ -230,11 +1082,52 @@ def is_member(user_id, chat_id):
             else:
                 channel_username = "@" + chat_id
 
+        cache_key = (channel_username.lower(), user_id)
+        cached = membership_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         member = bot.get_chat_member(channel_username, user_id)
-        return member.status in ['member', 'administrator', 'creator']
+        joined = member.status in ['member', 'administrator', 'creator']
+        membership_cache.set(cache_key, joined, MEMBERSHIP_TTL if joined else MEMBERSHIP_NEGATIVE_TTL)
+        return joined
+    except telebot.apihelper.ApiTelegramException as e:
+        logger.error(f"Error checking membership: {e}")
+        if e.error_code == 400:
+            return False  # Channel not found or the bot isn't an admin there: the user can't pass
+        return None
     except Exception as e:
         logger.error(f"Error checking membership: {e}")
-        return False
+        return None
+
+verify_executor = ThreadPoolExecutor(max_workers=VERIFY_WORKERS, thread_name_prefix="verify")
+
+# Check all required channels at once; stop at the first one the user hasn't joined.
+# Returns None instead of False when a check failed or didn't finish in time, so a slow or
+# rate-limited API never reports a member as "not joined".
+def has_joined_all(user_id, channel_names):
+    if not channel_names:
+        return True
+    pending = {verify_executor.submit(is_member, user_id, name) for name in channel_names}
+    deadline = time.monotonic() + VERIFY_TIMEOUT
+    unknown = False
+    try:
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"Verification of user {user_id} timed out with {len(pending)} checks unfinished")
+                return None
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                joined = future.result()
+                if joined is False:
+                    return False
+                if joined is None:
+                    unknown = True
+        return None if unknown else True
+    finally:
+        for future in pending:
+            future.cancel()
 
 # Create keyboard with channel butSTARs
 def channels_keyboard():
@@ -308,62 +1201,252 @@ def broadcast_command(message):
 def process_broadcast_message(message):
     try:
         update_stats("messages_received")
-        broadcast_content = message
-        db = load_database()
-        user_ids = list(db.keys())
-        successful_broadcasts = 0
-        failed_broadcasts = 0
-        blocked_users_count = 0
-
-        for user_id in user_ids:
+        content = broadcast_content_from_message(message)
+        if content is None:
+            bot.send_message(message.chat.id, f"Unsupported broadcast content type.") # Notify admin about unsupported type
+            update_stats("messages_sent")
+            return
+
+        job = BroadcastJob(message.chat.id, content, storage.user_ids())
+        broadcast_jobs[job.job_id] = job
+        start_broadcast_job(job)
+        bot.send_message(message.chat.id, f"Broadcast {job.job_id} started for {job.total} users.\nUse /broadcasts to check progress, pause, resume or cancel it.")
+        update_stats("messages_sent")
+    except Exception as e:
+        logger.error(f"Error processing broadcast message: {e}")
+        try:
+            bot.send_message(message.chat.id, "An error occurred while processing the broadcast.")
+            update_stats("messages_sent")
+        except:
+            pass
+
+# Capture what the admin sent in a form that can be saved and re-sent after a restart
+def broadcast_content_from_message(message):
+    if message.text:
+        return {"type": "text", "text": message.text}
+    elif message.photo:
+        return {"type": "photo", "file_id": message.photo[-1].file_id, "caption": message.caption}
+    elif message.video:
+        return {"type": "video", "file_id": message.video.file_id, "caption": message.caption}
+    elif message.forward_from_chat:
+        return {"type": "forward", "from_chat_id": message.forward_from_chat.id, "message_id": message.forward_from_message_id}
+    elif message.forward_from:
+        return {"type": "forward", "from_chat_id": message.chat.id, "message_id": message.message_id} # Handle forwarded messages from users
+    return None
+
+# Send the saved broadcast content to one user
+def send_broadcast_content(user_id, content):
+    if content["type"] == "text":
+        bot.send_message(user_id, content["text"])
+    elif content["type"] == "photo":
+        bot.send_photo(user_id, content["file_id"], caption=content["caption"])
+    elif content["type"] == "video":
+        bot.send_video(user_id, content["file_id"], caption=content["caption"])
+    else:
+        bot.forward_message(user_id, content["from_chat_id"], content["message_id"])
+
+# Broadcast job persisted under BROADCAST_DIR so it survives restarts
+class BroadcastJob:
+    def __init__(self, admin_chat_id, content, user_ids, job_id=None, status="running", created=None):
+        self.job_id = job_id or uuid.uuid4().hex[:8]
+        self.admin_chat_id = admin_chat_id
+        self.content = content
+        self.user_ids = user_ids
+        self.total = len(user_ids)
+        self.created = created or time.strftime("%Y-%m-%d %H:%M:%S")
+        self.status = status
+        self.counts = {"sent": 0, "failed": 0, "blocked": 0}
+        self.processed = 0
+        self.stop_status = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def state_path(self):
+        return os.path.join(BROADCAST_DIR, f"{self.job_id}.json")
+
+    @property
+    def log_path(self):
+        return os.path.join(BROADCAST_DIR, f"{self.job_id}.log")
+
+    @classmethod
+    def load(cls, state_path):
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        return cls(state["admin_chat_id"], state["content"], state["user_ids"], job_id=state["job_id"],
+                   status=state["status"], created=state["created"])
+
+    def save(self):
+        os.makedirs(BROADCAST_DIR, exist_ok=True)
+        state = {"job_id": self.job_id, "admin_chat_id": self.admin_chat_id, "content": self.content,
+                 "user_ids": self.user_ids, "status": self.status, "created": self.created}
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    # The result log is the job's cursor: every user listed there is done and is skipped on resume
+    def load_results(self):
+        done = set()
+        counts = {"sent": 0, "failed": 0, "blocked": 0}
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] in counts and parts[0] not in done:
+                        done.add(parts[0])
+                        counts[parts[1]] += 1
+        with self.lock:
+            self.counts = counts
+            self.processed = len(done)
+        return done
+
+    def progress(self):
+        with self.lock:
+            return dict(self.counts, status=self.status, processed=self.processed, total=self.total)
+
+    def request_stop(self, status):
+        self.stop_status = status
+        self.stopped.set()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+broadcast_jobs = {}
+
+# Send a broadcast to every user not yet in its result log
+def run_broadcast_job(job):
+    done = job.load_results()
+    logger.info(f"Broadcast {job.job_id}: {job.total - len(done)} of {job.total} users left")
+    with open(job.log_path, 'a') as log_file:
+        for user_id in job.user_ids:
+            if job.stopped.is_set():
+                break
+            if user_id in done:
+                continue
+            result = "sent"
             try:
                 if user_id.isdigit():
-                    user_id_int = int(user_id)
-                    if broadcast_content.text:
-                        bot.send_message(user_id_int, broadcast_content.text)
-                    elif broadcast_content.photo:
-                        photo_id = broadcast_content.photo[-1].file_id
-                        caption = broadcast_content.caption
-                        bot.send_photo(user_id_int, photo_id, caption=caption)
-                    elif broadcast_content.video:
-                        video_id = broadcast_content.video.file_id
-                        caption = broadcast_content.caption
-                        bot.send_video(user_id_int, video_id, caption=caption)
-                    elif broadcast_content.forward_from_chat:
-                        bot.forward_message(user_id_int, broadcast_content.forward_from_chat.id, broadcast_content.forward_from_message_id)
-                    elif broadcast_content.forward_from:
-                        bot.forward_message(user_id_int, broadcast_content.chat.id, broadcast_content.message_id) # Handle forwarded messages from users
-                    else:
-                        bot.send_message(message.chat.id, f"Unsupported broadcast content type.") # Notify admin about unsupported type
-                        return
-
-                    successful_broadcasts += 1
-                    time.sleep(0.05) # Add a small delay to avoid rate limiting
+                    send_broadcast_content(int(user_id), job.content)
                     update_stats("messages_sent")
+                    time.sleep(BROADCAST_DELAY) # Add a small delay to avoid rate limiting
                 else:
                     logger.warning(f"Skipping non-integer user ID: {user_id}")
-                    failed_broadcasts += 1 # Increment failed count for non-integer IDs
+                    result = "failed"
             except telebot.apihelper.ApiTelegramException as e:
                 if e.result_json and e.result_json.get('description') == 'Forbidden: bot was blocked by the user':
-                    logger.warning(f"Bot blocked by user {user_id_int}")
-                    blocked_users_count += 1
+                    logger.warning(f"Bot blocked by user {user_id}")
+                    update_stats("blocked_users")
+                    result = "blocked"
                 else:
-                    logger.error(f"Failed to broadcast to user {user_id_int}: {e}")
-                failed_broadcasts += 1
+                    logger.error(f"Failed to broadcast to user {user_id}: {e}")
+                    result = "failed"
             except Exception as e:
                 logger.error(f"An unexpected error occurred while broadcasting to user {user_id}: {e}")
-                failed_broadcasts += 1
+                result = "failed"
+
+            log_file.write(f"{user_id} {result}\n")
+            log_file.flush()
+            with job.lock:
+                job.processed += 1
+                job.counts[result] += 1
 
-        total_users = len(db)
-        active_users = total_users - blocked_users_count
+    with job.lock:
+        job.status = job.stop_status or "completed"
+    job.save()
 
-        bot.send_message(message.chat.id, f"Broadcast completed.\nSuccessful: {successful_broadcasts}\nFailed: {failed_broadcasts}\nUsers who blocked the bot: {blocked_users_count}\nActive users remaining: {active_users}")
+    progress = job.progress()
+    active_users = progress["total"] - progress["blocked"]
+    try:
+        bot.send_message(job.admin_chat_id, f"Broadcast {job.job_id} {progress['status']}.\nProcessed: {progress['processed']}/{progress['total']}\nSuccessful: {progress['sent']}\nFailed: {progress['failed'] + progress['blocked']}\nUsers who blocked the bot: {progress['blocked']}\nActive users remaining: {active_users}")
         update_stats("messages_sent")
-        update_stats("blocked_users", blocked_users_count) # Update blocked users count in stats
     except Exception as e:
-        logger.error(f"Error processing broadcast message: {e}")
+        logger.error(f"Error sending broadcast report: {e}")
+
+# Start (or restart) a broadcast job in the background
+def start_broadcast_job(job):
+    job.stop_status = None
+    job.stopped.clear()
+    with job.lock:
+        job.status = "running"
+    job.save()
+    job.thread = threading.Thread(target=run_broadcast_job, args=(job,), name=f"broadcast-{job.job_id}", daemon=True)
+    job.thread.start()
+
+# Load saved broadcast jobs and resume the ones a restart interrupted
+def resume_broadcast_jobs():
+    if not os.path.isdir(BROADCAST_DIR):
+        return
+    for file_name in sorted(os.listdir(BROADCAST_DIR)):
+        if not file_name.endswith(".json") or file_name[:-len(".json")] in broadcast_jobs:
+            continue
         try:
-            bot.send_message(message.chat.id, "An error occurred while processing the broadcast.")
+            job = BroadcastJob.load(os.path.join(BROADCAST_DIR, file_name))
+        except Exception as e:
+            logger.error(f"Could not load broadcast job {file_name}: {e}")
+            continue
+        broadcast_jobs[job.job_id] = job
+        if job.status == "running":
+            logger.info(f"Resuming interrupted broadcast {job.job_id}")
+            start_broadcast_job(job)
+        else:
+            job.load_results()
+
+# Broadcast jobs command handler: list, pause, resume or cancel
+@bot.message_handler(commands=['broadcasts'])
+def broadcasts_command(message):
+    try:
+        update_stats("messages_received")
+
+        # Check if user is admin
+        if message.from_user.id != CONFIG["ADMIN_ID"]:
+            bot.send_message(message.chat.id, "❌ You don't have permission to use this command.")
+            update_stats("messages_sent")
+            return
+
+        args = message.text.split()[1:]
+        if not args:
+            jobs = sorted(broadcast_jobs.values(), key=lambda j: j.created, reverse=True)[:10]
+            if not jobs:
+                reply = "No broadcast jobs yet."
+            else:
+                lines = ["📣 Broadcast Jobs\n"]
+                for job in jobs:
+                    p = job.progress()
+                    lines.append(f"{job.job_id} - {p['status']} - {p['processed']}/{p['total']} (sent {p['sent']}, failed {p['failed']}, blocked {p['blocked']}) - {job.created}")
+                lines.append("\nUse /broadcasts pause|resume|cancel <id>")
+                reply = "\n".join(lines)
+        elif len(args) != 2 or args[0] not in ("pause", "resume", "cancel"):
+            reply = "Usage: /broadcasts or /broadcasts pause|resume|cancel <id>"
+        else:
+            action, job_id = args
+            job = broadcast_jobs.get(job_id)
+            if not job:
+                reply = f"Broadcast {job_id} not found."
+            elif action == "resume":
+                if job.is_running() or job.status not in ("paused", "running"):
+                    reply = f"Broadcast {job_id} is {job.status} and cannot be resumed."
+                else:
+                    start_broadcast_job(job)
+                    reply = f"Broadcast {job_id} resumed."
+            elif job.is_running():
+                job.request_stop("paused" if action == "pause" else "cancelled")
+                reply = f"Broadcast {job_id}: {action} requested."
+            elif action == "cancel" and job.status == "paused":
+                with job.lock:
+                    job.status = "cancelled"
+                job.save()
+                reply = f"Broadcast {job_id} cancelled."
+            else:
+                reply = f"Broadcast {job_id} is {job.status}; nothing to {action}."
+
+        bot.send_message(message.chat.id, reply)
+        update_stats("messages_sent")
+    except Exception as e:
+        logger.error(f"Error in broadcasts command: {e}")
+        try:
+            bot.send_message(message.chat.id, "An error occurred. Please try again.")
             update_stats("messages_sent")
         except:
             pass
@@ -375,6 +1458,7 @@ def start_command(message):
         update_stats("messages_received")
         user_id = message.from_user.id
         username = message.from_user.username or f"user{user_id}"
+        is_new_user = not user_exists(user_id)
         user_data = get_user_data(user_id)
 
         # Check if this is a referral
@@ -382,16 +1466,11 @@ def start_command(message):
             try:
                 referrer_id = message.text.split()[1]
                 if referrer_id.isdigit() and str(user_id) != referrer_id:
-                    referrer_data = get_user_data(referrer_id)
-                    if str(user_id) not in referrer_data["referrals"]:
-                        config = load_config()
-                        referral_reward = config["REFERRAL_REWARD"]
-
-                        # Add referral to referrer's list
-                        referrer_data["referrals"].append(str(user_id))
-                        referrer_data["balance"] += referral_reward
-                        update_user_data(referrer_id, referrer_data)
+                    config = load_config()
+                    referral_reward = config["REFERRAL_REWARD"]
 
+                    # Add referral to referrer's list and credit the reward
+                    if credit_referral(referrer_id, user_id, referral_reward):
                         # Update stats
                         update_stats("total_referrals")
 
@@ -409,10 +1488,8 @@ def start_command(message):
                 logger.error(f"Error processing referral: {e}")
 
         # Count new user
-        with db_lock:
-            db = load_database()
-            if str(user_id) not in db:
-                update_stats("total_users")
+        if is_new_user:
+            update_stats("total_users")
 
         # Send join channels message
         welcome_text = (
@@ -450,18 +1527,11 @@ def callback_handler(call):
         if call.data == "verify_membership":
             # Check required channels
             required_channels = [ch for ch in config["MUST_JOIN_CHANNELS"] if ch["check"]]
-            all_joined = True
-
-            for channel in required_channels:
-                channel_name = channel["url"].split("/")[-1]
-                try:
-                    if not is_member(user_id, channel_name):
-                        all_joined = False
-                        break
-                except Exception as e:
-                    logger.error(f"Error in verification: {e}")
-                    all_joined = False
-                    break
+            try:
+                all_joined = has_joined_all(user_id, [channel["url"].split("/")[-1] for channel in required_channels])
+            except Exception as e:
+                logger.error(f"Error in verification: {e}")
+                all_joined = None
 
             if all_joined:
                 # User joined all required channels, show main menu
@@ -480,6 +1550,13 @@ def callback_handler(call):
                     parse_mode="HTML"
                 )
                 update_stats("messages_sent")
+            elif all_joined is None:
+                # Membership couldn't be checked right now (busy or rate limited); don't claim the user hasn't joined
+                bot.answer_callback_query(
+                    call.id,
+                    "⏳ Couldn't check your channels right now. Please tap verify again in a moment.",
+                    show_alert=True
+                )
             else:
                 # User hasn't joined all required channels
                 bot.answer_callback_query(
@@ -508,7 +1585,7 @@ def callback_handler(call):
         # Handle referrals callback
         elif call.data == "referrals":
             referral_link = f"https://t.me/{config['BOT_USERNAME'].replace('@', '')}?start={user_id}"
-            referral_count = len(user_data["referrals"])
+            referral_count = count_referrals(user_id)
             referral_reward = config["REFERRAL_REWARD"]
 
             referral_text = (
@@ -691,10 +1768,7 @@ def process_withdrawal_bank_name(message):
         amount = user_withdrawal_data[user_id]["amount"]
         account_number = user_withdrawal_data[user_id]["account_number"]
 
-        # Process withdrawal
-        user_data["balance"] -= amount
-
-        # Record withdrawal in user data
+        # Record withdrawal and debit the balance
         withdrawal_record = {
             "amount": amount,
             "date": datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
@@ -703,11 +1777,15 @@ def process_withdrawal_bank_name(message):
             "bank_name": bank_name
         }
 
-        if "withdrawals" not in user_data:
-            user_data["withdrawals"] = []
-
-        user_data["withdrawals"].append(withdrawal_record)
-        update_user_data(user_id, user_data)
+        if not record_withdrawal(user_id, withdrawal_record):
+            bot.send_message(
+                message.chat.id,
+                "❌ Insufficient balance. Please try the withdrawal again.",
+                reply_markup=main_menu_keyboard()
+            )
+            update_stats("messages_sent")
+            del user_withdrawal_data[user_id]
+            return
 
         # Send withdrawal request to payment channel
         try:
@@ -791,15 +1869,13 @@ def stats_command(message):
             update_stats("messages_sent")
             return
 
-        stats = load_stats()
-        db = load_database()
+        stats = stats_counters.snapshot()
+        totals = storage.aggregates()
+        total_users = totals["total_users"]
 
         # Calculate additional stats
-        active_users = len(db) - stats.get('blocked_users', 0)
-        total_balance = 0
-        for user_data in db.values():
-            if 'balance' in user_data:
-                total_balance += user_data['balance']
+        active_users = total_users - stats.get('blocked_users', 0)
+        total_balance = totals["total_balance"]
 
         # Format start date
         start_date = stats.get("start_date", "N/A")
@@ -816,14 +1892,17 @@ def stats_command(message):
 
         stats_text = (
             f"📊 Bot Statistics\n\n"
-            f"👤 Total Users: {len(db)}\n"
+            f"👤 Total Users: {total_users}\n"
             f"✅ Active Users (Did not block): {active_users}\n"
             f"🚫 Blocked Users: {stats.get('blocked_users', 0)}\n"
             f"🔄 Total Referrals: {stats.get('total_referrals', 0)}\n"
             f"💎 Total Payouts: {total_balance}STAR \n"
+            f"⏳ Pending Withdrawals: {totals['pending_withdrawals']} ({totals['pending_withdrawal_amount']}STAR )\n"
         )
         if days_running != "N/A":
             stats_text += f"⏳ Bot Running For: {days_running} days\n"
+        depths = bot.worker_pool.queue_depths()
+        stats_text += f"⚙️ Handler Queues: {' / '.join(str(d['depth']) for d in depths)} (peak {max(d['max_depth'] for d in depths)})\n"
 
         bot.send_message(message.chat.id, stats_text, parse_mode="HTML")
         update_stats("messages_sent")
@@ -877,27 +1956,142 @@ def print_config():
         for key, value in config.items():
             if key == "MUST_JOIN_CHANNELS":
                 logger.info(f"{key}: {len(value)} channels configured")
+            elif key == "TASKS":
+                logger.info(f"{key}: {len(value)} tasks configured")
             else:
                 logger.info(f"{key}: {value}")
     except Exception as e:
         logger.error(f"Error printing config: {e}")
 
-# Main function
-def main():
-    try:
-        # Ensure all required files exist
-        ensure_files_exist()
+webhook_updates = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+webhook_secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+webhook_server = None
 
-        # Print config for debugging
-        print_config()
+# Receive updates from Telegram and queue them for the webhook workers
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.send_error(404)
+            return
+        if not hmac.compare_digest(self.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), webhook_secret):
+            logger.warning(f"Rejected webhook request from {self.client_address[0]}: bad secret token")
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = 0
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            self.send_error(400)
+            return
+        try:
+            update_json = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error(400)
+            return
+        try:
+            webhook_updates.put_nowait(update_json)
+        except queue.Full:
+            logger.warning("Webhook update queue is full, asking Telegram to redeliver")
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
 
-        logger.info("Starting bot...")
-        bot.remove_webhook()
-        bot.polling(none_stop=True, interval=0, timeout=60)
-    except Exception as e:
-        logger.error(f"Critical error: {e}")
-        time.sleep(10)  # Wait before retrying
-        main()  # Restart bot
+    def log_message(self, format, *args):
+        logger.debug(f"Webhook {self.client_address[0]}: {format % args}")
+
+# Dispatch queued webhook updates to the handlers
+def webhook_worker():
+    while True:
+        mark_progress("webhook-dispatcher")
+        try:
+            update_json = webhook_updates.get(timeout=1)
+        except queue.Empty:
+            continue
+        try:
+            bot.process_new_updates([telebot.types.Update.de_json(update_json)])
+        except Exception as e:
+            logger.error(f"Error handling webhook update {update_json.get('update_id')}: {e}")
+
+# Start the webhook HTTP server and its workers (once, even if main() restarts)
+def start_webhook_server():
+    global webhook_server
+    if webhook_server is None:
+        # A single dispatcher keeps updates in arrival order; handlers still run on the per-chat pool,
+        # whose bounded queues back up into webhook_updates and from there into 503s for Telegram
+        threading.Thread(target=webhook_worker, name="webhook-dispatcher", daemon=True).start()
+        webhook_server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT), WebhookRequestHandler)
+        webhook_server.daemon_threads = True
+        logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{webhook_server.server_port}{WEBHOOK_PATH}")
+    return webhook_server
+
+# Register the webhook with Telegram and serve updates
+def run_webhook():
+    server = start_webhook_server()
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=webhook_secret)
+    logger.info(f"Webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    server.serve_forever()
+
+# Loops that made no progress for HEARTBEAT_STALL_TIMEOUT seconds
+def stalled_loops():
+    now = time.time()
+    return [name for name, ticked_at in list(progress_ticks.items()) if now - ticked_at > HEARTBEAT_STALL_TIMEOUT]
+
+# Touch the heartbeat file only while every loop makes progress, so a wedged handler, a deadlocked
+# lock or a stuck polling loop stops the heartbeat and the supervisor restarts the bot
+def heartbeat_loop():
+    while True:
+        stalled = stalled_loops()
+        if stalled:
+            logger.warning(f"No progress from {', '.join(stalled)}; withholding heartbeat")
+        else:
+            try:
+                with open(HEARTBEAT_FILE, "a"):
+                    os.utime(HEARTBEAT_FILE, None)
+            except OSError as e:
+                logger.error(f"Error writing heartbeat: {e}")
+        time.sleep(HEARTBEAT_INTERVAL)
+
+heartbeat_thread = None
+
+# Start the heartbeat thread (once, and only when running under a supervisor)
+def start_heartbeat():
+    global heartbeat_thread
+    if HEARTBEAT_FILE and heartbeat_thread is None:
+        heartbeat_thread = threading.Thread(target=heartbeat_loop, name="heartbeat", daemon=True)
+        heartbeat_thread.start()
+
+# Main function (retries in a loop; the old recursive restart grew the stack on every error)
+def main():
+    # SIGTERM (supervisor stop/restart, systemd, docker) exits through sys.exit, so the atexit hooks
+    # flush the storage write-behind buffer and the stats counters
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    while True:
+        try:
+            # Ensure all required files exist
+            ensure_files_exist()
+            init_storage()
+            init_stats()
+            resume_broadcast_jobs()
+            start_heartbeat()
+
+            # Print config for debugging
+            print_config()
+
+            if WEBHOOK_URL:
+                logger.info("Starting bot in webhook mode...")
+                run_webhook()
+            else:
+                logger.info("Starting bot...")
+                bot.remove_webhook()
+                bot.polling(none_stop=True, interval=0, timeout=60)
+            return
+        except Exception as e:
+            logger.error(f"Critical error: {e}")
+            time.sleep(10)  # Wait before retrying
 
 if __name__ == "__main__":
     main()
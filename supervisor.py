@@ -0,0 +1,316 @@
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+import subprocess
+from collections import deque
+
+logger = logging.getLogger("supervisor")
+
+STOP_TIMEOUT = 10  # Seconds a child gets to exit after SIGTERM before it is killed
+CHILD_LOG_FILE = "bot.log"  # stdout/stderr of the child, inside its directory
+CHILD_PID_FILE = "bot.pid"  # Lets a restarted supervisor find and stop children it lost track of
+HEARTBEAT_FILE = "heartbeat"  # Touched by the child (see BOT_HEARTBEAT_FILE in the templates)
+HEARTBEAT_TIMEOUT = 60  # Seconds without a heartbeat before a child counts as hung and is restarted
+RESTART_BACKOFF_BASE = 2  # Seconds before the first restart; doubles with every crash in a row
+RESTART_BACKOFF_MAX = 300
+STABLE_AFTER = 120  # Seconds a child must stay healthy for its backoff to reset
+CRASH_LOOP_RESTARTS = 5  # Restarts within CRASH_LOOP_WINDOW that put a child in crash-loop (no more restarts)
+CRASH_LOOP_WINDOW = 600
+MEMORY_LIMIT_MB = 256  # Resident memory above which a child is restarted (0 disables)
+CPU_LIMIT_PERCENT = 90  # CPU use (of one core) above which, for CPU_LIMIT_SECONDS, a child is restarted (0 disables)
+CPU_LIMIT_SECONDS = 60
+CHILD_NICE = 5  # Scheduling priority offset for children, so the maker stays responsive
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# (cpu seconds, resident bytes) of a process from /proc, or None where /proc is not available
+def read_process_usage(pid):
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (OSError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, int(fields[21]) * PAGE_SIZE
+
+# One deployed bot: a rendered bot.py in its own directory, run with this interpreter
+class ChildProcess:
+    def __init__(self, name, directory, script="bot.py"):
+        self.name = name
+        self.directory = directory
+        self.script = script
+        self.process = None
+        self.state = "starting"  # starting, running, stopping, backoff, crash-loop, stopped
+        self.restarts = 0
+        self.restart_times = deque()
+        self.failures_in_a_row = 0
+        self.started_at = None
+        self.next_start_at = None
+        self.stop_deadline = None
+        self.stop_reason = None
+        self.last_exit_code = None
+        self.last_problem = None
+        self.cpu_sample = None
+        self.cpu_percent = 0.0
+        self.cpu_over_since = None
+        self.rss_mb = 0.0
+
+    @property
+    def heartbeat_path(self):
+        return os.path.join(os.path.abspath(self.directory), HEARTBEAT_FILE)
+
+    @property
+    def pid_path(self):
+        return os.path.join(self.directory, CHILD_PID_FILE)
+
+    # Whether `pid` is alive and running in this child's directory (exited, zombie and reused pids are not)
+    def runs_here(self, pid):
+        try:
+            return os.path.realpath(f"/proc/{pid}/cwd") == os.path.realpath(self.directory)
+        except OSError:
+            return False
+
+    def wait_for_exit(self, pid, timeout):
+        deadline = time.time() + timeout
+        while self.runs_here(pid):
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    # Stop a child left running by an earlier supervisor (e.g. after the maker was killed), and wait for it
+    # to exit so the new child never runs alongside it
+    def stop_stale_process(self):
+        try:
+            with open(self.pid_path, "r") as f:
+                pid = int(f.read().strip())
+            if not self.runs_here(pid):
+                return
+            os.kill(pid, signal.SIGTERM)
+            if not self.wait_for_exit(pid, STOP_TIMEOUT):
+                logger.warning(f"Stale process {pid} of child {self.name} did not exit after SIGTERM; killing it")
+                os.kill(pid, signal.SIGKILL)
+                self.wait_for_exit(pid, STOP_TIMEOUT)
+            logger.warning(f"Stopped stale process {pid} of child {self.name}")
+        except (OSError, ValueError):
+            pass
+
+    def start(self):
+        self.stop_stale_process()
+        if os.path.exists(self.heartbeat_path):
+            os.remove(self.heartbeat_path)
+        env = dict(os.environ, BOT_HEARTBEAT_FILE=self.heartbeat_path)
+        with open(os.path.join(self.directory, CHILD_LOG_FILE), "ab") as log_file:
+            self.process = subprocess.Popen([sys.executable, self.script], cwd=self.directory, env=env, stdin=subprocess.DEVNULL,
+                                            stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+        try:
+            os.setpriority(os.PRIO_PROCESS, self.process.pid, CHILD_NICE)
+        except (AttributeError, OSError):
+            pass
+        with open(self.pid_path, "w") as f:
+            f.write(str(self.process.pid))
+        self.state = "running"
+        self.started_at = time.time()
+        self.next_start_at = None
+        self.cpu_sample = None
+        self.cpu_percent = 0.0
+        self.cpu_over_since = None
+        logger.info(f"Started child {self.name} (pid {self.process.pid})")
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def heartbeat_age(self):
+        try:
+            return time.time() - os.path.getmtime(self.heartbeat_path)
+        except OSError:
+            return None
+
+    # Refresh CPU and memory figures; returns a reason to restart the child, or None if it is healthy
+    def check_health(self, now):
+        usage = read_process_usage(self.process.pid)
+        if usage is not None:
+            cpu_seconds, rss_bytes = usage
+            if self.cpu_sample is not None and now > self.cpu_sample[0]:
+                self.cpu_percent = 100 * (cpu_seconds - self.cpu_sample[1]) / (now - self.cpu_sample[0])
+            self.cpu_sample = (now, cpu_seconds)
+            self.rss_mb = rss_bytes / (1024 * 1024)
+            if MEMORY_LIMIT_MB and self.rss_mb > MEMORY_LIMIT_MB:
+                return f"memory {self.rss_mb:.0f} MB over the {MEMORY_LIMIT_MB} MB limit"
+            if CPU_LIMIT_PERCENT and self.cpu_percent > CPU_LIMIT_PERCENT:
+                self.cpu_over_since = self.cpu_over_since or now
+                if now - self.cpu_over_since >= CPU_LIMIT_SECONDS:
+                    return f"CPU above {CPU_LIMIT_PERCENT}% for {CPU_LIMIT_SECONDS}s"
+            else:
+                self.cpu_over_since = None
+        # Bots rendered before heartbeats existed never write one; they are only checked for exits
+        heartbeat_age = self.heartbeat_age()
+        if heartbeat_age is not None and heartbeat_age > HEARTBEAT_TIMEOUT:
+            return f"no heartbeat for {heartbeat_age:.0f}s"
+        return None
+
+    # Send SIGTERM without waiting; the monitor collects the exit (or kills the child) on a later tick
+    def terminate(self, reason, now):
+        self.process.terminate()
+        self.state = "stopping"
+        self.stop_reason = reason
+        self.stop_deadline = now + STOP_TIMEOUT
+
+    def stop(self):
+        if not self.is_running():
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Child {self.name} did not exit after SIGTERM; killing it")
+            self.process.kill()
+            self.process.wait()
+
+    def status(self):
+        running = self.is_running()
+        return {"name": self.name, "state": self.state, "pid": self.process.pid if running else None,
+                "uptime": time.time() - self.started_at if running else 0, "restarts": self.restarts,
+                "last_exit_code": self.last_exit_code, "last_problem": self.last_problem,
+                "rss_mb": self.rss_mb if running else 0, "cpu_percent": self.cpu_percent if running else 0,
+                "heartbeat_age": self.heartbeat_age() if running else None}
+
+# Starts child bots, restarts the ones that exit or turn unhealthy with exponential backoff, and
+# parks children that keep crashing in "crash-loop" until they are restarted by hand
+class Supervisor:
+    def __init__(self, on_crash_loop=None):
+        self.on_crash_loop = on_crash_loop
+        self.children = {}
+        self.lock = threading.Lock()
+        self.monitor = threading.Thread(target=self._monitor_loop, name="supervisor", daemon=True)
+        self.monitor.start()
+
+    # Start (or restart with new code) the child in `directory`
+    def start_child(self, name, directory, script="bot.py"):
+        child = ChildProcess(name, directory, script)
+        with self.lock:
+            previous = self.children.get(name)
+            self.children[name] = child
+            if previous is not None:
+                # Marked first, like stop_child, so the monitor does not see it exit and schedule a restart
+                previous.state = "stopped"
+        if previous is not None:
+            previous.stop()
+        self._start(child)
+        return child
+
+    # Restart a child now, clearing its backoff and crash-loop state
+    def restart_child(self, name):
+        with self.lock:
+            child = self.children.get(name)
+            if child is None:
+                return False
+            if child.state == "starting":
+                return True
+            # "starting" keeps the monitor away from the child while it is stopped and started again
+            child.state = "starting"
+        child.stop()
+        child.failures_in_a_row = 0
+        child.restart_times.clear()
+        child.restarts += 1
+        self._start(child)
+        return True
+
+    # Start a child claimed as "starting", without holding the lock: start() may first wait up to
+    # 2 x STOP_TIMEOUT for a stale process to exit. A child stopped or replaced meanwhile is stopped again.
+    def _start(self, child):
+        try:
+            child.start()
+        except Exception:
+            # Retried by the monitor like a crashed child
+            child.state = "backoff"
+            child.next_start_at = time.time() + RESTART_BACKOFF_BASE
+            raise
+        with self.lock:
+            current = self.children.get(child.name) is child
+        if not current:
+            child.state = "stopped"
+            child.stop()
+
+    def stop_child(self, name):
+        with self.lock:
+            child = self.children.pop(name, None)
+        if child is not None:
+            child.state = "stopped"
+            child.stop()
+            logger.info(f"Stopped child {name}")
+        return child is not None
+
+    def get_child(self, name):
+        with self.lock:
+            return self.children.get(name)
+
+    def status(self):
+        with self.lock:
+            children = list(self.children.values())
+        return [child.status() for child in children]
+
+    def stop_all(self):
+        with self.lock:
+            names = list(self.children)
+        for name in names:
+            self.stop_child(name)
+
+    def _handle_failure(self, child, problem, now):
+        child.last_problem = problem
+        child.failures_in_a_row = 0 if now - child.started_at >= STABLE_AFTER else child.failures_in_a_row
+        child.failures_in_a_row += 1
+        child.restart_times.append(now)
+        while child.restart_times and now - child.restart_times[0] > CRASH_LOOP_WINDOW:
+            child.restart_times.popleft()
+        if len(child.restart_times) >= CRASH_LOOP_RESTARTS:
+            child.state = "crash-loop"
+            logger.error(f"Child {child.name} failed {len(child.restart_times)} times in {CRASH_LOOP_WINDOW}s ({problem}); not restarting it")
+            if self.on_crash_loop:
+                self.on_crash_loop(child.status())
+            return
+        delay = min(RESTART_BACKOFF_BASE * 2 ** (child.failures_in_a_row - 1), RESTART_BACKOFF_MAX)
+        child.state = "backoff"
+        child.next_start_at = now + delay
+        logger.warning(f"Child {child.name} failed ({problem}); restarting in {delay}s")
+
+    def _supervise(self, child, now):
+        if child.state == "running":
+            if not child.is_running():
+                child.last_exit_code = child.process.returncode
+                self._handle_failure(child, f"exited with code {child.last_exit_code}", now)
+                return
+            problem = child.check_health(now)
+            if problem:
+                # Waiting here would hold up every other child for up to STOP_TIMEOUT
+                child.terminate(problem, now)
+        elif child.state == "stopping":
+            if child.is_running():
+                if now >= child.stop_deadline:
+                    logger.warning(f"Child {child.name} did not exit after SIGTERM; killing it")
+                    child.process.kill()
+                return
+            child.last_exit_code = child.process.returncode
+            self._handle_failure(child, child.stop_reason, now)
+        elif child.state == "backoff" and now >= child.next_start_at:
+            with self.lock:
+                # Not restarted if it was stopped or replaced meanwhile
+                if self.children.get(child.name) is not child:
+                    return
+                child.state = "starting"
+                child.restarts += 1
+            self._start(child)
+
+    def _monitor_loop(self):
+        while True:
+            time.sleep(1)
+            with self.lock:
+                children = list(self.children.values())
+            for child in children:
+                try:
+                    self._supervise(child, time.time())
+                except Exception as e:
+                    logger.error(f"Supervising child {child.name} failed: {e}", exc_info=True)
@@ -0,0 +1,252 @@
+"""Template rendering and CONFIG validation shared by the Template Creator (bot.py) and the maker bots' deploy pipeline"""
+import os
+import re
+import ast
+import math
+import logging
+from urllib.parse import urlparse
+
+logger = logging.getLogger("template_renderer")
+
+# Template files are looked up next to this module, whatever the working directory
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Template files content
+TEMPLATES = {
+    'naira': 'nairabot_template.py',
+    'ton': 'tonbot_template.py',
+    'star': 'starbot_template.py',
+    # asyncio (AsyncTeleBot) editions: long polling only, without heartbeat or webhook mode;
+    # the makers do not deploy them (see DEPLOYABLE_TEMPLATES), run them by hand
+    'naira_async': 'nairabot_async_template.py',
+    'ton_async': 'tonbot_async_template.py',
+    'star_async': 'starbot_async_template.py'
+}
+
+class TemplateError(RuntimeError):
+    """A template that load_templates() was required to prepare but could not"""
+
+def read_template_file(template_name):
+    """Read the template file content"""
+    try:
+        template_file = TEMPLATES.get(template_name)
+        if not template_file:
+            logger.error(f"Template '{template_name}' not found in TEMPLATES")
+            return None
+
+        template_path = os.path.join(TEMPLATE_DIR, template_file)
+        if not os.path.exists(template_path):
+            logger.error(f"Template file does not exist: {template_file}")
+            return None
+
+        with open(template_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+            logger.info(f"Successfully read template file: {template_file} ({len(content)} chars)")
+            return content
+    except Exception as e:
+        logger.error(f"Error reading template file {template_name}: {e}", exc_info=True)
+        return None
+
+class PreparedTemplate:
+    """A template split once around its CONFIG assignment, so rendering is prefix + config + suffix"""
+
+    def __init__(self, name, content):
+        self.name = name
+        self.size = len(content)
+        # The assignment is located with the parser, so any formatting or length of the CONFIG block works
+        tree = ast.parse(content, TEMPLATES.get(name, name))
+        config_node = next((node for node in tree.body if isinstance(node, ast.Assign)
+                            and any(isinstance(target, ast.Name) and target.id == 'CONFIG' for target in node.targets)), None)
+        if config_node is not None:
+            lines = content.splitlines(keepends=True)
+            self.prefix = ''.join(lines[:config_node.lineno - 1])
+            self.suffix = '\n' + ''.join(lines[config_node.end_lineno:])
+        else:
+            # If template has no CONFIG block, the config is appended
+            self.prefix = content + '\n\n'
+            self.suffix = ''
+
+    def render(self, config):
+        """Return the template source with `config` in place of its CONFIG block"""
+        return self.prefix + config + self.suffix
+
+# Prepared templates by name, filled once by load_templates()
+prepared_templates = {}
+
+def prepare_template(template_name):
+    """Read and prepare one template; returns None if it is missing or not valid Python"""
+    content = read_template_file(template_name)
+    if content is None:
+        return None
+    try:
+        return PreparedTemplate(template_name, content)
+    except SyntaxError as e:
+        logger.error(f"Template {TEMPLATES.get(template_name)} is not valid Python: {e}")
+        return None
+
+def load_templates(required=()):
+    """Prepare every template once at startup; returns the names that are available.
+
+    Raises TemplateError if any template named in `required` is missing or not valid Python,
+    so a process that needs it stops at startup instead of failing on every render.
+    """
+    for template_name in TEMPLATES:
+        template = prepare_template(template_name)
+        if template is not None:
+            prepared_templates[template_name] = template
+    missing = [template_name for template_name in required if template_name not in prepared_templates]
+    if missing:
+        raise TemplateError(f"Required template(s) unavailable: {', '.join(missing)}")
+    return list(prepared_templates)
+
+def get_template(template_name):
+    """Return the template prepared by load_templates(), or None if it is unavailable"""
+    template = prepared_templates.get(template_name)
+    if template is None:
+        logger.error(f"Template '{template_name}' is not loaded (missing or invalid at startup; restart after fixing it)")
+    return template
+
+def render_template(template_name, config):
+    """Render a template with the given CONFIG block, or None if the template is unavailable"""
+    template = get_template(template_name)
+    return template.render(config) if template is not None else None
+
+class ConfigError(ValueError):
+    """A CONFIG block that could not be parsed or does not match CONFIG_SCHEMA"""
+
+    def __init__(self, errors):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+BOT_TOKEN_PATTERN = re.compile(r'^\d+:[A-Za-z0-9_-]+$')
+BOT_USERNAME_PATTERN = re.compile(r'^@[A-Za-z0-9_]{5,32}$')
+PUBLIC_CHANNEL_PATTERN = re.compile(r'^(https?://)?t\.me/[A-Za-z0-9_]{5,32}$')
+
+LINK_FIELDS = {
+    'name': {'type': str, 'min_length': 1, 'max_length': 64},
+    'url': {'type': str, 'url': True},
+}
+
+# Keys every template reads from CONFIG, with the checks their values must pass
+CONFIG_SCHEMA = {
+    'BOT_TOKEN': {'type': str, 'pattern': BOT_TOKEN_PATTERN, 'hint': 'a token from @BotFather like 123456:ABC-DEF'},
+    'ADMIN_ID': {'type': int, 'min': 1},
+    'REFERRAL_REWARD': {'type': (int, float), 'min': 0},
+    'MIN_WITHDRAWAL': {'type': (int, float), 'min': 0},
+    'MAX_WITHDRAWAL': {'type': (int, float), 'min': 0},
+    'WITHDRAWAL_ENABLED': {'type': bool},
+    'MUST_JOIN_CHANNELS': {'type': list, 'items': dict(LINK_FIELDS, check={'type': bool})},
+    'TASKS': {'type': list, 'items': dict(LINK_FIELDS, reward={'type': (int, float), 'min': 0})},
+    'PAYMENT_CHANNEL': {'type': str, 'url': True},
+    'BOT_USERNAME': {'type': str, 'pattern': BOT_USERNAME_PATTERN, 'hint': 'an @username of 5-32 letters, digits or _'},
+    'BOT_NAME': {'type': str, 'min_length': 1, 'max_length': 64},
+}
+
+def is_button_url(url):
+    """True for links a Telegram URL button accepts: http(s), or the bare t.me/... form the maker allows"""
+    if url.startswith('t.me/'):
+        url = 'https://' + url
+    parsed = urlparse(url)
+    return parsed.scheme in ('http', 'https') and bool(parsed.netloc) and not any(c.isspace() for c in url)
+
+def find_config_source(text):
+    """Return the `CONFIG = {...}` source in text and its parsed AST
+
+    The block ends at the first closing brace after which it parses as Python, so braces inside
+    strings (channel names, URLs) do not end it early.
+    """
+    start = text.find('CONFIG = {')
+    if start == -1:
+        raise ConfigError(["No 'CONFIG = {' block found"])
+    syntax_error = None
+    end = text.find('}', start)
+    while end != -1:
+        source = text[start:end + 1]
+        try:
+            return source, ast.parse(source)
+        except SyntaxError as e:
+            syntax_error = e
+        end = text.find('}', end + 1)
+    if syntax_error is None:
+        raise ConfigError(["CONFIG block is never closed with '}'"])
+    raise ConfigError([f"CONFIG is not valid Python (line {syntax_error.lineno} of the block: {syntax_error.msg})"])
+
+def check_value(path, value, spec, errors):
+    """Append to errors every way value breaks spec"""
+    types = spec['type'] if isinstance(spec['type'], tuple) else (spec['type'],)
+    if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+        expected = ' or '.join(t.__name__ for t in types)
+        errors.append(f"{path} must be {expected}, not {type(value).__name__} ({value!r})")
+        return
+    if isinstance(value, float) and not math.isfinite(value):
+        errors.append(f"{path} must be a finite number, got {value!r}")
+    elif 'min' in spec and value < spec['min']:
+        errors.append(f"{path} must be at least {spec['min']}, got {value!r}")
+    if 'min_length' in spec and len(value.strip()) < spec['min_length']:
+        errors.append(f"{path} must not be empty")
+    if 'max_length' in spec and len(value) > spec['max_length']:
+        errors.append(f"{path} must be at most {spec['max_length']} characters, got {len(value)}")
+    if 'pattern' in spec and not spec['pattern'].match(value):
+        errors.append(f"{path} must be {spec['hint']}, got {value!r}")
+    if spec.get('url') and not is_button_url(value):
+        errors.append(f"{path} must be an http(s):// or t.me/ link, got {value!r}")
+    if 'items' in spec:
+        for i, item in enumerate(value):
+            check_fields(f"{path}[{i}]", item, spec['items'], errors)
+
+def check_fields(path, value, schema, errors):
+    """Append to errors every missing, unknown or invalid key of the dict value"""
+    if not isinstance(value, dict):
+        errors.append(f"{path} must be a dict, not {type(value).__name__}")
+        return
+    for key, spec in schema.items():
+        if key not in value:
+            errors.append(f"{path} is missing {key!r}")
+        else:
+            check_value(f"{path}[{key!r}]", value[key], spec, errors)
+    for key in value:
+        if key not in schema:
+            errors.append(f"{path} has unknown key {key!r}")
+
+def validate_config(config):
+    """Return the list of problems with a CONFIG dict (empty if it is valid)"""
+    errors = []
+    check_fields('CONFIG', config, CONFIG_SCHEMA, errors)
+    if errors:
+        return errors
+    if config['MIN_WITHDRAWAL'] > config['MAX_WITHDRAWAL']:
+        errors.append(f"CONFIG['MIN_WITHDRAWAL'] ({config['MIN_WITHDRAWAL']}) is above CONFIG['MAX_WITHDRAWAL'] ({config['MAX_WITHDRAWAL']})")
+    for i, channel in enumerate(config['MUST_JOIN_CHANNELS']):
+        # Membership is checked against the link's last path segment, so only public t.me/<name> links work
+        if channel['check'] and not PUBLIC_CHANNEL_PATTERN.match(channel['url']):
+            errors.append(f"CONFIG['MUST_JOIN_CHANNELS'][{i}] has check=True, but {channel['url']!r} is not a public t.me/<name> channel link")
+    return errors
+
+def parse_config(text):
+    """Extract the CONFIG block from text and validate it
+
+    Returns (source, config), where source is the `CONFIG = {...}` text ready for render_template().
+    Raises ConfigError listing every problem found.
+    """
+    source, tree = find_config_source(text)
+    node = tree.body[0] if len(tree.body) == 1 else None
+    if not isinstance(node, ast.Assign) or not isinstance(node.value, ast.Dict):
+        raise ConfigError(["CONFIG must be a single dict assignment"])
+    seen = {}
+    errors = []
+    for key in node.value.keys:
+        if isinstance(key, ast.Constant):
+            if key.value in seen:
+                errors.append(f"Duplicate key {key.value!r} on lines {seen[key.value]} and {key.lineno} of the block")
+            seen.setdefault(key.value, key.lineno)
+    try:
+        config = ast.literal_eval(node.value)
+    except ValueError:
+        literal_nodes = (ast.Dict, ast.List, ast.Tuple, ast.Constant, ast.UnaryOp, ast.USub, ast.UAdd, ast.Load)
+        bad = next((n for n in ast.walk(node.value) if not isinstance(n, literal_nodes)), node.value)
+        raise ConfigError(errors + [f"CONFIG may only contain literal values (strings, numbers, True/False, lists, dicts), "
+                                    f"not {ast.unparse(bad)!r} on line {bad.lineno} of the block"])
+    errors += validate_config(config)
+    if errors:
+        raise ConfigError(errors)
+    return source, config
@@ -0,0 +1,523 @@
+import ast
+import os
+import atexit
+import json
+import time
+import re
+import zlib
+import hmac
+import hashlib
+import queue
+import secrets
+import logging
+import argparse
+import threading
+import telebot
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("runtime")
+
+# Hosts many generated bots in one process. Every bot ("tenant") is a directory in TENANTS_DIR holding
+# config.py (the CONFIG block produced by the maker's create_config_data), an optional tenant.json
+# ({"template": "ton" | "naira" | "star", "enabled": true}) and, once running, the bot's own data files.
+TENANTS_DIR = "tenants"
+TENANT_SCAN_INTERVAL = 30  # Seconds between scans of TENANTS_DIR for added, removed, changed or disabled bots
+TENANT_STATUS_FILE = "runtime.json"  # Written into a tenant's directory once it is running (or failed to start); the maker waits for it
+MAX_TENANTS = 500  # Bots one process will host; run more processes with --shard to go beyond
+DEFAULT_TEMPLATE = "ton"
+TEMPLATES = {
+    'naira': 'nairabot_template.py',
+    'ton': 'tonbot_template.py',
+    'star': 'starbot_template.py'
+}
+
+HANDLER_WORKERS = 16  # Threads running update handlers for all bots; one chat of one bot always uses the same thread
+HANDLER_QUEUE_SIZE = 5000  # Updates waiting per handler thread before dispatch blocks (backpressure on polling/webhook)
+VERIFY_WORKERS = 32  # Threads shared by every bot's parallel channel-membership checks
+HTTP_POOL_SIZE = HANDLER_WORKERS + VERIFY_WORKERS + MAX_TENANTS + 4  # Long polling holds one connection per bot
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 30
+STATS_FLUSH_INTERVAL = 10  # Seconds between writes of every tenant's stats counters (one thread for all tenants)
+LONG_POLLING_TIMEOUT = 20  # Seconds one getUpdates call may wait for updates
+TENANT_STOP_TIMEOUT = LONG_POLLING_TIMEOUT + 10  # Seconds stopping a tenant waits for its getUpdates call, broadcasts and queued updates to finish
+
+# Webhook mode: set WEBHOOK_URL to the public https base URL. Every bot gets WEBHOOK_PATH/<bot id> on a
+# single HTTP server (WEBHOOK_PORT + shard index). Leave it empty to long-poll one thread per bot.
+WEBHOOK_URL = ""
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""  # Per-bot secret tokens are derived from this; a random one is generated per run if empty
+WEBHOOK_QUEUE_SIZE = 5000  # Updates waiting for the dispatcher; when full Telegram gets a 503 and redelivers later
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+# Names a template assigns at module level that the runtime supplies for each tenant instead.
+# Template constants ending in _FILE or _DIR are also replaced, with paths inside the tenant directory.
+TENANT_OVERRIDES = ("CONFIG", "bot", "http_session", "verify_executor", "HANDLER_WORKERS")
+# Template functions run, in order, when a tenant starts (what the template's main() does before polling)
+TENANT_STARTUP = ("ensure_files_exist", "init_storage", "init_stats", "resume_broadcast_jobs")
+
+# One keep-alive connection pool shared by every bot. Only connection failures and
+# 502/503/504 on GET requests are retried, so a send is never repeated after Telegram got it.
+def create_http_session():
+    session = requests.Session()
+    retries = Retry(total=3, connect=3, read=0, status=2, backoff_factor=0.5,
+                    status_forcelist=(502, 503, 504), allowed_methods=frozenset(["GET"]))
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE, max_retries=retries, pool_block=True)
+    session.mount("https://", adapter)
+    return session
+
+http_session = create_http_session()
+telebot.apihelper.session = http_session
+telebot.apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+telebot.apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+
+verify_executor = ThreadPoolExecutor(max_workers=VERIFY_WORKERS, thread_name_prefix="verify")
+
+# Handler threads shared by every tenant. Updates are hashed by (bot, chat) onto one worker
+# queue, so each chat of each bot is handled in order while everything else runs in parallel
+class SharedWorkerPool:
+    def __init__(self, num_workers, queue_size=0):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(num_workers)]
+        self.max_depths = [0] * num_workers
+        self.processed = [0] * num_workers
+        self.workers = [threading.Thread(target=self._work, args=(i,), name=f"tenant-worker-{i}", daemon=True) for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    @staticmethod
+    def chat_key(update):
+        chat = getattr(update, "chat", None) or getattr(getattr(update, "message", None), "chat", None)
+        if chat is not None:
+            return chat.id
+        user = getattr(update, "from_user", None)
+        return user.id if user is not None else 0
+
+    def put(self, tenant_pool, func, args, kwargs):
+        chat_id = self.chat_key(args[0]) if args else 0
+        index = hash((tenant_pool.bot_id, chat_id)) % len(self.queues)
+        self.queues[index].put((tenant_pool, func, args, kwargs))
+        self.max_depths[index] = max(self.max_depths[index], self.queues[index].qsize())
+
+    def _work(self, index):
+        tasks = self.queues[index]
+        while True:
+            tenant_pool, func, args, kwargs = tasks.get()
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                tenant_pool.report_exception(e)
+            finally:
+                self.processed[index] += 1
+                tenant_pool.task_done()
+                # Don't keep a stopped tenant (its namespace, storage and data) alive until this thread's next update
+                tenant_pool = func = args = kwargs = None
+
+    def queue_depths(self):
+        return [{"depth": tasks.qsize(), "max_depth": self.max_depths[i], "processed": self.processed[i]}
+                for i, tasks in enumerate(self.queues)]
+
+# What a tenant's TeleBot sees as its worker_pool: the shared threads, with the tenant's own
+# exception state so a failing handler only disturbs that bot's polling loop
+class TenantWorkerPool:
+    def __init__(self, shared_pool, telebot_instance):
+        self.shared_pool = shared_pool
+        self.telebot = telebot_instance
+        self.bot_id = telebot_instance.bot_id
+        self.exception_event = threading.Event()
+        self.exception_info = None
+        self.pending = 0  # This tenant's updates queued or running on the shared threads
+        self.idle = threading.Condition()
+
+    def put(self, func, *args, **kwargs):
+        with self.idle:
+            self.pending += 1
+        self.shared_pool.put(self, func, args, kwargs)
+
+    def task_done(self):
+        with self.idle:
+            self.pending -= 1
+            if not self.pending:
+                self.idle.notify_all()
+
+    def report_exception(self, e):
+        handled = self.telebot.exception_handler.handle(e) if self.telebot.exception_handler else False
+        if not handled:
+            # Surfaced by the bot's polling loop like telebot's own pool does
+            self.exception_info = e
+            self.exception_event.set()
+
+    def queue_depths(self):
+        return self.shared_pool.queue_depths()
+
+    def raise_exceptions(self):
+        if self.exception_event.is_set():
+            raise self.exception_info
+
+    def clear_exceptions(self):
+        self.exception_event.clear()
+
+    # Wait for this tenant's queued updates to be handled; False if some are still pending after timeout
+    def close(self, timeout=None):
+        with self.idle:
+            return self.idle.wait_for(lambda: not self.pending, timeout)
+
+shared_pool = SharedWorkerPool(HANDLER_WORKERS, HANDLER_QUEUE_SIZE)
+
+# A bot template compiled once and executed once per tenant. Top-level assignments of the names in
+# TENANT_OVERRIDES and of the *_FILE/*_DIR constants are rewritten to take the tenant's value, so
+# no tenant builds its own worker threads, HTTP pool or files in the shared working directory.
+class TenantTemplate:
+    def __init__(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            tree = ast.parse(f.read(), path)
+        self.path_constants = {}
+        assigned = set()
+        for node in tree.body:
+            if not (isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)):
+                continue
+            name = node.targets[0].id
+            is_path = name.endswith(("_FILE", "_DIR")) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+            if is_path:
+                self.path_constants[name] = node.value.value
+            if is_path or name in TENANT_OVERRIDES:
+                assigned.add(name)
+                # NAME = __tenant__["NAME"] if "NAME" in __tenant__ else <original value>
+                node.value = ast.IfExp(
+                    test=ast.Compare(left=ast.Constant(name), ops=[ast.In()], comparators=[ast.Name("__tenant__", ast.Load())]),
+                    body=ast.Subscript(value=ast.Name("__tenant__", ast.Load()), slice=ast.Constant(name), ctx=ast.Load()),
+                    orelse=node.value)
+        missing = set(TENANT_OVERRIDES) - assigned
+        if missing:
+            raise ValueError(f"{path} does not assign {', '.join(sorted(missing))} at module level")
+        ast.fix_missing_locations(tree)
+        self.path = path
+        self.code = compile(tree, path, "exec")
+
+templates = {}
+
+def get_template(name):
+    if name not in TEMPLATES:
+        raise ValueError(f"Unknown template '{name}' (expected one of {', '.join(TEMPLATES)})")
+    if name not in templates:
+        templates[name] = TenantTemplate(os.path.join(os.path.dirname(os.path.abspath(__file__)), TEMPLATES[name]))
+    return templates[name]
+
+# Read the CONFIG dict literal from a config.py written by the maker (without executing it)
+def load_tenant_config(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read(), path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == "CONFIG" for t in node.targets):
+            config = ast.literal_eval(node.value)
+            break
+    else:
+        raise ValueError(f"{path} has no CONFIG assignment")
+    if not isinstance(config, dict) or not re.fullmatch(r"\d+:[\w-]+", str(config.get("BOT_TOKEN", ""))):
+        raise ValueError(f"{path} has no valid BOT_TOKEN")
+    return config
+
+def load_tenant_settings(directory):
+    settings_path = os.path.join(directory, "tenant.json")
+    if not os.path.exists(settings_path):
+        return {}
+    with open(settings_path, 'r') as f:
+        return json.load(f)
+
+# One hosted bot: the template's module namespace, executed with the tenant's CONFIG, bot and paths
+class Tenant:
+    def __init__(self, name, directory, config, template_name):
+        self.name = name
+        self.directory = directory
+        self.template_name = template_name
+        self.bot = telebot.TeleBot(config["BOT_TOKEN"], threaded=False)
+        self.bot.threaded = True
+        self.worker_pool = TenantWorkerPool(shared_pool, self.bot)
+        self.bot.worker_pool = self.worker_pool
+        self.poll_thread = None
+        self.stopped = threading.Event()
+
+        template = get_template(template_name)
+        overrides = {"CONFIG": config, "bot": self.bot, "http_session": http_session,
+                     "verify_executor": verify_executor, "HANDLER_WORKERS": 0}
+        for constant, file_name in template.path_constants.items():
+            overrides[constant] = os.path.join(directory, file_name)
+        self.namespace = {"__name__": f"tenant.{name}", "__file__": template.path, "__tenant__": overrides}
+        exec(template.code, self.namespace)
+        # The template replaced the pool with its own (empty, HANDLER_WORKERS is 0); put the shared one back
+        self.bot.worker_pool = self.worker_pool
+
+    @property
+    def bot_id(self):
+        return self.bot.bot_id
+
+    @property
+    def webhook_secret(self):
+        return hmac.new(webhook_secret.encode(), str(self.bot_id).encode(), hashlib.sha256).hexdigest()
+
+    def start(self):
+        for function_name in TENANT_STARTUP:
+            self.namespace[function_name]()
+        # stats_flush_loop flushes every tenant's counters, so stop the tenant's own flush thread
+        stats_counters = self.namespace.get("stats_counters")
+        if stats_counters is not None:
+            stats_counters.stopped.set()
+        if WEBHOOK_URL:
+            self.bot.remove_webhook()
+            self.bot.set_webhook(url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}/{self.bot_id}", secret_token=self.webhook_secret)
+        else:
+            self.bot.remove_webhook()
+            self.poll_thread = threading.Thread(target=self._poll, name=f"poll-{self.name}", daemon=True)
+            self.poll_thread.start()
+        write_tenant_status(self.directory, {"status": "running", "bot_id": self.bot_id, "pid": os.getpid(),
+                                             "started_at": time.strftime("%Y-%m-%d %H:%M:%S")})
+        logger.info(f"Tenant {self.name} started ({self.template_name} template, bot id {self.bot_id})")
+
+    def _poll(self):
+        while not self.stopped.is_set():
+            try:
+                self.bot.polling(none_stop=True, interval=0, timeout=60, long_polling_timeout=LONG_POLLING_TIMEOUT)
+            except Exception as e:
+                logger.error(f"Polling failed for tenant {self.name}: {e}")
+                self.stopped.wait(10)
+
+    # Tell the polling loop and running broadcasts to finish; stop() waits for them
+    def request_stop(self):
+        self.stopped.set()
+        if self.poll_thread is not None:
+            self.bot.stop_polling()
+        # Interrupted broadcasts are resumed from their result logs when the tenant starts again
+        for job in list(self.namespace.get("broadcast_jobs", {}).values()):
+            if job.is_running():
+                job.request_stop("running")
+
+    # Stop the tenant and wait for its threads: a getUpdates call still in flight would make the
+    # restarted bot's polling fail with 409 Conflict. Returns False if something outlived TENANT_STOP_TIMEOUT.
+    def stop(self):
+        self.request_stop()
+        deadline = time.monotonic() + TENANT_STOP_TIMEOUT
+        threads = [job.thread for job in list(self.namespace.get("broadcast_jobs", {}).values()) if job.thread is not None]
+        if self.poll_thread is not None:
+            threads.append(self.poll_thread)
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        finished = not any(thread.is_alive() for thread in threads)
+        finished = self.worker_pool.close(max(0, deadline - time.monotonic())) and finished
+        if not finished:
+            logger.warning(f"Tenant {self.name} still has work running after {TENANT_STOP_TIMEOUT}s; closing its files anyway")
+        # The template registered these for its own process exit; drop them so stopped tenants aren't kept alive
+        for name in ("stats_counters", "storage"):
+            resource = self.namespace.get(name)
+            if resource is not None:
+                atexit.unregister(resource.close)
+                resource.close()
+        try:
+            os.remove(os.path.join(self.directory, TENANT_STATUS_FILE))
+        except OSError:
+            pass
+        logger.info(f"Tenant {self.name} stopped")
+        return finished
+
+tenants = {}
+tenants_by_bot_id = {}
+tenants_lock = threading.Lock()
+shard_index, shard_count = 0, 1
+
+def in_shard(name):
+    return zlib.crc32(name.encode()) % shard_count == shard_index
+
+def write_tenant_status(directory, status):
+    tmp_path = os.path.join(directory, TENANT_STATUS_FILE + ".tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, os.path.join(directory, TENANT_STATUS_FILE))
+
+def config_mtime(directory):
+    return os.path.getmtime(os.path.join(directory, "config.py"))
+
+def start_tenant(name):
+    directory = os.path.join(TENANTS_DIR, name)
+    try:
+        settings = load_tenant_settings(directory)
+        if not settings.get("enabled", True):
+            return None
+        loaded_mtime = config_mtime(directory)
+        config = load_tenant_config(os.path.join(directory, "config.py"))
+        tenant = Tenant(name, directory, config, settings.get("template", DEFAULT_TEMPLATE))
+        tenant.config_mtime = loaded_mtime
+        with tenants_lock:
+            tenants[name] = tenant
+            tenants_by_bot_id[tenant.bot_id] = tenant
+        try:
+            tenant.start()
+        except Exception:
+            stop_tenant(name)
+            raise
+    except Exception as e:
+        write_tenant_status(directory, {"status": "failed", "error": str(e), "failed_at": time.strftime("%Y-%m-%d %H:%M:%S")})
+        raise
+    return tenant
+
+def stop_tenant(name):
+    with tenants_lock:
+        tenant = tenants.pop(name, None)
+        if tenant is not None:
+            tenants_by_bot_id.pop(tenant.bot_id, None)
+    if tenant is None:
+        return True
+    return tenant.stop()
+
+# Start bots that appeared in TENANTS_DIR and stop the ones that were removed or disabled
+def scan_tenants():
+    if not os.path.isdir(TENANTS_DIR):
+        return
+    wanted = set()
+    for name in sorted(os.listdir(TENANTS_DIR)):
+        directory = os.path.join(TENANTS_DIR, name)
+        if not os.path.exists(os.path.join(directory, "config.py")) or not in_shard(name):
+            continue
+        try:
+            if load_tenant_settings(directory).get("enabled", True):
+                wanted.add(name)
+        except Exception as e:
+            logger.error(f"Could not read settings of tenant {name}: {e}")
+            if name in tenants:
+                wanted.add(name)  # Keep a running bot running while its settings file is being edited
+    with tenants_lock:
+        running = set(tenants)
+        # A redeployed bot (new config.py) is restarted with the new config
+        changed = {name for name in running & wanted if tenants[name].config_mtime != config_mtime(tenants[name].directory)}
+    # The old instance is stopped (and its getUpdates call finished) before the new one starts
+    for name in sorted((running - wanted) | changed):
+        if not stop_tenant(name) and name in changed:
+            changed.discard(name)
+            logger.warning(f"Not restarting tenant {name} until the next scan: its previous instance is still finishing")
+    running -= changed
+    for name in sorted(wanted - running):
+        if len(tenants) >= MAX_TENANTS:
+            logger.warning(f"MAX_TENANTS ({MAX_TENANTS}) reached; not starting {len(wanted - running)} more tenant(s)")
+            break
+        try:
+            start_tenant(name)
+        except Exception as e:
+            logger.error(f"Could not start tenant {name}: {e}", exc_info=True)
+
+def stats_flush_loop():
+    while True:
+        time.sleep(STATS_FLUSH_INTERVAL)
+        with tenants_lock:
+            running = list(tenants.values())
+        for tenant in running:
+            stats_counters = tenant.namespace.get("stats_counters")
+            try:
+                if stats_counters is not None:
+                    stats_counters.flush()
+            except Exception as e:
+                logger.error(f"Could not flush stats of tenant {tenant.name}: {e}")
+
+def tenant_scan_loop():
+    while True:
+        time.sleep(TENANT_SCAN_INTERVAL)
+        try:
+            scan_tenants()
+        except Exception as e:
+            logger.error(f"Tenant scan failed: {e}", exc_info=True)
+
+webhook_updates = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+webhook_secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+# Receive updates for every tenant and queue them for the dispatcher
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        prefix, _, bot_id = self.path.rpartition("/")
+        with tenants_lock:
+            tenant = tenants_by_bot_id.get(int(bot_id)) if prefix == WEBHOOK_PATH and bot_id.isdigit() else None
+        if tenant is None:
+            self.send_error(404)
+            return
+        if not hmac.compare_digest(self.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), tenant.webhook_secret):
+            logger.warning(f"Rejected webhook request for tenant {tenant.name} from {self.client_address[0]}: bad secret token")
+            self.send_error(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = 0
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            self.send_error(400)
+            return
+        try:
+            update_json = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_error(400)
+            return
+        try:
+            webhook_updates.put_nowait((tenant, update_json))
+        except queue.Full:
+            logger.warning("Webhook update queue is full, asking Telegram to redeliver")
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(f"Webhook {self.client_address[0]}: {format % args}")
+
+# Hand queued webhook updates to their tenant's handlers (which run on the shared pool)
+def webhook_worker():
+    while True:
+        tenant, update_json = webhook_updates.get()
+        try:
+            tenant.bot.process_new_updates([telebot.types.Update.de_json(update_json)])
+        except Exception as e:
+            logger.error(f"Error handling webhook update {update_json.get('update_id')} for tenant {tenant.name}: {e}")
+
+def start_webhook_server():
+    threading.Thread(target=webhook_worker, name="webhook-dispatcher", daemon=True).start()
+    server = ThreadingHTTPServer((WEBHOOK_HOST, WEBHOOK_PORT + shard_index), WebhookRequestHandler)
+    server.daemon_threads = True
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{server.server_port}{WEBHOOK_PATH}/<bot id>")
+    return server
+
+def main():
+    global shard_index, shard_count
+    parser = argparse.ArgumentParser(description="Run every bot in TENANTS_DIR in this process.")
+    parser.add_argument("--shard", default="0/1", help="INDEX/COUNT: host only the bots hashed to this shard (one process per core)")
+    args = parser.parse_args()
+    shard_index, shard_count = (int(part) for part in args.shard.split("/"))
+    if not 0 <= shard_index < shard_count:
+        parser.error("--shard must be INDEX/COUNT with 0 <= INDEX < COUNT")
+
+    logger.info(f"--- Starting tenant runtime (shard {shard_index}/{shard_count}, {TENANTS_DIR}) ---")
+    server = start_webhook_server() if WEBHOOK_URL else None
+    scan_tenants()
+    logger.info(f"{len(tenants)} tenant(s) running")
+    threading.Thread(target=tenant_scan_loop, name="tenant-scan", daemon=True).start()
+    threading.Thread(target=stats_flush_loop, name="stats-flush", daemon=True).start()
+    try:
+        if server is not None:
+            server.serve_forever()
+        else:
+            threading.Event().wait()
+    except KeyboardInterrupt:
+        logger.info("Stopping tenant runtime...")
+    finally:
+        with tenants_lock:
+            stopping = list(tenants.values())
+        for tenant in stopping:
+            tenant.request_stop()  # Every polling loop winds down at the same time rather than one after another
+        for name in list(tenants):
+            stop_tenant(name)
+
+if __name__ == "__main__":
+    main()